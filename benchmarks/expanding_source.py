@@ -0,0 +1,65 @@
+'''
+compare the single pass distance transform of NCC.distances.expanding_source
+against the previous loop, which ran distance_transform_edt once per number of
+caustic crossings
+
+usage: python benchmarks/expanding_source.py [--num_pixels N] [--num_levels L]
+'''
+from microlensing.NCC import distances
+
+from scipy.ndimage import distance_transform_edt, gaussian_filter
+from types import SimpleNamespace
+import argparse
+import numpy as np
+import time
+
+
+def loop_expanding_source(vals):
+    '''
+    distance transform of every value in turn, as expanding_source did before
+    '''
+    d_caustic = np.zeros(vals.shape)
+    for i in range(np.min(vals), np.max(vals) + 1):
+        mask = (vals==i)
+        d = distance_transform_edt(mask)
+        d_caustic[mask] = d[mask]
+    return d_caustic
+
+def ncc_map(num_pixels: int, num_levels: int, seed: int = 0):
+    '''
+    smooth random field quantized into num_levels values, resembling a map of
+    the number of caustic crossings
+    '''
+    rng = np.random.default_rng(seed)
+    field = gaussian_filter(rng.random((num_pixels, num_pixels)), num_pixels / 100)
+    field = (field - field.min()) / (field.max() - field.min())
+    return np.minimum(field * num_levels, num_levels - 1).astype(np.int32)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_pixels', type=int, default=2000)
+    parser.add_argument('--num_levels', type=int, nargs='+', default=[10, 30, 60])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'levels':>8} {'loop (s)':>10} {'single pass (s)':>16} {'speedup':>8} {'identical':>10}")
+    for num_levels in args.num_levels:
+        vals = ncc_map(args.num_pixels, num_levels)
+        ncc = SimpleNamespace(num_caustic_crossings=vals, pixel_scales=[1, 1])
+
+        loop_times, new_times = [], []
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            expected = loop_expanding_source(vals)
+            loop_times.append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            result = distances.expanding_source(ncc)
+            new_times.append(time.perf_counter() - t)
+
+        print(f"{np.unique(vals).size:>8} {min(loop_times):>10.3f} {min(new_times):>16.3f} "
+              f"{min(loop_times) / min(new_times):>8.1f} {str(np.array_equal(result, expected)):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+time the import of each module of the package in a fresh interpreter, and fail
+if any takes longer than the budget or loads a library that is only needed to
+plot, to convert units, or to run on the GPU. the shared libraries are loaded
+when the first object is constructed rather than on import
+
+usage: python benchmarks/import_time.py [--budget SECONDS] [--repeat N]
+                                        [--modules NAME ...]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+MODULES = ['microlensing.IPM.ipm', 'microlensing.CCF.ccf', 'microlensing.CCF.stitching', 'microlensing.NCC.ncc',
+           'microlensing.MIF.mif', 'microlensing.Stars.stars', 'microlensing.Util.sweep', 'microlensing.Util.length_scales']
+
+# modules that none of the above may load on import
+DEFERRED = ['matplotlib', 'shapely', 'astropy', 'sncosmo',
+            'microlensing.IPM.lib_ipm', 'microlensing.IPM.lib_ipm_double', 'microlensing.CCF.lib_ccf',
+            'microlensing.NCC.lib_ncc', 'microlensing.MIF.lib_mif']
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'loaded': [name for name in {deferred} if name in sys.modules]}}))
+'''
+
+
+def import_time(module: str, repeat: int):
+    '''
+    :param module: name of the module to import
+    :param repeat: number of fresh interpreters to import the module in
+    :return time: shortest time in seconds to import the module
+    :return loaded: deferred modules that the import loaded
+    '''
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    times = []
+    loaded = set()
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', SCRIPT.format(module=module, deferred=DEFERRED)],
+                                capture_output=True, text=True, env=env)
+        if result.returncode != 0:
+            raise Exception(f"Error importing {module}\n{result.stderr}")
+        result = json.loads(result.stdout.splitlines()[-1])
+        times.append(result['time'])
+        loaded.update(result['loaded'])
+    return min(times), sorted(loaded)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help='largest allowed import time of each module in seconds, including numpy')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    args = parser.parse_args()
+
+    if args.budget <= 0:
+        raise ValueError("budget must be > 0")
+    if args.repeat < 1:
+        raise ValueError("repeat must be >= 1")
+
+    baseline, _ = import_time('numpy', args.repeat)
+    print(f"{'numpy':<36} {baseline:8.3f} s")
+
+    failed = []
+    for module in args.modules:
+        elapsed, loaded = import_time(module, args.repeat)
+        status = 'ok'
+        if elapsed > args.budget:
+            status = 'over budget'
+        if loaded:
+            status = f"loaded {', '.join(loaded)}"
+        if status != 'ok':
+            failed.append(module)
+        print(f"{module:<36} {elapsed:8.3f} s  {status}")
+
+    if failed:
+        print(f"{len(failed)} of {len(args.modules)} modules failed the {args.budget} s import budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+'''
+benchmarks of the Python layers on synthetic magnification maps, maps of the
+number of caustic crossings, caustics, and star files. every case is run at
+each requested scale, recording the time and the peak memory allocated while
+it runs, and the results are written to a json report. reports from two
+releases can be compared to find regressions. only the CPU is needed
+
+scales run maps of 1000^2 (small), 4000^2 (medium), 8000^2 (large), and
+16000^2 (xlarge) pixels, and 10^3, 10^5, 10^6, and 10^7 stars
+
+usage: python benchmarks/suite.py [--scales small medium] [--filter NAME]
+                                  [--repeat N] [--output report.json]
+       python benchmarks/suite.py --compare base.json new.json [--threshold 1.2]
+'''
+from microlensing.CCF import stitching
+from microlensing.Lightcurves import lightcurves, ncc_curves
+from microlensing.Lightcurves.cache import ConvolvedMapCache
+from microlensing.MIF.mif import accumulate_lines
+from microlensing.NCC import distances
+from microlensing.SourceProfiles.gaussian import Gaussian, Gaussians
+from microlensing.SourceProfiles.uniform_disk import UniformDisk
+from microlensing.Util import util
+from microlensing.Util.ragged_array import RaggedArray
+
+from scipy.ndimage import zoom
+from types import SimpleNamespace
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+
+SCALES = ['small', 'medium', 'large', 'xlarge']
+NUM_PIXELS = {'small': 1000, 'medium': 4000, 'large': 8000, 'xlarge': 16000}
+NUM_STARS = {'small': 10**3, 'medium': 10**5, 'large': 10**6, 'xlarge': 10**7}
+
+
+def magnification_map(num_pixels: int, seed: int = 0):
+    '''
+    object with the attributes of an IPM instance that has run, with a
+    lognormal map
+    '''
+    rng = np.random.default_rng(seed)
+    return SimpleNamespace(magnifications=rng.lognormal(0, 0.5, (num_pixels, num_pixels)).astype(np.float32),
+                           center=(0, 0), half_length=(10, 10), num_pixels=(num_pixels, num_pixels),
+                           pixel_scales=(20 / num_pixels, 20 / num_pixels))
+
+def ncc_map(num_pixels: int, num_levels: int = 30, seed: int = 0):
+    '''
+    object with the attributes of an NCC instance that has run, with a smooth
+    random field quantized into num_levels values
+    '''
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((64, 64))
+    field = zoom(coarse, num_pixels / 64, order=1)[:num_pixels, :num_pixels]
+    field = (field - field.min()) / (field.max() - field.min())
+    vals = np.minimum(field * num_levels, num_levels - 1).astype(np.int32)
+    return SimpleNamespace(num_caustic_crossings=vals,
+                           center=(0, 0), half_length=(10, 10), num_pixels=(num_pixels, num_pixels),
+                           pixel_scales=(20 / num_pixels, 20 / num_pixels))
+
+def caustic_branches(num_loops: int, num_branches: int = 4, num_points: int = 100, seed: int = 0):
+    '''
+    closed loops split into branches whose ends meet, in a random order, as
+    the critical curves or caustics of a CCF instance
+
+    :return x: array of shape (num_loops * num_branches, num_points, 2)
+    '''
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-100, 100, (num_loops, 1, 1))
+    radii = rng.uniform(0.1, 1, (num_loops, 1, 1))
+    t = np.linspace(0, 1, num_points)
+    phi = 2 * np.pi * (np.arange(num_branches)[None, :, None] + t) / num_branches
+    x = np.stack([centers + radii * np.cos(phi), centers + radii * np.sin(phi)], axis=-1)
+    x = x.reshape(-1, num_points, 2)
+    return x[rng.permutation(x.shape[0])]
+
+def mif_lines(num_lines: int, num_points: int = 200, seed: int = 0):
+    '''
+    magnifications along the image lines of a MIF instance
+    '''
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(num_points // 2, num_points, num_lines)
+    x = np.cumsum(rng.normal(0, 1, lengths.sum()))
+    y = rng.lognormal(0, 1, lengths.sum())
+    return x, y, lengths, np.linspace(x.min(), x.max(), 10000)
+
+def write_ragged(fname: str, num_members: int, seed: int = 0):
+    '''
+    ragged array of complex doubles, as the image lines written by MIF
+    '''
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(10, 200, num_members).astype(np.int32)
+    with open(fname, 'wb') as f:
+        np.array([num_members], dtype=np.int32).tofile(f)
+        for n in lengths:
+            np.array([n], dtype=np.int32).tofile(f)
+            rng.random(2 * n).tofile(f)
+
+
+class Case():
+    '''
+    benchmark of a function at several scales. setup(scale, tmpdir) returns
+    the arguments of run, and is not timed
+    '''
+
+    def __init__(self, name: str, setup, run):
+        self.name = name
+        self.setup = setup
+        self.run = run
+
+CASES = []
+
+def case(name: str, setup):
+    def register(run):
+        CASES.append(Case(name, setup, run))
+        return run
+    return register
+
+
+@case('lightcurves.constant_source', lambda scale, tmpdir: (magnification_map(NUM_PIXELS[scale]), Gaussian(10)))
+def _(ipm, source):
+    # an empty cache so every run convolves the map
+    lightcurves.constant_source(ipm, source, 10000, cache=ConvolvedMapCache(max_bytes=0))
+
+@case('lightcurves.constant_source_tracks', lambda scale, tmpdir: (magnification_map(NUM_PIXELS[scale]), Gaussian(10)))
+def _(ipm, source):
+    starts = np.random.default_rng(0).uniform(-9, -5, (1000, 2))
+    lightcurves.constant_source_tracks(ipm, source, starts, np.ones((1000, 2)), np.linspace(0, 10, 1000),
+                                       cache=ConvolvedMapCache(max_bytes=0))
+
+@case('lightcurves.changing_source', lambda scale, tmpdir: (magnification_map(NUM_PIXELS[scale]), Gaussians(20, 1, 2)))
+def _(ipm, source):
+    lightcurves.changing_source(ipm, source, 10000)
+
+@case('lightcurves.constant_sources', lambda scale, tmpdir: (magnification_map(NUM_PIXELS[scale]), Gaussians(20, 1, 4)))
+def _(ipm, source):
+    lightcurves.constant_sources(ipm, source, 10000)
+
+@case('ncc_curves.constant_source', lambda scale, tmpdir: (ncc_map(NUM_PIXELS[scale]), UniformDisk(10)))
+def _(ncc, source):
+    ncc_curves.constant_source(ncc, source, 10000)
+
+@case('distances.expanding_source', lambda scale, tmpdir: (ncc_map(NUM_PIXELS[scale]),))
+def _(ncc):
+    distances.expanding_source(ncc)
+
+@case('distances.moving_source', lambda scale, tmpdir: (ncc_map(NUM_PIXELS[scale]),))
+def _(ncc):
+    distances.moving_source(ncc, [0, 30, 90])
+
+@case('stitching.closed_curves', lambda scale, tmpdir: (caustic_branches(NUM_STARS[scale]),))
+def _(x):
+    stitching.closed_curves(x)
+
+@case('mif.accumulate_lines', lambda scale, tmpdir: mif_lines(NUM_STARS[scale]))
+def _(x, y, lengths, bins):
+    accumulate_lines(x, y, lengths, bins)
+
+def _stars(scale, tmpdir):
+    rng = np.random.default_rng(0)
+    stars = rng.uniform(-100, 100, (NUM_STARS[scale], 3))
+    return stars, os.path.join(tmpdir, 'stars.bin')
+
+@case('util.write_stars', _stars)
+def _(stars, fname):
+    util.write_stars(fname, stars, True, (100, 100), 1)
+
+def _star_file(scale, tmpdir):
+    stars, fname = _stars(scale, tmpdir)
+    util.write_stars(fname, stars, True, (100, 100), 1)
+    return (fname,)
+
+@case('util.read_stars', _star_file)
+def _(fname):
+    util.read_stars(fname)
+
+def _array(scale, tmpdir):
+    fname = os.path.join(tmpdir, 'map.bin')
+    util.write_array(fname, magnification_map(NUM_PIXELS[scale]).magnifications)
+    return (fname,)
+
+@case('util.read_array', _array)
+def _(fname):
+    util.read_array(fname, np.float32)
+
+@case('util.write_array', lambda scale, tmpdir: (os.path.join(tmpdir, 'map.bin'),
+                                                 magnification_map(NUM_PIXELS[scale]).magnifications))
+def _(fname, values):
+    util.write_array(fname, values)
+
+def _ragged(scale, tmpdir):
+    fname = os.path.join(tmpdir, 'lines.bin')
+    write_ragged(fname, NUM_STARS[scale] // 10)
+    return (fname,)
+
+@case('util.read_ragged_array', _ragged)
+def _(fname):
+    util.read_ragged_array(fname, np.float64, is_complex=True)
+
+@case('ragged_array.flat', _ragged)
+def _(fname):
+    RaggedArray(fname, np.float64, is_complex=True, cache_index=False).flat()
+
+
+def measure(func, args, repeat: int):
+    '''
+    :return times: list of the times of repeat runs
+    :return peak_memory: peak memory in bytes allocated during a separate run
+                         traced by tracemalloc, which includes NumPy arrays
+    '''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return times, peak_memory
+
+def machine_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run_suite(scales, name_filter: str = None, repeat: int = 3):
+    results = []
+    for scale in scales:
+        for bench in CASES:
+            if name_filter is not None and name_filter not in bench.name:
+                continue
+            with tempfile.TemporaryDirectory() as tmpdir:
+                args = bench.setup(scale, tmpdir)
+                times, peak_memory = measure(bench.run, args, repeat)
+            result = {'name': bench.name, 'scale': scale,
+                      'time_min': min(times), 'time_median': float(np.median(times)),
+                      'repeat': repeat, 'peak_memory': peak_memory}
+            results.append(result)
+            print(f"{bench.name:<40} {scale:<8} {result['time_min']:>10.4f} s {peak_memory / 2**20:>10.1f} MiB",
+                  flush=True)
+    return results
+
+def compare(base: dict, new: dict, threshold: float):
+    '''
+    print the ratio of new to base time and memory of every case in both
+    reports
+
+    :return num_regressions: number of cases whose time or memory increased
+                             by more than the threshold
+    '''
+    base_results = {(r['name'], r['scale']): r for r in base['results']}
+    num_regressions = 0
+    print(f"{'case':<40} {'scale':<8} {'time':>8} {'memory':>8}")
+    for r in new['results']:
+        key = (r['name'], r['scale'])
+        if key not in base_results:
+            continue
+        b = base_results[key]
+        time_ratio = r['time_min'] / b['time_min'] if b['time_min'] > 0 else np.inf
+        memory_ratio = r['peak_memory'] / b['peak_memory'] if b['peak_memory'] > 0 else np.inf
+        regression = time_ratio > threshold or memory_ratio > threshold
+        num_regressions += regression
+        print(f"{r['name']:<40} {r['scale']:<8} {time_ratio:>8.2f} {memory_ratio:>8.2f}"
+              f"{'  regression' if regression else ''}")
+    return num_regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs='+', choices=SCALES, default=['small'])
+    parser.add_argument('--filter', default=None, help='only run cases whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='json file to write the report to')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), default=None,
+                        help='compare two reports instead of running the suite')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='ratio of new to base time or memory counted as a regression')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        reports = []
+        for fname in args.compare:
+            with open(fname) as f:
+                reports.append(json.load(f))
+        sys.exit(1 if compare(*reports, args.threshold) > 0 else 0)
+
+    report = {'machine': machine_info(),
+              'results': run_suite(args.scales, args.filter, args.repeat)}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
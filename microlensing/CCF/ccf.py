@@ -1,9 +1,14 @@
-from . import lib_ccf
+from microlensing.CCF import stitching
 from microlensing.Stars.stars import Stars
-from . import plotting
+from microlensing.Util.library_object import LibraryObject, library_state, restore_library_state
+from microlensing.Util.timings import peak_memory, profiled, stage
 
 import numpy as np
-from matplotlib.axes import Axes
+from typing import TYPE_CHECKING
+
+# matplotlib is only imported once something is plotted
+if TYPE_CHECKING:
+    from matplotlib.axes import Axes
 
 
 class CCF(object):
@@ -12,7 +17,8 @@ class CCF(object):
                  rectangular: bool = None, approx: bool = None, safety_scale: float = None,
                  num_stars: int = None, starfile: str = None, num_phi: int = None, num_branches: int = None, random_seed: int = None,
                  write_stars: bool = False, write_critical_curves: bool = False, write_caustics: bool = False, write_length_scales: bool = False,
-                 outfile_prefix: str = None, verbose: int = 0):
+                 outfile_prefix: str = None, verbose: int = 0, backend: str = 'gpu',
+                 num_processes: int = None, zero_copy: bool = False):
         '''
         :param kappa_tot: total convergence
         :param shear: shear
@@ -39,11 +45,23 @@ class CCF(object):
         :param write_length_scales: whether to write magnification length scales or not
         :param outfile_prefix: prefix to be used in output file names
         :param verbose: verbosity level of messages. must be 0, 1, 2, or 3
+        :param backend: library to run on. Options are: gpu (the CUDA library) and cpu (a NumPy implementation
+                        that needs no GPU, and finds the branches in parallel processes)
+        :param num_processes: number of processes for the cpu backend to find branches with. default is the number of CPUs
+        :param zero_copy: whether results should be read-only views of the library's memory instead of copies of it
         '''
-        self.lib = lib_ccf.lib
+        self.lib = self._library(backend)
+        self.backend = backend
 
-        self.obj = self.lib.CCF_init()
+        # the library object is kept alive by any views of its memory
+        self._handle = LibraryObject(self.lib, 'CCF')
+        self.obj = self._handle.obj
         self.verbose = verbose
+        self.zero_copy = zero_copy
+
+        # time in seconds of each stage of the last run and save
+        self._timings = {}
+        self._stitch_order = None
 
         self.kappa_tot = kappa_tot
         self.shear = shear
@@ -82,9 +100,27 @@ class CCF(object):
         
         self.outfile_prefix = outfile_prefix
 
-    def __del__(self):
-        self.lib.CCF_delete(self.obj)
-        
+        self.num_processes = num_processes
+
+    @staticmethod
+    def _library(backend: str):
+        '''
+        load the library of a backend on first use
+        '''
+        if backend == 'gpu':
+            from . import lib_ccf
+            return lib_ccf.lib
+        elif backend == 'cpu':
+            from . import lib_ccf_cpu
+            return lib_ccf_cpu.lib
+        raise ValueError("backend must be gpu or cpu")
+
+    def __getstate__(self):
+        return library_state(self)
+
+    def __setstate__(self, state):
+        restore_library_state(self, state, self._library(state['backend']), 'CCF')
+
     @property
     def kappa_tot(self):
         return self.lib.get_kappa_tot(self.obj)
@@ -318,6 +354,21 @@ class CCF(object):
         if value is not None:
             self.lib.set_outfile_prefix(self.obj, value.encode('utf-8'))
 
+    @property
+    def num_processes(self):
+        if self.backend != 'cpu':
+            return None
+        return self.lib.get_num_processes(self.obj)
+    
+    @num_processes.setter
+    def num_processes(self, value):
+        if value is not None:
+            if self.backend != 'cpu':
+                raise ValueError("num_processes is only used by the cpu backend")
+            if value < 1:
+                raise ValueError("num_processes must be >= 1")
+            self.lib.set_num_processes(self.obj, value)
+
     @property
     def corner(self):
         return (self.lib.get_corner_x1(self.obj), self.lib.get_corner_x2(self.obj))
@@ -326,38 +377,68 @@ class CCF(object):
     def num_roots(self):
         return self.lib.get_num_roots(self.obj)
 
+    @profiled
     def run(self):
-        if not self.lib.run(self.obj, self.verbose):
-            raise Exception("Error running CCF")
-        
-        self.critical_curves = np.ctypeslib.as_array(self.lib.get_critical_curves(self.obj), 
-                                                     shape=(self.num_roots * self.num_branches,
-                                                            self.num_phi // self.num_branches + 1,
-                                                            2)).copy()
-        
-        self.caustics = np.ctypeslib.as_array(self.lib.get_caustics(self.obj), 
-                                              shape=(self.num_roots * self.num_branches,
-                                                     self.num_phi // self.num_branches + 1,
-                                                     2)).copy()
-            
-        if self.write_mu_length_scales:
-            self.mu_length_scales = np.ctypeslib.as_array(self.lib.get_mu_length_scales(self.obj), 
-                                                          shape=(self.num_roots * self.num_branches,
-                                                                 self.num_phi // self.num_branches + 1)).copy()
-        else:
+        if self.zero_copy:
+            # results of a previous run are views of memory the library is
+            # about to overwrite
+            self.critical_curves = None
+            self.caustics = None
             self.mu_length_scales = None
-
-        self.stars = Stars(np.ctypeslib.as_array(self.lib.get_stars(self.obj),
-                                                 shape=(self.num_stars, 3)).copy(),
-                           self.rectangular, self.corner, self.theta_star)
+            self.stars = None
+            if self._handle.in_use():
+                raise Exception("Results of a previous CCF run are still referenced. "
+                                "Copy or delete them before running again")
+
+        self._timings = {}
+        with stage(self._timings, 'run'):
+            if not self.lib.run(self.obj, self.verbose):
+                raise Exception("Error running CCF")
+
+        with stage(self._timings, 'copy_out'):
+            self.critical_curves = self._handle.array(self.lib.get_critical_curves(self.obj),
+                                                      shape=(self.num_roots * self.num_branches,
+                                                             self.num_phi // self.num_branches + 1,
+                                                             2), zero_copy=self.zero_copy)
+
+            self.caustics = self._handle.array(self.lib.get_caustics(self.obj),
+                                               shape=(self.num_roots * self.num_branches,
+                                                      self.num_phi // self.num_branches + 1,
+                                                      2), zero_copy=self.zero_copy)
+
+            if self.write_mu_length_scales:
+                self.mu_length_scales = self._handle.array(self.lib.get_mu_length_scales(self.obj),
+                                                           shape=(self.num_roots * self.num_branches,
+                                                                  self.num_phi // self.num_branches + 1), zero_copy=self.zero_copy)
+            else:
+                self.mu_length_scales = None
+
+            self.stars = Stars(self._handle.array(self.lib.get_stars(self.obj),
+                                                  shape=(self.num_stars, 3), zero_copy=self.zero_copy),
+                               self.rectangular, self.corner, self.theta_star)
+
+        # order in which critical curves join into loops, found when needed
+        self._stitch_order = None
         
     @property
     def t_ccs(self):
         return self.lib.get_t_ccs(self.obj)
+
+    @property
+    def timings(self):
+        '''
+        time in seconds of each stage of the last run and save, and the peak
+        memory of the process in bytes. the cpu backend also reports the
+        stages of the library (generate_stars, find_initial_roots, etc.)
+        '''
+        timings = dict(self.lib.get_timings(self.obj)) if self.backend == 'cpu' else {}
+        return {'find_critical_curves': self.t_ccs, **timings, **self._timings, 'peak_memory': peak_memory()}
     
+    @profiled
     def save(self):
-        if not self.lib.save(self.obj, self.verbose):
-            raise Exception("Error saving CCF")
+        with stage(self._timings, 'save'):
+            if not self.lib.save(self.obj, self.verbose):
+                raise Exception("Error saving CCF")
 
     @property
     def mu_length_scales_weights(self):
@@ -370,8 +451,34 @@ class CCF(object):
 
         return dists
 
-    def plot_critical_curves(self, ax: Axes, color='black', xrange=None, yrange=None,
+    def _closed_curves(self, curves):
+        if self._stitch_order is None:
+            self._stitch_order = stitching.stitch_order(self.critical_curves)
+        return stitching.closed_curves(curves, order=self._stitch_order)
+
+    @property
+    def closed_critical_curves(self):
+        '''
+        critical curves joined into loops
+
+        :return points: array of shape (num_loop_points, 2) of the points of all loops
+        :return offsets: loop i is points[offsets[i]:offsets[i+1]]
+        '''
+        return self._closed_curves(self.critical_curves)
+
+    @property
+    def closed_caustics(self):
+        '''
+        caustics joined into loops in the same way as their critical curves
+
+        :return points: array of shape (num_loop_points, 2) of the points of all loops
+        :return offsets: loop i is points[offsets[i]:offsets[i+1]]
+        '''
+        return self._closed_curves(self.caustics)
+
+    def plot_critical_curves(self, ax: 'Axes', color='black', xrange=None, yrange=None,
                              fill_parities=False, plot_phase=False, **kwargs):
+        from . import plotting
 
         if fill_parities:
             ax.add_collection(plotting.CriticalCurves(self.critical_curves, xrange, yrange))
@@ -392,7 +499,7 @@ class CCF(object):
             ax.set_xlabel('$x_1$')
             ax.set_ylabel('$x_2$')
 
-    def plot_caustics(self, ax: Axes, color='black', plot_phase=False, **kwargs):
+    def plot_caustics(self, ax: 'Axes', color='black', plot_phase=False, **kwargs):
 
         if plot_phase:
             line = ax.add_collection(PhaseCurves(self.caustics, self.num_roots, self.num_phi, self.num_branches, 
@@ -411,7 +518,7 @@ class CCF(object):
             ax.set_xlabel('$y_1$')
             ax.set_ylabel('$y_2$')
 
-    def plot_mu_length_scales_hist(self, ax: Axes, bins=None, dw=0.01, where=..., **kwargs):
+    def plot_mu_length_scales_hist(self, ax: 'Axes', bins=None, dw=0.01, where=..., **kwargs):
         dat = np.log10(self.mu_length_scales[where])
         weights = self.mu_length_scales_weights[where]
 
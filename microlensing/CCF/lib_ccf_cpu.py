@@ -0,0 +1,508 @@
+from microlensing.Deflection import deflection_angles
+from microlensing.Deflection.deflector import Deflector
+from microlensing.Util.microlensing_cpu import Microlensing, Library, available_cpus, print_verbose, print_error
+from microlensing.Util.timings import stage
+from microlensing.Stars.star_field import star_field_corner
+from microlensing.Util.util import write_array
+
+import multiprocessing
+import numpy as np
+import time
+
+
+'''
+critical curves are found as in the CUDA code. for a value of phi, the critical
+curve equation
+
+    f(z) = (dw/dz_bar)_bar - dw/dz * e^(-i * phi) = 0
+
+has num_roots roots, which are found at once with the Aberth-Ehrlich method.
+phi in [0, 2 * pi] is split into num_branches branches, whose roots are first
+found at the center of the branch and then followed outwards in steps of
+2 * pi / num_phi on both sides, starting each step from the roots of the last.
+branches are independent of each other, and are distributed over processes.
+all the roots of a step are updated simultaneously, with the deflection angle
+derivatives of the stars from the local expansions of the tree
+'''
+
+
+class CriticalCurveEquation():
+    '''
+    critical curve equation of a star field, and the Aberth-Ehrlich update of
+    its roots
+    '''
+
+    # number of (root, root) pairs summed at once, few enough to stay in cache
+    MAX_PAIRS = 2**16
+
+    # 1/mu and step size in units of theta_star below which roots are found
+    TOLERANCE = 1e-9
+
+    def __init__(self, deflector: Deflector, poles: Deflector, pole_scale: float):
+        '''
+        :param deflector: deflector of the star field
+        :param poles: deflector whose alpha_star, times pole_scale, is the sum
+                      over the stars of 1 / (z - z_i)_bar
+        :param pole_scale: see poles
+        '''
+        self.deflector = deflector
+        self.poles = poles
+        self.pole_scale = pole_scale
+
+    def derivatives(self, z):
+        '''
+        :param z: complex image plane positions
+        :return d_w_d_z: real derivative of the lens equation with respect to z
+        :return d_w_d_zbar: derivative with respect to z_bar
+        :return d2_w_d_zbar2: second derivative with respect to z_bar
+        '''
+        d = self.deflector
+        d_alpha_star_d_zbar, d2_alpha_star_d_zbar2 = d.alpha_star_derivatives(z)
+        d_w_d_z = 1 - d.kappa - deflection_angles.d_alpha_smooth_d_z(z, d.kappastar, d.rectangular, d.corner, d.approx)
+        d_w_d_zbar = (d.gamma - d_alpha_star_d_zbar
+                      - deflection_angles.d_alpha_smooth_d_zbar(z, d.kappastar, d.rectangular, d.corner,
+                                                                d.approx, d.taylor_smooth))
+        d2_w_d_zbar2 = (-d2_alpha_star_d_zbar2
+                        - deflection_angles.d2_alpha_smooth_d_zbar2(z, d.kappastar, d.rectangular, d.corner,
+                                                                    d.approx, d.taylor_smooth))
+        return d_w_d_z, d_w_d_zbar, d2_w_d_zbar2
+
+    def errors(self, z, phi):
+        '''
+        :param z: complex image plane positions
+        :param phi: value of phi for each position
+        :return errors: maximum possible error in 1/mu at each position
+        '''
+        d_w_d_z, d_w_d_zbar, _ = self.derivatives(z)
+        f0 = np.abs(np.conj(d_w_d_zbar) - d_w_d_z * np.exp(-1j * phi))
+        return np.maximum(np.abs(f0 * (f0 + 2 * d_w_d_z)), np.abs(f0 * (f0 - 2 * d_w_d_z)))
+
+    def mu_length_scales(self, z):
+        '''
+        :param z: complex image plane positions on the critical curves
+        :return d_0: magnification length scale in the approximation
+                     mu = sqrt(d_0 / d) for the magnification of a microimage
+                     some distance d perpendicular to a caustic
+        '''
+        d_w_d_z, d_w_d_zbar, d2_w_d_zbar2 = self.derivatives(z)
+        critical_curve_tangent = -2j * np.conj(d_w_d_zbar) * d2_w_d_zbar2
+        caustic_tangent = d_w_d_z * critical_curve_tangent + d_w_d_zbar * np.conj(critical_curve_tangent)
+        with np.errstate(divide='ignore'):
+            return 1 / (2 * np.abs(caustic_tangent))
+
+    def pole_sum(self, z):
+        '''
+        sum over the poles of the equation, which are double poles at the
+        stars (and at the origin for exact circular star fields)
+        '''
+        d = self.deflector
+        result = self.pole_scale * np.conj(self.poles.alpha_star(z))
+        if not d.rectangular and not d.approx:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result += 1 / z
+        return 2 * result
+
+    def root_sum(self, z, roots, rows, cols):
+        '''
+        sum of 1 / (z - z_j) over the other roots of the same set
+
+        :param z: roots to calculate the sum for
+        :param roots: array of shape (num_sets, num_roots) of all the roots
+        :param rows: set of each root in z
+        :param cols: index of each root in z within its set
+        '''
+        result = np.empty(z.shape, dtype=np.complex128)
+        step = max(1, self.MAX_PAIRS // roots.shape[1])
+        # 1 / dz = dz_bar / |dz|^2 in real arithmetic, which is faster than
+        # complex division
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for row in np.unique(rows):
+                where = np.flatnonzero(rows == row)
+                x = roots[row].real
+                y = roots[row].imag
+                for i in range(0, where.size, step):
+                    idx = where[i: i + step]
+                    dx = z.real[idx, None] - x
+                    dy = z.imag[idx, None] - y
+                    inv_norm = dx * dx
+                    inv_norm += dy * dy
+                    np.reciprocal(inv_norm, out=inv_norm)
+                    inv_norm[np.arange(idx.size), cols[idx]] = 0
+                    result[idx] = np.einsum('ij,ij->i', dx, inv_norm) - 1j * np.einsum('ij,ij->i', dy, inv_norm)
+        return result
+
+    def step(self, roots, phi, active):
+        '''
+        one Aberth-Ehrlich update of all the roots which are not yet found
+
+        :param roots: array of shape (num_sets, num_roots) of the roots of each
+                      set, updated in place
+        :param phi: array of shape (num_sets,) of the value of phi of each set
+        :param active: boolean array of the roots not yet found, updated in place
+        '''
+        rows, cols = np.nonzero(active)
+        z = roots[rows, cols]
+
+        d_w_d_z, d_w_d_zbar, d2_w_d_zbar2 = self.derivatives(z)
+        f0 = np.conj(d_w_d_zbar) - d_w_d_z * np.exp(-1j * phi[rows])
+        f1 = np.conj(d2_w_d_zbar2)
+
+        # roots where 1/mu is already below the tolerance stay where they are
+        a = np.abs(f0)
+        found = ((np.abs(a * (a + 2 * d_w_d_z)) < self.TOLERANCE)
+                 & (np.abs(a * (a - 2 * d_w_d_z)) < self.TOLERANCE))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_new = z - f0 / (f1 + f0 * (self.pole_sum(z) - self.root_sum(z, roots, rows, cols)))
+        z_new = np.where(found, z, z_new)
+        found |= np.abs(z_new - z) / self.deflector.theta < self.TOLERANCE
+
+        roots[rows, cols] = z_new
+        active[rows[found], cols[found]] = False
+
+    def solve(self, roots, phi, num_iters: int):
+        '''
+        :param roots: array of shape (num_sets, num_roots) of the initial roots
+                      of each set, updated in place
+        :param phi: array of shape (num_sets,) of the value of phi of each set
+        :param num_iters: maximum number of iterations
+        '''
+        active = np.ones(roots.shape, dtype=bool)
+        for i in range(num_iters):
+            if not np.any(active):
+                break
+            self.step(roots, phi, active)
+
+
+def branch_phi(c: int, num_phi: int, num_branches: int):
+    '''
+    :return phi: values of phi of branch c, of shape (num_phi // num_branches + 1,)
+    '''
+    phi0 = np.pi / num_branches + c * 2 * np.pi / num_branches
+    half = num_phi // (2 * num_branches)
+    return phi0 + 2 * np.pi / num_phi * np.arange(-half, half + 1)
+
+def find_initial_roots(equation: CriticalCurveEquation, c: int, initial_roots, num_phi: int, num_branches: int):
+    '''
+    :return roots: roots at the center of branch c
+    :return errors: maximum possible errors in 1/mu of the roots
+    '''
+    phi = branch_phi(c, num_phi, num_branches)
+    phi0 = phi[phi.size // 2: phi.size // 2 + 1]
+
+    roots = initial_roots.copy()[None, :]
+    # empirically, 30 iterations are roughly what is needed
+    equation.solve(roots, phi0, 30)
+    return roots[0], equation.errors(roots[0], phi0[0])
+
+def find_branch(equation: CriticalCurveEquation, c: int, center_roots, num_phi: int, num_branches: int):
+    '''
+    follow the roots at the center of branch c out to both of its ends
+
+    :return roots: array of shape (num_phi // num_branches + 1, num_roots) of
+                   the roots for each value of phi of the branch
+    :return errors: maximum possible errors in 1/mu of the roots
+    '''
+    phi = branch_phi(c, num_phi, num_branches)
+    half = phi.size // 2
+
+    roots = np.empty((phi.size, center_roots.size), dtype=np.complex128)
+    roots[half] = center_roots
+    for j in range(1, half + 1):
+        # both sides of the center at once, starting from the last roots.
+        # fewer iterations are needed, as roots stay close to their last
+        # positions
+        step_roots = roots[[half - j + 1, half + j - 1]].copy()
+        equation.solve(step_roots, phi[[half - j, half + j]], 20)
+        roots[half - j] = step_roots[0]
+        roots[half + j] = step_roots[1]
+
+    return roots, equation.errors(roots, phi[:, None])
+
+
+_equation = None
+
+def _init_worker(equation):
+    global _equation
+    _equation = equation
+
+def _find_initial_roots(task):
+    return find_initial_roots(_equation, *task)
+
+def _find_branch(task):
+    return find_branch(_equation, *task)
+
+
+class CCF(Microlensing):
+    '''
+    CPU implementation of the critical curve finder of the CUDA library
+    '''
+
+    def __init__(self, dtype=np.float64):
+        super().__init__(dtype)
+
+        self.num_stars = 137
+        self.num_phi = 100
+        self.num_branches = 1
+        self.write_critical_curves = 1
+        self.write_caustics = 1
+        self.write_mu_length_scales = 0
+
+        self.num_processes = None
+
+        self.num_roots = 0
+        self.max_error = 0
+        self.t_init_roots = 0
+        self.t_ccs = 0
+        self.t_caustics = 0
+
+        self.equation = None
+        self.ccs = None
+        self.caustics = None
+        self.mu_length_scales = None
+
+    def get_corner_x1(self):
+        return self.corner.real if self.rectangular else abs(self.corner)
+
+    def get_corner_x2(self):
+        return self.corner.imag if self.rectangular else 0
+
+    def get_stars(self):
+        return self.stars
+
+    def get_critical_curves(self):
+        return self.ccs.view(np.float64).reshape(*self.ccs.shape, 2)
+
+    def get_caustics(self):
+        return self.caustics.view(np.float64).reshape(*self.caustics.shape, 2)
+
+    def check_input_params(self, verbose: int):
+        print_verbose("Checking CCF input parameters...", verbose, 3)
+
+        if not super().check_input_params(verbose):
+            return False
+
+        if self.num_stars < 1:
+            print_error("Error. num_stars must be an integer > 0")
+            return False
+
+        if self.num_phi < 1 or self.num_phi % 2 != 0:
+            print_error("Error. num_phi must be an even integer > 0")
+            return False
+
+        if self.num_branches < 1:
+            print_error("Error. num_branches must be an integer > 0")
+            return False
+
+        if self.num_phi % (2 * self.num_branches) != 0:
+            print_error("Error. num_phi must be a multiple of 2 * num_branches")
+            return False
+
+        for name in ['write_critical_curves', 'write_caustics', 'write_mu_length_scales']:
+            if getattr(self, name) not in [0, 1]:
+                print_error(f"Error. {name} must be 1 (true) or 0 (false).")
+                return False
+
+        if self.num_processes is not None and self.num_processes < 1:
+            print_error("Error. num_processes must be an integer > 0")
+            return False
+
+        print_verbose("Done checking CCF input parameters.", verbose, 3)
+        return True
+
+    def calculate_derived_params(self, verbose: int):
+        print_verbose("Calculating CCF derived parameters...", verbose, 3)
+
+        if not super().calculate_derived_params(verbose):
+            return False
+
+        # if stars are not drawn from external file, calculate corner of the star field
+        if self.starfile == '':
+            shape = complex(1 / abs(1 - self.kappa_tot + self.shear), 1 / abs(1 - self.kappa_tot - self.shear))
+            self.corner = star_field_corner(shape, self.num_stars, self.mean_mass, self.kappa_star,
+                                            self.theta_star, self.rectangular)
+            print_verbose(f"corner set to {self.corner}", verbose, 2)
+
+        # error is 10^-7 einstein radii
+        self.alpha_error = self.theta_star * 1e-7
+
+        if not self.calculate_taylor_smooth():
+            return False
+        print_verbose(f"taylor_smooth set to {self.taylor_smooth}", verbose, 2)
+
+        # number of roots to be found
+        if self.rectangular:
+            self.num_roots = 2 * self.num_stars + (self.taylor_smooth - 1 if self.approx else 0)
+        else:
+            self.num_roots = 2 * self.num_stars + (0 if self.approx else 2)
+        print_verbose(f"num_roots set to {self.num_roots}", verbose, 2)
+
+        print_verbose("Done calculating CCF derived parameters.", verbose, 3)
+        return True
+
+    def create_equation(self):
+        '''
+        critical curve equation of the star field. the sum over its poles uses
+        the tree of the stars when they all have the same mass, and a tree of
+        unit mass stars otherwise
+        '''
+        masses = self.stars[:, 2].astype(np.float64)
+        if np.all(masses == masses[0]):
+            poles = self.deflector
+            pole_scale = 1 / (self.theta_star**2 * masses[0])
+        else:
+            unit_stars = np.array(self.stars, dtype=np.float64)
+            unit_stars[:, 2] = 1
+            poles = Deflector(unit_stars, 1, root_half_length=self.root_half_length,
+                              expansion_order=self.expansion_order)
+            pole_scale = 1
+        self.equation = CriticalCurveEquation(self.deflector, poles, pole_scale)
+        return True
+
+    def _pool(self):
+        '''
+        pool of worker processes holding the critical curve equation, or None
+        if branches are found in this process
+        '''
+        num_processes = min(self.num_processes or available_cpus(), self.num_branches)
+        if num_processes == 1:
+            return None
+        return multiprocessing.Pool(num_processes, initializer=_init_worker, initargs=(self.equation,))
+
+    def _map(self, pool, func, worker_func, tasks):
+        if pool is None:
+            return [func(self.equation, *task) for task in tasks]
+        return pool.map(worker_func, tasks)
+
+    def check_errors(self, errors, verbose: int):
+        errors = np.concatenate([np.ravel(e) for e in errors])
+        if not np.all(np.isfinite(errors)):
+            print_error("Error. Errors in 1/mu contain values which are not positive real numbers.")
+            return False
+        self.max_error = np.max(errors)
+        print_verbose(f"Maximum error in 1/mu: {self.max_error}", verbose, 1)
+        return True
+
+    def find_ccs(self, verbose: int):
+        # initial roots at star positions +/- 1, and any extra roots evenly
+        # spaced on a circle of radius |corner|
+        positions = self.stars[:, 0].astype(np.float64) + 1j * self.stars[:, 1].astype(np.float64)
+        num_extra = self.num_roots - 2 * self.num_stars
+        initial_roots = np.concatenate([positions + 1, positions - 1,
+                                        abs(self.corner) * np.exp(2j * np.pi / max(num_extra, 1) * np.arange(num_extra))])
+
+        pool = self._pool()
+        try:
+            print_verbose("Finding initial roots...", verbose, 1)
+            t0 = time.perf_counter()
+            tasks = [(c, initial_roots, self.num_phi, self.num_branches) for c in range(self.num_branches)]
+            results = self._map(pool, find_initial_roots, _find_initial_roots, tasks)
+            self.t_init_roots = time.perf_counter() - t0
+            self.timings['find_initial_roots'] = self.t_init_roots
+            print_verbose(f"Done finding initial roots. Elapsed time: {self.t_init_roots} seconds.", verbose, 1)
+
+            if not self.check_errors([errors for _, errors in results], verbose):
+                return False
+
+            print_verbose("Finding critical curve positions...", verbose, 1)
+            t0 = time.perf_counter()
+            tasks = [(c, roots, self.num_phi, self.num_branches) for c, (roots, _) in enumerate(results)]
+            results = self._map(pool, find_branch, _find_branch, tasks)
+            self.t_ccs = time.perf_counter() - t0
+            self.timings['find_ccs'] = self.t_ccs
+            print_verbose(f"Done finding critical curve positions. Elapsed time: {self.t_ccs} seconds.", verbose, 1)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if not self.check_errors([errors for _, errors in results], verbose):
+            return False
+
+        # rows are (root, branch) pairs, as in the transposed array of the
+        # CUDA code
+        ccs = np.stack([roots for roots, _ in results])
+        self.ccs = ccs.transpose(2, 0, 1).reshape(self.num_roots * self.num_branches, -1).copy()
+        return True
+
+    def find_caustics(self, verbose: int):
+        print_verbose("Finding caustic positions...", verbose, 2)
+        t0 = time.perf_counter()
+        self.caustics = self.deflector.w(self.ccs)
+        self.t_caustics = time.perf_counter() - t0
+        self.timings['find_caustics'] = self.t_caustics
+        print_verbose(f"Done finding caustic positions. Elapsed time: {self.t_caustics} seconds.", verbose, 2)
+        return True
+
+    def find_mu_length_scales(self, verbose: int):
+        if self.write_mu_length_scales:
+            print_verbose("Finding magnification length scales...", verbose, 2)
+            with stage(self.timings, 'find_mu_length_scales'):
+                self.mu_length_scales = self.equation.mu_length_scales(self.ccs)
+            print_verbose("Done finding magnification length scales.", verbose, 2)
+        else:
+            self.mu_length_scales = None
+        return True
+
+    def write_files(self, verbose: int):
+        if not super().write_files(verbose, 'ccf'):
+            return False
+
+        print_verbose("Writing CCF parameter info...", verbose, 2)
+        fname = f"{self.outfile_prefix}ccf_parameter_info.txt"
+        with open(fname, 'a') as f:
+            f.write(f"num_roots {self.num_roots}\n")
+            f.write(f"num_phi {self.num_phi}\n")
+            f.write(f"num_branches {self.num_branches}\n")
+            f.write(f"max_error_1/mu {self.max_error:.9g}\n")
+            f.write(f"t_init_roots {self.t_init_roots:.9g}\n")
+            f.write(f"t_ccs {self.t_ccs:.9g}\n")
+            f.write(f"t_caustics {self.t_caustics:.9g}\n")
+        print_verbose(f"Done writing CCF parameter info to file {fname}", verbose, 1)
+
+        if self.write_critical_curves:
+            print_verbose("Writing critical curve positions...", verbose, 2)
+            fname = f"{self.outfile_prefix}ccf_ccs.bin"
+            write_array(fname, self.ccs, self.dtype)
+            print_verbose(f"Done writing critical curve positions to file {fname}", verbose, 1)
+
+        if self.write_caustics:
+            print_verbose("Writing caustic positions...", verbose, 2)
+            fname = f"{self.outfile_prefix}ccf_caustics.bin"
+            write_array(fname, self.caustics, self.dtype)
+            print_verbose(f"Done writing caustic positions to file {fname}", verbose, 1)
+
+        if self.write_mu_length_scales:
+            print_verbose("Writing magnification length scales...", verbose, 2)
+            fname = f"{self.outfile_prefix}ccf_mu_length_scales.bin"
+            write_array(fname, self.mu_length_scales, self.dtype)
+            print_verbose(f"Done writing magnification length scales to file {fname}", verbose, 1)
+
+        return True
+
+    def run(self, verbose: int):
+        self.timings = {}
+        if not self.check_input_params(verbose):
+            return False
+        if not self.calculate_derived_params(verbose):
+            return False
+        if not self.populate_star_array(verbose):
+            return False
+        if not self.create_tree(verbose):
+            return False
+        if not self.create_equation():
+            return False
+        if not self.find_ccs(verbose):
+            return False
+        if not self.find_caustics(verbose):
+            return False
+        if not self.find_mu_length_scales(verbose):
+            return False
+        return True
+
+    def save(self, verbose: int):
+        with stage(self.timings, 'write_files'):
+            return self.write_files(verbose)
+
+
+lib = Library(CCF, np.float64)
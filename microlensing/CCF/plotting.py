@@ -2,6 +2,7 @@ import numpy as np
 from matplotlib.patches import Polygon
 from matplotlib.collections import LineCollection, PatchCollection
 from matplotlib.colors import Normalize
+from microlensing.CCF.stitching import next_curves, closed_curves
 
 
 colors = {-1: '#ff7700',  # saddlepoints are orange
@@ -10,20 +11,8 @@ colors = {-1: '#ff7700',  # saddlepoints are orange
 
 # function to determine the order in which to join critical curves
 def list_order(x):
-    starts = np.round(x[:,0], 5) # round the first point on the curve to 5 decimal places
-    starts = starts[:,0] + 1j * starts[:,1] # convert to complex numbers
-
-    ends = np.round(x[:,-1], 5) # round final points to 5 decimal places
-    ends = ends[:,0] + 1j * ends[:,1] # and convert to complex numbers
-
-    indices = range(0, len(starts)) # the size of the critical curve array (num_roots, basically)
-    # in order, the index of the curve that starts where curve[i] ends
-    where = [np.argwhere(starts == ends[i])[0,0] for i in indices]
-
-    res = {}
-    for a, b in zip(indices, where):
-        res[a] = b # dictionary mapping end -> start
-    return res
+    # dictionary mapping end -> start
+    return {a: b for a, b in enumerate(next_curves(x).tolist()) if b >= 0}
 
 # calculate the area of a polygon defined by a list of points
 # the shoelace formula adds x_i * y_i+1 - x_i+1 * y_i to the area
@@ -35,17 +24,8 @@ class CriticalCurves(PatchCollection):
 
     def __init__(self, critical_curves, xrange=None, yrange=None, **kwargs):
 
-        polygons = []
-        order = list_order(critical_curves)
-
-        while len(order.keys()) > 0:
-            polygons.append(np.empty(shape=(0,2)))
-            key = next(iter(order.keys())) # get the next unused key
-            while key in order.keys(): # and while it is in the list of keys
-                # append the chain whose start is the end of the previous one
-                polygons[-1] = np.append(polygons[-1], critical_curves[key], axis=0)
-                # and now use that chain's end as the next key
-                key = order.pop(key)
+        points, offsets = closed_curves(critical_curves)
+        polygons = np.split(points, offsets[1:-1])
 
         if xrange is not None:
             polygons = [p for p in polygons 
@@ -0,0 +1,107 @@
+import numpy as np
+from microlensing.Util.timings import profiled
+
+
+'''
+join the branches of critical curves and caustics into loops. kept apart from
+plotting so that analysis of the loops does not import matplotlib
+'''
+
+
+def _rounded_endpoints(x, decimals: int = 5):
+    '''
+    first and final points of each curve, rounded and converted to complex
+    numbers so that they can be compared and sorted
+    '''
+    starts = np.round(x[:,0], decimals)
+    ends = np.round(x[:,-1], decimals)
+    return starts[:,0] + 1j * starts[:,1], ends[:,0] + 1j * ends[:,1]
+
+def next_curves(x, decimals: int = 5):
+    '''
+    for each curve, the index of the curve that starts where it ends. starts
+    are sorted once and ends are looked up with a binary search, rather than
+    comparing every end with every start
+
+    :param x: array of curves of shape (num_curves, num_points, 2)
+    :param decimals: number of decimal places endpoints are rounded to
+    :return next: index of the following curve, or -1 if there is none
+    '''
+    starts, ends = _rounded_endpoints(x, decimals)
+
+    # complex numbers sort by real and then imaginary part
+    order = np.argsort(starts, kind='stable')
+    sorted_starts = starts[order]
+    idx = np.minimum(np.searchsorted(sorted_starts, ends), len(starts) - 1)
+
+    return np.where(sorted_starts[idx] == ends, order[idx], -1)
+
+@profiled
+def stitch_order(x, decimals: int = 5):
+    '''
+    order in which to join curves into loops
+
+    :param x: array of curves of shape (num_curves, num_points, 2)
+    :param decimals: number of decimal places endpoints are rounded to
+    :return order: indices of the curves, loop by loop
+    :return loop_offsets: loop i consists of curves order[loop_offsets[i]:loop_offsets[i+1]]
+    :return closed: whether each loop ends where it starts
+    '''
+    following = next_curves(x, decimals).tolist()
+    num_curves = len(following)
+
+    # walk chains that something else does not lead into first, so that open
+    # chains are not split
+    has_previous = np.zeros(num_curves, dtype=bool)
+    has_previous[[b for b in following if b >= 0]] = True
+    heads = np.flatnonzero(~has_previous).tolist() + list(range(num_curves))
+
+    visited = [False] * num_curves
+    order = []
+    loop_offsets = [0]
+    closed = []
+    for head in heads:
+        if visited[head]:
+            continue
+        i = head
+        while i >= 0 and not visited[i]:
+            visited[i] = True
+            order.append(i)
+            i = following[i]
+        loop_offsets.append(len(order))
+        closed.append(i == head)
+
+    return np.array(order, dtype=int), np.array(loop_offsets, dtype=int), np.array(closed, dtype=bool)
+
+@profiled
+def closed_curves(x, decimals: int = 5, order=None):
+    '''
+    join curves whose ends meet into loops, as a ragged array. the final
+    point of each curve is the first point of the next one, so it is dropped
+    except at the end of open loops
+
+    :param x: array of curves of shape (num_curves, num_points, 2)
+    :param decimals: number of decimal places endpoints are rounded to
+    :param order: result of stitch_order, if already known. this allows e.g.
+                  caustics to be joined in the same way as their critical curves
+    :return points: array of shape (num_loop_points, 2) of the points of all loops
+    :return offsets: loop i is points[offsets[i]:offsets[i+1]]
+    '''
+    if order is None:
+        order = stitch_order(x, decimals)
+    order, loop_offsets, closed = order
+
+    num_points = x.shape[1]
+    num_curves = np.diff(loop_offsets)
+
+    # points taken from each curve, in loop order
+    counts = np.full(order.size, num_points - 1)
+    open_ends = loop_offsets[1:][~closed] - 1
+    counts[open_ends] += 1
+
+    starts = np.repeat(order * num_points, counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    points = x.reshape(-1, x.shape[-1])[starts + within]
+
+    offsets = np.concatenate(([0], np.cumsum(num_curves * (num_points - 1) + ~closed)))
+    return points, offsets
@@ -0,0 +1,284 @@
+import numpy as np
+
+
+def alpha_macro(z, kappa: float, gamma: float):
+    '''
+    :param z: complex image plane position(s)
+    :param kappa: total convergence
+    :param gamma: shear
+    :return alpha_macro: kappa * z - gamma * z_bar
+    '''
+    return kappa * z - gamma * np.conj(z)
+
+def alpha_star(z, theta: float, stars, max_pairs: int = 2**22):
+    '''
+    calculate the deflection angle due to point mass lenses by direct summation
+
+    :param z: complex image plane position(s)
+    :param theta: Einstein radius of a unit mass point lens
+    :param stars: array of stars (x1, x2, mass)
+    :param max_pairs: maximum number of (position, star) pairs held in memory
+                      at once
+    :return alpha_star: theta^2 * sum(m_i / (z - z_i))_bar
+    '''
+    z = np.asarray(z, dtype=np.complex128)
+    positions = stars[:, 0] + 1j * stars[:, 1]
+    masses = stars[:, 2]
+
+    shape = z.shape
+    z = z.ravel()
+    a_star_bar = np.zeros(z.shape, dtype=np.complex128)
+
+    step = max(1, max_pairs // max(1, z.size))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(0, positions.size, step):
+            a_star_bar += np.sum(masses[i: i + step] / (z[:, None] - positions[i: i + step]), axis=1)
+
+    return (theta**2 * a_star_bar.conj()).reshape(shape)
+
+def alpha_star_derivatives(z, theta: float, stars, max_pairs: int = 2**22):
+    '''
+    calculate the derivatives of the deflection angle due to point mass lenses
+    by direct summation
+
+    :param z: complex image plane position(s)
+    :param theta: Einstein radius of a unit mass point lens
+    :param stars: array of stars (x1, x2, mass)
+    :param max_pairs: maximum number of (position, star) pairs held in memory
+                      at once
+    :return d_alpha_star_d_zbar: -theta^2 * sum(m_i / (z - z_i)^2)_bar
+    :return d2_alpha_star_d_zbar2: 2 * theta^2 * sum(m_i / (z - z_i)^3)_bar
+    '''
+    z = np.asarray(z, dtype=np.complex128)
+    positions = stars[:, 0] + 1j * stars[:, 1]
+    masses = stars[:, 2]
+
+    shape = z.shape
+    z = z.ravel()
+    s2 = np.zeros(z.shape, dtype=np.complex128)
+    s3 = np.zeros(z.shape, dtype=np.complex128)
+
+    step = max(1, max_pairs // max(1, z.size))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(0, positions.size, step):
+            inv = 1 / (z[:, None] - positions[i: i + step])
+            term = masses[i: i + step] * inv * inv
+            s2 += np.sum(term, axis=1)
+            s3 += np.sum(term * inv, axis=1)
+
+    return ((-theta**2 * s2.conj()).reshape(shape),
+            (2 * theta**2 * s3.conj()).reshape(shape))
+
+def alpha_smooth(z, kappastar: float, rectangular: bool, corner, approx: bool, taylor_smooth: int):
+    '''
+    calculate the deflection angle due to smooth matter
+
+    :param z: complex image plane position(s)
+    :param kappastar: convergence in point mass lenses
+    :param rectangular: whether the star field is rectangular or circular
+    :param corner: complex corner of the star field
+    :param approx: whether the smooth matter deflection is approximate or exact
+    :param taylor_smooth: degree of the Taylor series for alpha_smooth if
+                          approximate and rectangular
+    :return alpha_smooth: deflection angle due to the smooth matter
+    '''
+    z = np.asarray(z, dtype=np.complex128)
+    corner = complex(corner)
+    zbar = np.conj(z)
+
+    if rectangular:
+        if approx:
+            s1 = np.zeros(z.shape, dtype=np.complex128)
+            s2 = np.zeros(z.shape, dtype=np.complex128)
+            s3 = np.zeros(z.shape, dtype=np.complex128)
+            s4 = np.zeros(z.shape, dtype=np.complex128)
+            for i in range(taylor_smooth, 0, -1):
+                s1 += 1 / i
+                s2 += 1 / i
+                s3 += 1 / i
+                s4 += 1 / i
+                s1 *= zbar / corner
+                s2 *= zbar / corner.conjugate()
+                s3 *= zbar / -corner
+                s4 *= zbar / -corner.conjugate()
+
+            a_smooth = ((corner - zbar) * (np.log(corner) - s1)
+                        - (corner.conjugate() - zbar) * (np.log(corner.conjugate()) - s2)
+                        + (-corner - zbar) * (np.log(-corner) - s3)
+                        - (-corner.conjugate() - zbar) * (np.log(-corner.conjugate()) - s4))
+            a_smooth *= -1j * kappastar / np.pi
+            a_smooth -= kappastar * 2 * (corner.real + z.real)
+        else:
+            c1 = corner - zbar
+            c2 = corner.conjugate() - zbar
+            c3 = -corner - zbar
+            c4 = -corner.conjugate() - zbar
+
+            a_smooth = c1 * np.log(c1) - c2 * np.log(c2) + c3 * np.log(c3) - c4 * np.log(c4)
+            a_smooth *= -1j * kappastar / np.pi
+            boxcar = ((-corner.real <= z.real) & (z.real <= corner.real)
+                      & (-corner.imag <= z.imag) & (z.imag <= corner.imag))
+            a_smooth -= kappastar * 2 * (corner.real + z.real) * boxcar
+            a_smooth -= (kappastar * 4 * corner.real
+                         * (corner.imag + z.imag >= 0) * (corner.imag - z.imag >= 0) * (z.real - corner.real >= 0))
+    else:
+        if approx:
+            a_smooth = -kappastar * z
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                a_smooth = np.where(np.abs(z) <= abs(corner),
+                                    -kappastar * z,
+                                    -kappastar * abs(corner)**2 / zbar)
+
+    return a_smooth
+
+def _boxcar(z, corner: complex):
+    return ((-corner.real <= z.real) & (z.real <= corner.real)
+            & (-corner.imag <= z.imag) & (z.imag <= corner.imag))
+
+def d_alpha_smooth_d_z(z, kappastar: float, rectangular: bool, corner, approx: bool):
+    '''
+    calculate the derivative of the deflection angle with respect to z due to
+    smooth matter
+
+    :param z: complex image plane position(s)
+    :param kappastar: convergence in point mass lenses
+    :param rectangular: whether the star field is rectangular or circular
+    :param corner: complex corner of the star field
+    :param approx: whether the smooth matter deflection is approximate or exact
+    :return d_alpha_smooth_d_z: real derivative at each position
+    '''
+    z = np.asarray(z, dtype=np.complex128)
+    corner = complex(corner)
+
+    if approx:
+        return np.full(z.shape, -kappastar)
+    if rectangular:
+        return -kappastar * _boxcar(z, corner)
+    return -kappastar * (abs(corner) - np.abs(z) >= 0)
+
+def d_alpha_smooth_d_zbar(z, kappastar: float, rectangular: bool, corner, approx: bool, taylor_smooth: int):
+    '''
+    calculate the derivative of the deflection angle with respect to z_bar due
+    to smooth matter
+
+    :param z: complex image plane position(s)
+    :param kappastar: convergence in point mass lenses
+    :param rectangular: whether the star field is rectangular or circular
+    :param corner: complex corner of the star field
+    :param approx: whether the smooth matter deflection is approximate or exact
+    :param taylor_smooth: degree of the Taylor series for alpha_smooth if
+                          approximate and rectangular
+    :return d_alpha_smooth_d_zbar: derivative at each position
+    '''
+    z = np.asarray(z, dtype=np.complex128)
+    corner = complex(corner)
+    zbar = np.conj(z)
+
+    if rectangular:
+        if approx:
+            # geometric series ratio
+            r = zbar / corner
+            phase = 1j * np.angle(corner)
+
+            # taylor_smooth is odd, and the highest order term is not 0
+            d_a_smooth = np.zeros(z.shape, dtype=np.complex128)
+            for i in range(taylor_smooth - 1, 1, -2):
+                d_a_smooth += (1 - np.exp(2 * phase * i)) / i
+                d_a_smooth *= r * r
+            d_a_smooth *= 2
+
+            d_a_smooth *= -1j * kappastar / np.pi
+            d_a_smooth += kappastar - 4 * kappastar * np.angle(corner) / np.pi
+        else:
+            c1 = corner.conjugate() - zbar
+            c2 = corner - zbar
+            c3 = -corner - zbar
+            c4 = -corner.conjugate() - zbar
+
+            d_a_smooth = np.log(c1) - np.log(c2) - np.log(c3) + np.log(c4)
+            d_a_smooth *= -1j * kappastar / np.pi
+            d_a_smooth -= kappastar * _boxcar(z, corner)
+    else:
+        if approx:
+            d_a_smooth = np.zeros(z.shape, dtype=np.complex128)
+        else:
+            # as in the CUDA code, the form outside the star field is used
+            # everywhere, so the critical curve equation stays rational in z
+            with np.errstate(divide='ignore', invalid='ignore'):
+                d_a_smooth = kappastar * abs(corner)**2 / zbar**2
+
+    return d_a_smooth
+
+def d2_alpha_smooth_d_zbar2(z, kappastar: float, rectangular: bool, corner, approx: bool, taylor_smooth: int):
+    '''
+    calculate the second derivative of the deflection angle with respect to
+    z_bar due to smooth matter
+
+    :param z: complex image plane position(s)
+    :param kappastar: convergence in point mass lenses
+    :param rectangular: whether the star field is rectangular or circular
+    :param corner: complex corner of the star field
+    :param approx: whether the smooth matter deflection is approximate or exact
+    :param taylor_smooth: degree of the Taylor series for alpha_smooth if
+                          approximate and rectangular
+    :return d2_alpha_smooth_d_zbar2: second derivative at each position
+    '''
+    z = np.asarray(z, dtype=np.complex128)
+    corner = complex(corner)
+    zbar = np.conj(z)
+
+    if rectangular:
+        if approx:
+            r = zbar / corner
+            phase = 1j * np.angle(corner)
+
+            d2_a_smooth = np.zeros(z.shape, dtype=np.complex128)
+            for i in range(taylor_smooth - 1, 1, -2):
+                d2_a_smooth += 1 - np.exp(2 * phase * i)
+                d2_a_smooth *= r * r
+            with np.errstate(divide='ignore', invalid='ignore'):
+                d2_a_smooth /= zbar
+            d2_a_smooth *= 2
+
+            d2_a_smooth *= -1j * kappastar / np.pi
+        else:
+            c1 = corner.conjugate() - zbar
+            c2 = corner - zbar
+            c3 = -corner - zbar
+            c4 = -corner.conjugate() - zbar
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                d2_a_smooth = -1 / c1 + 1 / c2 + 1 / c3 - 1 / c4
+            d2_a_smooth *= -1j * kappastar / np.pi
+    else:
+        if approx:
+            d2_a_smooth = np.zeros(z.shape, dtype=np.complex128)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                d2_a_smooth = -2 * kappastar * abs(corner)**2 / zbar**3
+
+    return d2_a_smooth
+
+def w(z, kappa: float, gamma: float, theta: float, stars, kappastar: float,
+      rectangular: bool, corner, approx: bool, taylor_smooth: int):
+    '''
+    lens equation from image plane to source plane
+
+    :param z: complex image plane position(s)
+    :param kappa: total convergence
+    :param gamma: shear
+    :param theta: Einstein radius of a unit mass point lens
+    :param stars: array of stars (x1, x2, mass)
+    :param kappastar: convergence in point mass lenses
+    :param rectangular: whether the star field is rectangular or circular
+    :param corner: complex corner of the star field
+    :param approx: whether the smooth matter deflection is approximate or exact
+    :param taylor_smooth: degree of the Taylor series for alpha_smooth if
+                          approximate and rectangular
+    :return w: z - alpha_macro - alpha_star - alpha_smooth
+    '''
+    z = np.asarray(z, dtype=np.complex128)
+    return (z - alpha_macro(z, kappa, gamma)
+            - alpha_star(z, theta, stars)
+            - alpha_smooth(z, kappastar, rectangular, corner, approx, taylor_smooth))
@@ -0,0 +1,291 @@
+from microlensing.Deflection import deflection_angles, fmm
+from microlensing.Deflection.tree import QuadTree, MAX_NUM_STARS_DIRECT
+
+import numpy as np
+
+
+class Deflector():
+    '''
+    deflection angles of a star field evaluated with the fast multipole method.
+    the tree and its expansion coefficients are built once per star field, after
+    which each position costs O(1) time: the stars in its leaf and the
+    neighboring leaves are summed directly, and all other stars through the
+    local expansion of its leaf
+
+    error bound: multipole to multipole and local to local translations are
+    exact for the truncated expansions, so the only error comes from the
+    multipole to local conversions. for a source node of mass M and half length
+    h whose center is a distance R = |dz| * h from that of the target node,
+    truncating both expansions at order p changes 1 / (z - z_i) by at most
+    rho^(p + 1) / (R * (1 - rho)) per unit mass, where rho = 2 * sqrt(2) / |dz|
+    <= 1 / sqrt(2) (all positions lie within sqrt(2) * h of their centers).
+    the error in alpha_star at any position is therefore at most
+
+        theta^2 * sum_{levels} max_{nodes} sum_{interaction list} M * rho^(p + 1) / (R * (1 - rho))
+
+    which is what error_bound returns. this holds for any arrangement of the
+    stars, so it is typically orders of magnitude above the actual error.
+    positions outside the root node use the multipole expansion of the root
+    when at least 2 * sqrt(2) root half lengths from the origin, and direct
+    summation otherwise
+    '''
+
+    def __init__(self, stars, theta: float, kappa: float = 0, gamma: float = 0, kappastar: float = 0,
+                 rectangular: bool = True, corner=0, approx: bool = True, taylor_smooth: int = 1,
+                 root_half_length: float = None, expansion_order: int = None, alpha_error: float = None,
+                 max_num_stars_direct: int = MAX_NUM_STARS_DIRECT, tree: QuadTree = None):
+        '''
+        :param stars: array of stars (x1, x2, mass)
+        :param theta: Einstein radius of a unit mass point lens
+        :param kappa: total convergence
+        :param gamma: shear
+        :param kappastar: convergence in point mass lenses
+        :param rectangular: whether the star field is rectangular or circular
+        :param corner: complex corner of the star field
+        :param approx: whether the smooth matter deflection is approximate or exact
+        :param taylor_smooth: degree of the Taylor series for alpha_smooth if
+                              approximate and rectangular
+        :param root_half_length: half length of the root node of the tree.
+                                 default is slightly larger than the extent of
+                                 the stars
+        :param expansion_order: order of the multipole and local expansions,
+                                between 3 and 31. if None, estimated from
+                                alpha_error in the same way as the CUDA code
+        :param alpha_error: desired error in the deflection angle, used if
+                            expansion_order is None
+        :param max_num_stars_direct: maximum number of stars in a leaf and its
+                                     neighbors, which are summed directly
+        :param tree: QuadTree of these stars, if already built. overrides
+                     root_half_length and max_num_stars_direct
+        '''
+        self.stars = np.asarray(stars, dtype=np.float64)
+        if self.stars.ndim != 2 or self.stars.shape[1] != 3:
+            raise ValueError("stars must be an array of shape (num_stars, 3)")
+
+        self.theta = theta
+        self.kappa = kappa
+        self.gamma = gamma
+        self.kappastar = kappastar
+        self.rectangular = rectangular
+        self.corner = complex(corner)
+        self.approx = approx
+        self.taylor_smooth = taylor_smooth
+
+        if tree is None:
+            # the root must contain all the stars
+            extent = 1.1 * np.max(np.abs(self.stars[:, :2]), initial=0)
+            if root_half_length is None or root_half_length < extent:
+                root_half_length = extent
+            root_half_length = max(root_half_length, np.finfo(np.float64).tiny)
+            tree = QuadTree(self.stars, root_half_length, max_num_stars_direct)
+        self.tree = tree
+        root_half_length = tree.root_half_length
+        levels = self.tree.levels
+        n = self.tree.num_nodes_per_side(levels)
+        positions = self.tree.sorted_stars[:, 0] + 1j * self.tree.sorted_stars[:, 1]
+        i1, i2 = self.tree.node_index(positions, levels)
+        leaf = i2 * n + i1
+
+        masses = np.bincount(leaf, weights=self.tree.sorted_stars[:, 2], minlength=n * n).reshape(n, n)
+        self._masses = [None] * (levels + 1)
+        self._masses[levels] = masses
+        for level in range(levels, 0, -1):
+            m = self._masses[level]
+            self._masses[level - 1] = m[0::2, 0::2] + m[1::2, 0::2] + m[0::2, 1::2] + m[1::2, 1::2]
+
+        if expansion_order is None:
+            if alpha_error is None or alpha_error <= 0:
+                raise ValueError("alpha_error must be > 0 if expansion_order is not provided")
+            # same estimate as the CUDA code, which is far less pessimistic than
+            # the rigorous bound of error_bound
+            masses = self.stars[:, 2]
+            expansion_order = max(3, int(np.ceil(2 * np.log2(theta)
+                                                 + np.log2(np.mean(masses**2)) - np.log2(np.mean(masses))
+                                                 + levels
+                                                 - np.log2(root_half_length) - np.log2(alpha_error))))
+        if not 3 <= expansion_order <= fmm.MAX_EXPANSION_ORDER:
+            raise ValueError(f"expansion_order must be between 3 and {fmm.MAX_EXPANSION_ORDER}")
+        self.expansion_order = int(expansion_order)
+
+        centers = self.tree.centers(levels).ravel()
+        leaf_coeffs = fmm.multipole_coeffs(self.tree.sorted_stars, centers[leaf], self.tree.half_length(levels),
+                                           leaf, n * n, self.expansion_order)
+        multipoles = fmm.upward_pass(leaf_coeffs.reshape(n, n, -1), levels, self.expansion_order)
+        self.root_multipole = multipoles[0][0, 0]
+        self.local_coeffs = fmm.downward_pass(multipoles, levels, self.expansion_order).reshape(n * n, -1)
+        self.leaf_centers = centers
+
+        # stars within each leaf and its neighbors, padded to a fixed width with
+        # massless stars far from every position
+        near_counts = np.diff(self.tree.near_start)
+        width = max(1, int(near_counts.max(initial=0)))
+        columns = np.arange(width)
+        index = np.where(columns < near_counts[:, None], self.tree.near_start[:-1, None] + columns, -1)
+        near = np.append(self.tree.near_stars, self.tree.num_stars)[index]
+        self._near_positions = np.append(positions, 1e150 * root_half_length)[near]
+        self._near_masses = np.append(self.tree.sorted_stars[:, 2], 0)[near]
+
+    @property
+    def root_half_length(self):
+        return self.tree.root_half_length
+
+    @property
+    def tree_levels(self):
+        return self.tree.levels
+
+    def error_bound(self, expansion_order: int = None):
+        '''
+        upper bound on the error in alpha_star for a given expansion order
+
+        :param expansion_order: order of the expansion. default is the order
+                                used by this Deflector
+        :return error: maximum error in alpha_star at any position
+        '''
+        if expansion_order is None:
+            expansion_order = self.expansion_order
+
+        error = 0
+        for level in range(2, self.tree.levels + 1):
+            n = 2**level
+            h = self.tree.half_length(level)
+            masses = self._masses[level]
+            level_error = np.zeros((n, n))
+            for py in (0, 1):
+                for px in (0, 1):
+                    for dx, dy in fmm.interaction_list(px, py):
+                        sx = fmm._slices(dx, px, n)
+                        sy = fmm._slices(dy, py, n)
+                        if sx is None or sy is None:
+                            continue
+                        R = 2 * np.hypot(dx, dy)
+                        rho = 2 * np.sqrt(2) / R
+                        level_error[sy[0], sx[0]] += masses[sy[1], sx[1]] * rho**(expansion_order + 1) / (R * h * (1 - rho))
+            error += level_error.max()
+
+        # expansion of the root, used at least 2 * sqrt(2) root half lengths away
+        rho = 0.5
+        outside_error = (self._masses[0][0, 0] * rho**(expansion_order + 1)
+                         / (2 * np.sqrt(2) * self.root_half_length * (1 - rho)))
+
+        return self.theta**2 * max(error, outside_error)
+
+    def alpha_star(self, z, max_points: int = 2**16):
+        '''
+        :param z: complex image plane position(s)
+        :param max_points: maximum number of positions evaluated at once
+        :return alpha_star: theta^2 * sum(m_i / (z - z_i))_bar
+        '''
+        z = np.asarray(z, dtype=np.complex128)
+        shape = z.shape
+        z = z.ravel()
+        result = np.zeros(z.shape, dtype=np.complex128)
+
+        inside = self.tree.contains(z)
+        far = ~inside & (np.abs(z) >= 2 * np.sqrt(2) * self.root_half_length)
+        near = ~inside & ~far
+
+        levels = self.tree.levels
+        n = self.tree.num_nodes_per_side(levels)
+        h = self.tree.half_length(levels)
+
+        where = np.flatnonzero(inside)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(0, where.size, max_points):
+                idx = where[i: i + max_points]
+                zi = z[idx]
+                i1, i2 = self.tree.node_index(zi, levels)
+                leaf = i2 * n + i1
+
+                dphi = fmm.evaluate_local(self.local_coeffs[leaf], (zi - self.leaf_centers[leaf]) / h, h)
+                dphi += np.sum(self._near_masses[leaf] / (zi[:, None] - self._near_positions[leaf]), axis=1)
+                result[idx] = dphi
+
+            if np.any(far):
+                result[far] = fmm.evaluate_multipole(self.root_multipole, z[far] / self.root_half_length,
+                                                     self.root_half_length)
+
+        result = self.theta**2 * result.conj()
+
+        if np.any(near):
+            result[near] = deflection_angles.alpha_star(z[near], self.theta, self.stars)
+
+        return result.reshape(shape)
+
+    def alpha_star_derivatives(self, z, max_points: int = 2**16):
+        '''
+        derivatives of the deflection angle due to the stars, as needed for
+        critical curves. positions outside the root node are summed directly
+
+        :param z: complex image plane position(s)
+        :param max_points: maximum number of positions evaluated at once
+        :return d_alpha_star_d_zbar: -theta^2 * sum(m_i / (z - z_i)^2)_bar
+        :return d2_alpha_star_d_zbar2: 2 * theta^2 * sum(m_i / (z - z_i)^3)_bar
+        '''
+        z = np.asarray(z, dtype=np.complex128)
+        shape = z.shape
+        z = z.ravel()
+        d1 = np.zeros(z.shape, dtype=np.complex128)
+        d2 = np.zeros(z.shape, dtype=np.complex128)
+
+        inside = self.tree.contains(z)
+
+        levels = self.tree.levels
+        n = self.tree.num_nodes_per_side(levels)
+        h = self.tree.half_length(levels)
+
+        where = np.flatnonzero(inside)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(0, where.size, max_points):
+                idx = where[i: i + max_points]
+                zi = z[idx]
+                i1, i2 = self.tree.node_index(zi, levels)
+                leaf = i2 * n + i1
+
+                d2phi, d3phi = fmm.evaluate_local_derivatives(self.local_coeffs[leaf],
+                                                              (zi - self.leaf_centers[leaf]) / h, h)
+                inv = 1 / (zi[:, None] - self._near_positions[leaf])
+                term = self._near_masses[leaf] * inv * inv
+                d2phi -= np.sum(term, axis=1)
+                d3phi += 2 * np.sum(term * inv, axis=1)
+                d1[idx] = d2phi
+                d2[idx] = d3phi
+
+        d1 = self.theta**2 * d1.conj()
+        d2 = self.theta**2 * d2.conj()
+
+        if not np.all(inside):
+            d1[~inside], d2[~inside] = deflection_angles.alpha_star_derivatives(z[~inside], self.theta, self.stars)
+
+        return d1.reshape(shape), d2.reshape(shape)
+
+    def alpha_smooth(self, z):
+        '''
+        :param z: complex image plane position(s)
+        :return alpha_smooth: deflection angle due to the smooth matter
+        '''
+        return deflection_angles.alpha_smooth(z, self.kappastar, self.rectangular, self.corner,
+                                              self.approx, self.taylor_smooth)
+
+    def deflect(self, z, max_points: int = 2**16):
+        '''
+        total deflection angle of the macromodel, the stars, and the smooth matter
+
+        :param z: complex image plane position(s)
+        :param max_points: maximum number of positions evaluated at once
+        :return alpha: alpha_macro + alpha_star + alpha_smooth
+        '''
+        z = np.asarray(z, dtype=np.complex128)
+        return (deflection_angles.alpha_macro(z, self.kappa, self.gamma)
+                + self.alpha_star(z, max_points)
+                + self.alpha_smooth(z))
+
+    def w(self, z, max_points: int = 2**16):
+        '''
+        lens equation from image plane to source plane
+
+        :param z: complex image plane position(s)
+        :param max_points: maximum number of positions evaluated at once
+        :return w: z - alpha_macro - alpha_star - alpha_smooth
+        '''
+        z = np.asarray(z, dtype=np.complex128)
+        return z - self.deflect(z, max_points)
@@ -0,0 +1,231 @@
+from scipy.special import binom
+
+import numpy as np
+
+
+'''
+coefficients are scaled by the half length h of their node. for a node with
+center c, the potential of the stars within it is
+
+    phi(z) = a_0 * log(z - c) + sum_{k >= 1} a_k * ((z - c) / h)^-k
+
+outside the node (multipole coefficients a_k), and the potential of the stars
+far from it is
+
+    phi(z) = sum_{l >= 0} b_l * ((z - c) / h)^l
+
+inside the node (local coefficients b_l). the deflection angle is then
+theta^2 * (dphi/dz)_bar. translations between nodes are linear, and are
+represented as matrices acting on the coefficient vectors
+'''
+
+MAX_EXPANSION_ORDER = 31
+
+
+def multipole_coeffs(stars, centers, half_length: float, node, num_nodes: int, expansion_order: int):
+    '''
+    calculate the multipole coefficients of the leaf nodes directly from their
+    stars
+
+    :param stars: array of stars (x1, x2, mass)
+    :param centers: complex centers of the nodes the stars belong to
+    :param half_length: half length of the nodes
+    :param node: flat index of the node each star belongs to
+    :param num_nodes: total number of nodes
+    :param expansion_order: order of the expansion
+    :return coeffs: multipole coefficients of shape (num_nodes, expansion_order + 1)
+    '''
+    masses = stars[:, 2]
+    dz = (stars[:, 0] + 1j * stars[:, 1] - centers) / half_length
+
+    coeffs = np.zeros((num_nodes, expansion_order + 1), dtype=np.complex128)
+    coeffs[:, 0] = np.bincount(node, weights=masses, minlength=num_nodes)
+
+    term = masses.astype(np.complex128)
+    for k in range(1, expansion_order + 1):
+        term = term * dz
+        coeffs[:, k] = -(np.bincount(node, weights=term.real, minlength=num_nodes)
+                         + 1j * np.bincount(node, weights=term.imag, minlength=num_nodes)) / k
+
+    return coeffs
+
+def M2M_matrix(dz: complex, expansion_order: int):
+    '''
+    matrix shifting multipole coefficients from a child to its parent
+
+    :param dz: (child center - parent center) / child half length
+    :param expansion_order: order of the expansion
+    '''
+    p = expansion_order
+    l = np.arange(p + 1)[:, None]
+    k = np.arange(p + 1)[None, :]
+
+    mat = binom(l - 1, k - 1) * dz**np.maximum(l - k, 0) / 2.**l
+    mat = np.where(k <= l, mat, 0).astype(np.complex128)
+    mat[0, 0] = 1
+    mat[1:, 0] = -dz**l[1:, 0] / (l[1:, 0] * 2.**l[1:, 0])
+    return mat
+
+def M2L_matrix(dz: complex, expansion_order: int):
+    '''
+    matrix converting the multipole coefficients of a node into local
+    coefficients of a well separated node of the same size. the constant term
+    of the local expansion does not affect the deflection angle, and is set to
+    0
+
+    :param dz: (source center - target center) / half length
+    :param expansion_order: order of the expansion
+    '''
+    p = expansion_order
+    l = np.arange(1, p + 1)[:, None]
+    k = np.arange(1, p + 1)[None, :]
+
+    mat = np.zeros((p + 1, p + 1), dtype=np.complex128)
+    mat[1:, 1:] = binom(l + k - 1, k - 1) / (-dz)**k / dz**l
+    mat[1:, 0] = -1 / (l[:, 0] * dz**l[:, 0])
+    return mat
+
+def L2L_matrix(dz: complex, expansion_order: int):
+    '''
+    matrix shifting local coefficients from a parent to its child
+
+    :param dz: (child center - parent center) / parent half length
+    :param expansion_order: order of the expansion
+    '''
+    p = expansion_order
+    l = np.arange(p + 1)[:, None]
+    k = np.arange(p + 1)[None, :]
+
+    mat = binom(k, l) * dz**np.maximum(k - l, 0) / 2.**l
+    return np.where(k >= l, mat, 0).astype(np.complex128)
+
+def interaction_list(px: int, py: int):
+    '''
+    offsets (dx, dy) of the nodes in the interaction list of a node with the
+    given parity of its indices. these are the children of the neighbors of
+    its parent which are not its own neighbors
+    '''
+    return [(dx, dy)
+            for dy in range(-2 - py, 4 - py)
+            for dx in range(-2 - px, 4 - px)
+            if abs(dx) > 1 or abs(dy) > 1]
+
+def _slices(offset: int, parity: int, n: int):
+    '''
+    slices of target and source indices along one axis, for targets of the
+    given parity and sources at the given offset from them
+    '''
+    lower = max(0, -((parity + offset) // 2))
+    upper = min(n // 2 - 1, (n - 1 - parity - offset) // 2)
+    if upper < lower:
+        return None
+    target = slice(parity + 2 * lower, parity + 2 * upper + 1, 2)
+    source = slice(parity + 2 * lower + offset, parity + 2 * upper + offset + 1, 2)
+    return target, source
+
+def upward_pass(leaf_coeffs, levels: int, expansion_order: int):
+    '''
+    calculate the multipole coefficients of all levels of the tree from those
+    of the leaves
+
+    :param leaf_coeffs: multipole coefficients of the leaves, of shape
+                        (2^levels, 2^levels, expansion_order + 1)
+    :return multipoles: list of the multipole coefficients of each level
+    '''
+    multipoles = [None] * (levels + 1)
+    multipoles[levels] = leaf_coeffs
+
+    for level in range(levels, 0, -1):
+        child = multipoles[level]
+        n = child.shape[0] // 2
+        parent = np.zeros((n, n, expansion_order + 1), dtype=np.complex128)
+        for py in (0, 1):
+            for px in (0, 1):
+                mat = M2M_matrix(complex(2 * px - 1, 2 * py - 1), expansion_order)
+                parent += child[py::2, px::2] @ mat.T
+        multipoles[level - 1] = parent
+
+    return multipoles
+
+def downward_pass(multipoles, levels: int, expansion_order: int):
+    '''
+    calculate the local coefficients of the leaves of the tree. local
+    coefficients are non zero only starting at the second level
+
+    :param multipoles: list of the multipole coefficients of each level
+    :return locals: local coefficients of the leaves, of shape
+                    (2^levels, 2^levels, expansion_order + 1)
+    '''
+    local = np.zeros((1, 1, expansion_order + 1), dtype=np.complex128)
+
+    for level in range(1, levels + 1):
+        n = 2**level
+        child = np.zeros((n, n, expansion_order + 1), dtype=np.complex128)
+        multipole = multipoles[level]
+
+        for py in (0, 1):
+            for px in (0, 1):
+                if level > 1:
+                    mat = L2L_matrix(complex(px - 0.5, py - 0.5), expansion_order)
+                    child[py::2, px::2] += local @ mat.T
+
+                for dx, dy in interaction_list(px, py):
+                    sx = _slices(dx, px, n)
+                    sy = _slices(dy, py, n)
+                    if sx is None or sy is None:
+                        continue
+                    mat = M2L_matrix(complex(2 * dx, 2 * dy), expansion_order)
+                    child[sy[0], sx[0]] += multipole[sy[1], sx[1]] @ mat.T
+
+        local = child
+
+    return local
+
+def evaluate_local(coeffs, dz, half_length: float):
+    '''
+    derivative of a local expansion
+
+    :param coeffs: local coefficients for each position, of shape
+                   (n, expansion_order + 1)
+    :param dz: (position - node center) / half length
+    :return dphi/dz: derivative of the potential at each position
+    '''
+    expansion_order = coeffs.shape[1] - 1
+    result = np.zeros(dz.shape, dtype=np.complex128)
+    for l in range(expansion_order, 0, -1):
+        result = result * dz + l * coeffs[:, l]
+    return result / half_length
+
+def evaluate_local_derivatives(coeffs, dz, half_length: float):
+    '''
+    second and third derivatives of a local expansion
+
+    :param coeffs: local coefficients for each position, of shape
+                   (n, expansion_order + 1)
+    :param dz: (position - node center) / half length
+    :return d2phi/dz2: second derivative of the potential at each position
+    :return d3phi/dz3: third derivative of the potential at each position
+    '''
+    expansion_order = coeffs.shape[1] - 1
+    d2 = np.zeros(dz.shape, dtype=np.complex128)
+    d3 = np.zeros(dz.shape, dtype=np.complex128)
+    for l in range(expansion_order, 1, -1):
+        d2 = d2 * dz + l * (l - 1) * coeffs[:, l]
+    for l in range(expansion_order, 2, -1):
+        d3 = d3 * dz + l * (l - 1) * (l - 2) * coeffs[:, l]
+    return d2 / half_length**2, d3 / half_length**3
+
+def evaluate_multipole(coeffs, dz, half_length: float):
+    '''
+    derivative of a single multipole expansion
+
+    :param coeffs: multipole coefficients, of shape (expansion_order + 1,)
+    :param dz: (position - node center) / half length
+    :return dphi/dz: derivative of the potential at each position
+    '''
+    expansion_order = coeffs.shape[0] - 1
+    inv = 1 / dz
+    result = np.zeros(dz.shape, dtype=np.complex128)
+    for k in range(expansion_order, 0, -1):
+        result = (result - k * coeffs[k]) * inv
+    return (coeffs[0] + result) * inv / half_length
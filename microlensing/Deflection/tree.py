@@ -0,0 +1,130 @@
+import numpy as np
+
+
+# number of stars to use directly when evaluating deflections. this helps
+# determine the depth of the tree
+MAX_NUM_STARS_DIRECT = 32
+
+
+def _neighborhood_sum(counts):
+    '''
+    sum of a 2D array over the 3x3 neighborhood of every element
+    '''
+    padded = np.pad(counts, 1)
+    n1, n2 = counts.shape
+    return sum(padded[i: i + n1, j: j + n2] for i in range(3) for j in range(3))
+
+
+class QuadTree():
+    '''
+    quadtree of uniform depth over a square centered on the origin. star
+    fields are uniformly distributed, so every node of a level is kept and the
+    nodes of a level form a regular (2^level, 2^level) grid indexed [x2, x1].
+    this mirrors tree_node.cuh, but allows translations between levels to be
+    applied to all nodes of a level at once
+    '''
+
+    def __init__(self, stars, root_half_length: float, max_num_stars_direct: int = MAX_NUM_STARS_DIRECT,
+                 max_levels: int = None):
+        '''
+        :param stars: array of stars (x1, x2, mass)
+        :param root_half_length: half length of the root node. must contain
+                                 all the stars
+        :param max_num_stars_direct: the tree is subdivided until no leaf and
+                                     its neighbors contain more stars than this
+        :param max_levels: maximum depth of the tree. default caps the number of
+                           leaves at 16 times the number of stars
+        '''
+        self.stars = np.asarray(stars, dtype=np.float64)
+        self.root_half_length = root_half_length
+        self.num_stars = self.stars.shape[0]
+
+        if max_levels is None:
+            max_levels = int(np.ceil(np.log(max(16 * self.num_stars, 1)) / np.log(4)))
+
+        positions = self.stars[:, 0] + 1j * self.stars[:, 1]
+
+        self.levels = 0
+        while self.levels < max_levels:
+            counts = self._counts(positions, self.levels)
+            if _neighborhood_sum(counts).max(initial=0) <= max_num_stars_direct:
+                break
+            self.levels += 1
+
+        n = self.num_nodes_per_side(self.levels)
+        leaf = self.node_index(positions, self.levels)
+        flat_leaf = leaf[1] * n + leaf[0]
+
+        # stars sorted by the leaf they belong to
+        self.order = np.argsort(flat_leaf, kind='stable')
+        self.sorted_stars = self.stars[self.order]
+        counts = np.bincount(flat_leaf, minlength=n * n)
+        self.leaf_start = np.concatenate(([0], np.cumsum(counts)))
+
+        # stars within each leaf and its neighbors, as a compressed list
+        near_counts = _neighborhood_sum(counts.reshape(n, n)).ravel()
+        self.near_start = np.concatenate(([0], np.cumsum(near_counts)))
+        near_stars = np.empty(self.near_start[-1], dtype=np.int64)
+        fill = self.near_start[:-1].copy()
+        i2, i1 = np.divmod(np.arange(n * n), n)
+        for d2 in (-1, 0, 1):
+            for d1 in (-1, 0, 1):
+                j2, j1 = i2 + d2, i1 + d1
+                valid = (0 <= j1) & (j1 < n) & (0 <= j2) & (j2 < n)
+                target = np.flatnonzero(valid)
+                source = j2[valid] * n + j1[valid]
+                num = counts[source]
+                idx, k = _expand(self.leaf_start[source], num)
+                near_stars[np.repeat(fill[target], num) + k] = idx
+                fill[target] += num
+        self.near_stars = near_stars
+
+    def _counts(self, positions, level: int):
+        n = self.num_nodes_per_side(level)
+        i1, i2 = self.node_index(positions, level)
+        return np.bincount(i2 * n + i1, minlength=n * n).reshape(n, n)
+
+    @staticmethod
+    def num_nodes_per_side(level: int):
+        return 2**level
+
+    def half_length(self, level: int):
+        return self.root_half_length / 2**level
+
+    def centers(self, level: int):
+        '''
+        :return centers: complex node centers of shape (2^level, 2^level)
+        '''
+        h = self.half_length(level)
+        x = -self.root_half_length + h * (2 * np.arange(self.num_nodes_per_side(level)) + 1)
+        return x[None, :] + 1j * x[:, None]
+
+    def node_index(self, z, level: int):
+        '''
+        index of the node containing each position. positions outside the root
+        are assigned to the nearest node
+
+        :return i1, i2: x1 and x2 indices of the nodes
+        '''
+        n = self.num_nodes_per_side(level)
+        h = self.half_length(level)
+        i1 = np.clip(np.floor((np.real(z) + self.root_half_length) / (2 * h)), 0, n - 1).astype(np.int64)
+        i2 = np.clip(np.floor((np.imag(z) + self.root_half_length) / (2 * h)), 0, n - 1).astype(np.int64)
+        return i1, i2
+
+    def contains(self, z):
+        return ((np.abs(np.real(z)) <= self.root_half_length)
+                & (np.abs(np.imag(z)) <= self.root_half_length))
+
+
+def _expand(start, num):
+    '''
+    expand ranges [start, start + num) into their members
+
+    :return idx: members of all the ranges
+    :return k: position of each member within its range
+    '''
+    owner = np.repeat(np.arange(num.size), num)
+    offsets = np.cumsum(num) - num
+    k = np.arange(owner.size) - offsets[owner]
+    return start[owner] + k, k
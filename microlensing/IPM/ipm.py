@@ -1,9 +1,13 @@
-from . import lib_ipm
-from . import lib_ipm_double
 from microlensing.Stars.stars import Stars
+from microlensing.Util.library_object import LibraryObject, library_state, restore_library_state
+from microlensing.Util.timings import peak_memory, profiled, stage
 
 import numpy as np
-import matplotlib.axes
+from typing import TYPE_CHECKING
+
+# matplotlib is only imported once something is plotted
+if TYPE_CHECKING:
+    import matplotlib.axes
 
 
 class IPM(object):
@@ -13,7 +17,8 @@ class IPM(object):
                  starfile: str = None, center_y1: float = None, center_y2: float = None, half_length_y1: float = None, half_length_y2: float = None,
                  num_pixels_y1: int = None, num_pixels_y2: int = None, num_rays_y: int = None, random_seed: int = None,
                  write_stars: bool = False, write_maps: bool = False, write_parities: bool = False, write_histograms: bool = False,
-                 outfile_prefix: str = None, verbose: int = 0, is_double: bool = False):
+                 outfile_prefix: str = None, verbose: int = 0, is_double: bool = False, backend: str = 'gpu',
+                 num_processes: int = None, zero_copy: bool = False):
         '''
         :param kappa_tot: total convergence
         :param shear: shear
@@ -46,14 +51,23 @@ class IPM(object):
         :param outfile_prefix: prefix to be used in output file names
         :param verbose: verbosity level of messages. must be 0, 1, 2, or 3
         :param is_double: whether to use float or double library
+        :param backend: library to run on. Options are: gpu (the CUDA library) and cpu (a NumPy implementation
+                        that needs no GPU)
+        :param num_processes: number of processes for the cpu backend to shoot cells with. default is the number of CPUs
+        :param zero_copy: whether results should be read-only views of the library's memory instead of copies of it
         '''
-        if is_double:
-            self.lib = lib_ipm_double.lib
-        else:
-            self.lib = lib_ipm.lib
+        self.lib = self._library(backend, is_double)
+        self.backend = backend
+        self.is_double = is_double
 
-        self.obj = self.lib.IPM_init()
+        # the library object is kept alive by any views of its memory
+        self._handle = LibraryObject(self.lib, 'IPM')
+        self.obj = self._handle.obj
         self.verbose = verbose
+        self.zero_copy = zero_copy
+
+        # time in seconds of each stage of the last run and save
+        self._timings = {}
 
         self.kappa_tot = kappa_tot
         self.shear = shear
@@ -94,9 +108,32 @@ class IPM(object):
         
         self.outfile_prefix = outfile_prefix
 
-    def __del__(self):
-        self.lib.IPM_delete(self.obj)
-        
+        self.num_processes = num_processes
+
+    @staticmethod
+    def _library(backend: str, is_double: bool):
+        '''
+        load the library of a backend and precision on first use
+        '''
+        if backend == 'gpu':
+            if is_double:
+                from . import lib_ipm_double
+                return lib_ipm_double.lib
+            from . import lib_ipm
+            return lib_ipm.lib
+        elif backend == 'cpu':
+            from . import lib_ipm_cpu
+            if is_double:
+                return lib_ipm_cpu.lib_double
+            return lib_ipm_cpu.lib
+        raise ValueError("backend must be gpu or cpu")
+
+    def __getstate__(self):
+        return library_state(self)
+
+    def __setstate__(self, state):
+        restore_library_state(self, state, self._library(state['backend'], state['is_double']), 'IPM')
+
     @property
     def kappa_tot(self):
         return self.lib.get_kappa_tot(self.obj)
@@ -400,6 +437,21 @@ class IPM(object):
         if value is not None:
             self.lib.set_outfile_prefix(self.obj, value.encode('utf-8'))
 
+    @property
+    def num_processes(self):
+        if self.backend != 'cpu':
+            return None
+        return self.lib.get_num_processes(self.obj)
+    
+    @num_processes.setter
+    def num_processes(self, value):
+        if value is not None:
+            if self.backend != 'cpu':
+                raise ValueError("num_processes is only used by the cpu backend")
+            if value < 1:
+                raise ValueError("num_processes must be >= 1")
+            self.lib.set_num_processes(self.obj, value)
+
     @property
     def num_stars(self):
         return self.lib.get_num_stars(self.obj)
@@ -408,32 +460,147 @@ class IPM(object):
     def corner(self):
         return (self.lib.get_corner_x1(self.obj), self.lib.get_corner_x2(self.obj))
 
+    def _release_results(self):
+        if self.zero_copy:
+            # results of a previous run are views of memory the library is
+            # about to overwrite
+            self.magnifications = None
+            self.magnifications_minima = None
+            self.magnifications_saddles = None
+            self.stars = None
+            if self._handle.in_use():
+                raise Exception("Results of a previous IPM run are still referenced. "
+                                "Copy or delete them before running again")
+
+    @profiled
     def run(self):
-        if not self.lib.run(self.obj, self.verbose):
-            raise Exception("Error running IPM")
-        
-        self.magnifications = np.ctypeslib.as_array(self.lib.get_pixels(self.obj), 
-                                                    shape=(self.num_pixels_y2,
-                                                           self.num_pixels_y1)).copy()
+        self._release_results()
+
+        self._timings = {}
+        with stage(self._timings, 'run'):
+            if not self.lib.run(self.obj, self.verbose):
+                raise Exception("Error running IPM")
+
+        with stage(self._timings, 'copy_out'):
+            self._get_results()
+
+    @profiled
+    def run_region(self, center, half_length, num_pixels):
+        '''
+        Compute the magnification map of a region of the source plane with
+        the star field and tree of the previous run, so that only cells are
+        shot. If there is no previous run, or a parameter the star field
+        depends on has changed, the star field and tree are first generated
+        for the region set in the object (center_y1, half_length_y1, etc.),
+        which should then cover all the regions to be run. The object's
+        region is set to the given region afterwards, so save writes its
+        map. Only available with the cpu backend
+
+        :param center: (y1, y2) center of the region
+        :param half_length: (y1, y2) half lengths of the region, or a single
+                            value for a square region
+        :param num_pixels: (y1, y2) number of pixels of the region, or a
+                           single value for the same number along both axes
+        '''
+        if self.backend != 'cpu':
+            raise ValueError("run_region is only available with the cpu backend")
+
+        center = np.broadcast_to(center, 2).astype(float)
+        half_length = np.broadcast_to(half_length, 2).astype(float)
+        num_pixels = np.broadcast_to(num_pixels, 2)
+        if np.any(half_length <= 0):
+            raise ValueError("half_length must be > 0")
+        if np.any(num_pixels < 1):
+            raise ValueError("num_pixels must be >= 1")
+
+        self._release_results()
+
+        self._timings = {}
+        with stage(self._timings, 'run'):
+            if not self.lib.run_region(self.obj, *center.tolist(), *half_length.tolist(),
+                                       *(int(n) for n in num_pixels), self.verbose):
+                raise Exception("Error running IPM")
+
+        with stage(self._timings, 'copy_out'):
+            self._get_results()
+
+    def _get_results(self):
+        self.magnifications = self._handle.array(self.lib.get_pixels(self.obj),
+                                                 shape=(self.num_pixels_y2,
+                                                        self.num_pixels_y1), zero_copy=self.zero_copy)
         if self.write_parities:
-            self.magnifications_minima = np.ctypeslib.as_array(self.lib.get_pixels_minima(self.obj), 
-                                                               shape=(self.num_pixels_y2,
-                                                                      self.num_pixels_y1)).copy()
-            self.magnifications_saddles = np.ctypeslib.as_array(self.lib.get_pixels_saddles(self.obj), 
-                                                                shape=(self.num_pixels_y2,
-                                                                       self.num_pixels_y1)).copy()
+            self.magnifications_minima = self._handle.array(self.lib.get_pixels_minima(self.obj),
+                                                            shape=(self.num_pixels_y2,
+                                                                   self.num_pixels_y1), zero_copy=self.zero_copy)
+            self.magnifications_saddles = self._handle.array(self.lib.get_pixels_saddles(self.obj),
+                                                             shape=(self.num_pixels_y2,
+                                                                    self.num_pixels_y1), zero_copy=self.zero_copy)
         else:
             self.magnifications_minima = None
             self.magnifications_saddles = None
 
-        self.stars = Stars(np.ctypeslib.as_array(self.lib.get_stars(self.obj),
-                                                 shape=(self.num_stars, 3)).copy(),
+        self.stars = Stars(self._handle.array(self.lib.get_stars(self.obj),
+                                              shape=(self.num_stars, 3), zero_copy=self.zero_copy),
                            self.rectangular, self.corner, self.theta_star)
         
+    @profiled
+    def run_tiled(self, tile_num_pixels: int = 2048):
+        '''
+        Compute the magnification map one tile at a time with a single star
+        field and tree, streaming each tile into the magnification map files
+        (ipm_magnifications.bin, and the parity maps if write_parities) instead
+        of holding the map in memory. The maps are then available as read-only
+        memory mapped arrays. Completed tiles are recorded in ipm_tiles.txt,
+        and are skipped if an interrupted run is restarted with the same
+        parameters. Only available with the cpu backend
+
+        :param tile_num_pixels: number of pixels along each side of a tile.
+                                tiles should be large compared to the size of
+                                the region lost to light_loss, which is shot
+                                around every tile
+        '''
+        if self.backend != 'cpu':
+            raise ValueError("run_tiled is only available with the cpu backend")
+        if tile_num_pixels < 1:
+            raise ValueError("tile_num_pixels must be >= 1")
+
+        self._release_results()
+
+        self._timings = {}
+        with stage(self._timings, 'run'):
+            if not self.lib.run_tiled(self.obj, tile_num_pixels, self.verbose):
+                raise Exception("Error running IPM")
+
+        # the maps are memory mapped files, which are not copied into memory
+        self.magnifications = self.lib.get_pixels(self.obj)
+        if self.write_parities:
+            self.magnifications_minima = self.lib.get_pixels_minima(self.obj)
+            self.magnifications_saddles = self.lib.get_pixels_saddles(self.obj)
+        else:
+            self.magnifications_minima = None
+            self.magnifications_saddles = None
+
+        self.stars = Stars(self._handle.array(self.lib.get_stars(self.obj),
+                                              shape=(self.num_stars, 3), zero_copy=self.zero_copy),
+                           self.rectangular, self.corner, self.theta_star)
+
     @property
     def t_shoot_cells(self):
         return self.lib.get_t_shoot_cells(self.obj)
 
+    @property
+    def timings(self):
+        '''
+        time in seconds of each stage of the last run and save, and the peak
+        memory of the process in bytes. the cpu backend also reports the
+        stages of the library (generate_stars, create_tree, etc.)
+        '''
+        if self.backend == 'cpu':
+            timings = dict(self.lib.get_timings(self.obj))
+        else:
+            timings = {'shoot_cells': self.t_shoot_cells}
+        return {**timings, **self._timings, 'peak_memory': peak_memory()}
+
     @property
     def magnitudes(self):
         return -2.5 * np.log10(self.magnifications / np.abs(self.mu_ave))
@@ -457,11 +624,13 @@ class IPM(object):
                          [(self.center[1] - self.half_length[1]),
                           (self.center[1] + self.half_length[1])]])
     
+    @profiled
     def save(self):
-        if not self.lib.save(self.obj, self.verbose):
-            raise Exception("Error saving IPM")
+        with stage(self._timings, 'save'):
+            if not self.lib.save(self.obj, self.verbose):
+                raise Exception("Error saving IPM")
 
-    def plot(self, ax: matplotlib.axes.Axes, cmap='viridis', plot_magnitudes=False, parity=None, **kwargs):
+    def plot(self, ax: 'matplotlib.axes.Axes', cmap='viridis', plot_magnitudes=False, parity=None, **kwargs):
         if parity not in [None, '+', '-']:
             raise ValueError("parity must be None, '+', or '-'")
 
@@ -514,7 +683,7 @@ class IPM(object):
             ax.set_xlabel('$y_1$')
             ax.set_ylabel('$y_2$')
 
-    def plot_hist(self, ax: matplotlib.axes.Axes, bins=None, dw=0.01, plot_magnitudes=False, parity=None, **kwargs):
+    def plot_hist(self, ax: 'matplotlib.axes.Axes', bins=None, dw=0.01, plot_magnitudes=False, parity=None, **kwargs):
         if parity not in [None, '+', '-']:
             raise ValueError("parity must be None, '+', or '-'")
         
@@ -0,0 +1,766 @@
+from microlensing.Util.microlensing_cpu import Microlensing, Library, available_cpus, print_verbose, print_error
+from microlensing.Util.timings import stage
+from microlensing.Stars.star_field import star_field_size
+from microlensing.Util.util import open_array, write_array, write_hist
+from . import polygon
+
+import multiprocessing
+import numpy as np
+import time
+
+
+class CellShooter():
+    '''
+    maps square cells of the image plane grid to the source plane as pairs of
+    triangles and allocates their area among the pixels they cover
+    '''
+
+    # maximum number of cells mapped at once within a band of rows
+    MAX_CELLS = 2**14
+
+    def __init__(self, deflector, ray_half_sep, num_ray_threads, center_x, half_length_x,
+                 center_y, half_length_y, num_pixels_y, write_parities):
+        self.deflector = deflector
+        self.ray_half_sep = ray_half_sep
+        self.num_ray_threads = num_ray_threads
+        self.center_x = center_x
+        self.half_length_x = half_length_x
+        self.center_y = center_y
+        self.half_length_y = half_length_y
+        self.num_pixels_y = num_pixels_y
+        self.write_parities = write_parities
+
+        # area of one triangle in the image plane, in units of the pixel area
+        self.image_plane_area = (2 * ray_half_sep.real * ray_half_sep.imag * num_pixels_y[0] * num_pixels_y[1]
+                                 / (2 * half_length_y.real * 2 * half_length_y.imag))
+
+    def deflect(self, z):
+        return self.deflector.w(z)
+
+    def corners(self, j0: int, j1: int):
+        '''
+        source plane positions of the cell corners for rows [j0, j1) of cells,
+        in pixel coordinates
+
+        :return y: complex array of shape (j1 - j0 + 1, num_ray_threads[0] + 1)
+        '''
+        x1 = (self.center_x.real - self.half_length_x.real
+              + 2 * self.ray_half_sep.real * np.arange(self.num_ray_threads[0] + 1))
+        x2 = (self.center_x.imag - self.half_length_x.imag
+              + 2 * self.ray_half_sep.imag * np.arange(j0, j1 + 1))
+        z = x1[None, :] + 1j * x2[:, None]
+
+        y = self.deflect(z) - self.center_y
+
+        npix1, npix2 = self.num_pixels_y
+        y = ((y.real + self.half_length_y.real) * npix1 / (2 * self.half_length_y.real)
+             + 1j * (y.imag + self.half_length_y.imag) * npix2 / (2 * self.half_length_y.imag))
+        # reverse y coordinate so array forms image in correct orientation
+        return y.real + 1j * (npix2 - y.imag)
+
+    def shoot(self, j0: int, j1: int):
+        '''
+        shoot rows [j0, j1) of cells
+
+        :return pixels: flat (minima, saddles) arrays if write_parities, else a
+                        flat array of the total magnifications
+        '''
+        npix1, npix2 = self.num_pixels_y
+        num_maps = 2 if self.write_parities else 1
+        pixels = np.zeros((num_maps, npix1 * npix2), dtype=np.float64)
+
+        step = max(1, self.MAX_CELLS // self.num_ray_threads[0])
+        for k in range(j0, j1, step):
+            y = self.corners(k, min(k + step, j1))
+
+            # cell corners x[0], x[1], x[2], x[3] are the upper right, upper
+            # left, lower left, and lower right corners
+            y0 = y[1:, 1:]
+            y1 = y[1:, :-1]
+            y2 = y[:-1, :-1]
+            y3 = y[:-1, 1:]
+
+            # if a ray lands on a star, the cell is skipped
+            valid = (np.isfinite(y0) & np.isfinite(y1) & np.isfinite(y2) & np.isfinite(y3)).ravel()
+            y0, y1, y2, y3 = y0.ravel()[valid], y1.ravel()[valid], y2.ravel()[valid], y3.ravel()[valid]
+
+            triangles = np.concatenate((np.stack((y0, y1, y2), axis=1),
+                                        np.stack((y2, y3, y0), axis=1)))
+
+            x, yy = triangles.real, triangles.imag
+            area = ((x[:, 0] * yy[:, 1] - x[:, 1] * yy[:, 0])
+                    + (x[:, 1] * yy[:, 2] - x[:, 2] * yy[:, 1])
+                    + (x[:, 2] * yy[:, 0] - x[:, 0] * yy[:, 2])) / 2
+            use = np.abs(area) < 10000 * self.image_plane_area
+
+            if self.write_parities:
+                parities = [use & (area < 0), use & (area >= 0)]
+            else:
+                parities = [use]
+
+            for i, where in enumerate(parities):
+                if not np.any(where):
+                    continue
+                idx, vals = polygon.allocate_area_among_pixels(triangles[where], self.image_plane_area,
+                                                               self.num_pixels_y)
+                pixels[i] += np.bincount(idx, vals, minlength=npix1 * npix2)
+
+        return pixels
+
+
+_deflector = None
+
+def _init_worker(deflector):
+    global _deflector
+    _deflector = deflector
+
+def _shoot_rows(task):
+    params, j0, j1 = task
+    return CellShooter(_deflector, *params).shoot(j0, j1)
+
+def _histogram(pixels, factor: float, max_rows: int):
+    '''
+    histograms of round(value * factor) and round(log10(value) * factor) of a
+    map, reading max_rows rows at a time so memory mapped maps are never fully
+    loaded
+
+    :return histogram: (values, counts) of the magnifications
+    :return log_histogram: (values, counts) of the log magnifications
+    '''
+    hists = ([], [])
+    with np.errstate(divide='ignore'):
+        for i in range(0, pixels.shape[0], max_rows):
+            chunk = np.asarray(pixels[i: i + max_rows], dtype=np.float64)
+            mags = np.round(chunk * factor)
+            log_mags = np.round(np.log10(chunk) * factor)
+            hists[0].append(np.unique(mags, return_counts=True))
+            hists[1].append(np.unique(log_mags[np.isfinite(log_mags)], return_counts=True))
+
+    result = []
+    for hist in hists:
+        values, inverse = np.unique(np.concatenate([h[0] for h in hist]), return_inverse=True)
+        counts = np.bincount(inverse, np.concatenate([h[1] for h in hist]), minlength=values.size)
+        result.append((values, counts.astype(np.int64)))
+    return result
+
+
+class IPM(Microlensing):
+    '''
+    CPU implementation of the inverse polygon mapping of the CUDA library
+    '''
+
+    def __init__(self, dtype=np.float32):
+        super().__init__(dtype)
+
+        self.light_loss = 0.001
+        self.center_y1 = 0
+        self.center_y2 = 0
+        self.half_length_y1 = 5
+        self.half_length_y2 = 5
+        self.num_pixels_y1 = 1000
+        self.num_pixels_y2 = 1000
+        self.num_rays_y = 1
+        self.write_maps = 1
+        self.write_parities = 0
+        self.write_histograms = 1
+
+        self.num_processes = None
+
+        self.pixels = None
+        self.pixels_minima = None
+        self.pixels_saddles = None
+        self.t_shoot_cells = 0
+        self.tiled = False
+
+        # parameters of the star field and tree kept between run_region calls
+        self._session = None
+        self._session_corner = None
+        self._tree_alpha_error = None
+
+    def check_input_params(self, verbose: int):
+        print_verbose("Checking IPM input parameters...", verbose, 3)
+
+        if not super().check_input_params(verbose):
+            return False
+
+        tiny = np.finfo(self.dtype).tiny
+
+        if self.light_loss < tiny:
+            print_error(f"Error. light_loss must be >= {tiny}")
+            return False
+        elif self.light_loss > 0.01:
+            print_error("Error. light_loss must be <= 0.01")
+            return False
+
+        if self.half_length_y1 < tiny or self.half_length_y2 < tiny:
+            print_error(f"Error. half_length_y1 and half_length_y2 must both be >= {tiny}")
+            return False
+
+        if self.num_pixels_y1 < 1 or self.num_pixels_y2 < 1:
+            print_error("Error. num_pixels_y1 and num_pixels_y2 must both be integers > 0")
+            return False
+
+        if self.num_rays_y < 1:
+            print_error("Error. num_rays_y must be an integer > 0")
+            return False
+
+        for name in ['write_maps', 'write_parities', 'write_histograms']:
+            if getattr(self, name) not in [0, 1]:
+                print_error(f"Error. {name} must be 1 (true) or 0 (false).")
+                return False
+
+        if self.num_processes is not None and self.num_processes < 1:
+            print_error("Error. num_processes must be an integer > 0")
+            return False
+
+        print_verbose("Done checking IPM input parameters.", verbose, 3)
+        return True
+
+    def calculate_derived_params(self, verbose: int):
+        print_verbose("Calculating IPM derived parameters...", verbose, 3)
+
+        if not super().calculate_derived_params(verbose):
+            return False
+
+        tmp_corner = self.calculate_region_params()
+
+        if self.starfile == '':
+            # calculate final number of stars to use and corner of the star field
+            self.num_stars, self.corner = star_field_size(tmp_corner, self.kappa_star, self.theta_star, self.mean_mass,
+                                                          self.rectangular, self.safety_scale)
+        else:
+            # check that the star file actually has a large enough field of stars
+            if not self.rectangular:
+                self.corner = tmp_corner / abs(tmp_corner) * abs(self.corner)
+
+            if not self.covers(tmp_corner):
+                print_error("Error. The provided star field is not large enough to cover the desired source plane region.\n"
+                            "Try decreasing the safety_scale, or providing a larger field of stars.")
+                return False
+
+        if not self.calculate_taylor_smooth():
+            return False
+
+        print_verbose("Done calculating IPM derived parameters.", verbose, 3)
+        return True
+
+    def calculate_region_params(self):
+        '''
+        ray separation, shooting region, and alpha_error for the current
+        source plane region
+
+        :return tmp_corner: corner of the smallest star field centered on the
+                            origin which contains the shooting region
+        '''
+        center_y = complex(self.center_y1, self.center_y2)
+        half_length_y = complex(self.half_length_y1, self.half_length_y2)
+        npix1, npix2 = self.num_pixels_y1, self.num_pixels_y2
+
+        # number density of rays in the lens plane
+        self.num_rays_x = self.num_rays_y * npix1 * npix2 / (2 * half_length_y.real * 2 * half_length_y.imag)
+
+        # average area covered by one ray is 1 / number density. account for
+        # potential rectangular pixels and use half_length
+        self.ray_half_sep = complex(np.sqrt(half_length_y.real / half_length_y.imag * npix2 / npix1),
+                                    np.sqrt(half_length_y.imag / half_length_y.real * npix1 / npix2))
+        self.ray_half_sep /= 2 * np.sqrt(self.num_rays_x)
+
+        self.center_x, self.half_length_x, self.num_ray_threads = self.shooting_region(center_y, half_length_y)
+
+        # error is a circle of radius 1/10 of smallest pixel scale
+        self.alpha_error = min(half_length_y.real / (10 * npix1), half_length_y.imag / (10 * npix2))
+
+        return complex(abs(self.center_x.real) + self.half_length_x.real,
+                       abs(self.center_x.imag) + self.half_length_x.imag)
+
+    def covers(self, tmp_corner: complex):
+        '''
+        whether the star field is large enough for a shooting region
+
+        :param tmp_corner: corner of the smallest star field centered on the
+                           origin which contains the shooting region
+        '''
+        if self.rectangular:
+            return (self.corner.real >= self.safety_scale * tmp_corner.real
+                    and self.corner.imag >= self.safety_scale * tmp_corner.imag)
+        return abs(self.corner) >= self.safety_scale * abs(tmp_corner)
+
+    def shooting_region(self, center_y: complex, half_length_y: complex):
+        '''
+        region of the image plane to shoot cells from for a region of the
+        source plane
+
+        :param center_y: center of the source plane region
+        :param half_length_y: half lengths of the source plane region
+        :return center_x: center of the image plane region
+        :return half_length_x: half lengths of the image plane region
+        :return num_ray_threads: number of cells along each axis
+        '''
+        # shooting region is greater than outer boundary for macro-mapping by
+        # the size of the region of images visible for a macro-image which on
+        # average loses no more than the desired amount of flux
+        half_length_x = half_length_y + (self.theta_star * np.sqrt(self.kappa_star * self.mean_mass2
+                                                                   / (self.mean_mass * self.light_loss))
+                                         * complex(1, 1))
+        half_length_x = complex(half_length_x.real / abs(1 - self.kappa_tot + self.shear),
+                                half_length_x.imag / abs(1 - self.kappa_tot - self.shear))
+        # make shooting region a multiple of the ray separation
+        num_ray_threads = (int(half_length_x.real / (2 * self.ray_half_sep.real)) + 1,
+                           int(half_length_x.imag / (2 * self.ray_half_sep.imag)) + 1)
+        half_length_x = complex(2 * self.ray_half_sep.real * num_ray_threads[0],
+                                2 * self.ray_half_sep.imag * num_ray_threads[1])
+        num_ray_threads = (2 * num_ray_threads[0], 2 * num_ray_threads[1])
+
+        center_x = complex(center_y.real / (1 - self.kappa_tot + self.shear),
+                           center_y.imag / (1 - self.kappa_tot - self.shear))
+
+        return center_x, half_length_x, num_ray_threads
+
+    def _pool(self):
+        '''
+        pool of worker processes holding the deflector, or None if cells are
+        shot in this process
+        '''
+        num_processes = self.num_processes or available_cpus()
+        if num_processes == 1:
+            return None
+        return multiprocessing.Pool(num_processes, initializer=_init_worker, initargs=(self.deflector,))
+
+    def shoot_region(self, center_y: complex, half_length_y: complex, num_pixels_y, pool=None, verbose: int = 0):
+        '''
+        shoot cells for a region of the source plane with the current star
+        field and tree
+
+        :param center_y: center of the region
+        :param half_length_y: half lengths of the region
+        :param num_pixels_y: (num_pixels_y1, num_pixels_y2) of the region
+        :param pool: pool of worker processes from _pool, if any
+        :param verbose: verbosity level of messages
+        :return pixels: array of shape (2, num_pixels_y2, num_pixels_y1) of the
+                        (minima, saddles) magnifications if write_parities,
+                        else of shape (1, num_pixels_y2, num_pixels_y1) of the
+                        total magnifications
+        '''
+        center_x, half_length_x, num_ray_threads = self.shooting_region(center_y, half_length_y)
+        params = (self.ray_half_sep, num_ray_threads, center_x, half_length_x,
+                  center_y, half_length_y, tuple(num_pixels_y), self.write_parities)
+
+        num_processes = self.num_processes or available_cpus()
+        num_rows = num_ray_threads[1]
+
+        # several bands of rows per process balances the load, while each band
+        # only returns its partial maps once
+        num_tasks = min(num_rows, 4 * num_processes)
+        edges = np.linspace(0, num_rows, num_tasks + 1).astype(int)
+        tasks = [(params, j0, j1) for j0, j1 in zip(edges[:-1], edges[1:])]
+
+        if pool is None:
+            shooter = CellShooter(self.deflector, *params)
+            results = (shooter.shoot(j0, j1) for _, j0, j1 in tasks)
+        else:
+            results = pool.imap_unordered(_shoot_rows, tasks)
+
+        pixels = 0
+        for i, result in enumerate(results):
+            pixels = pixels + result
+            if verbose >= 1:
+                print(f"\r{100 * (i + 1) // len(tasks)}% complete", end='', flush=True)
+
+        return pixels.reshape(-1, num_pixels_y[1], num_pixels_y[0])
+
+    def shoot_cells(self, verbose: int):
+        print_verbose("Shooting cells...", verbose, 1)
+        t0 = time.perf_counter()
+
+        pool = self._pool()
+        try:
+            pixels = self.shoot_region(complex(self.center_y1, self.center_y2),
+                                       complex(self.half_length_y1, self.half_length_y2),
+                                       (self.num_pixels_y1, self.num_pixels_y2), pool, verbose)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.t_shoot_cells = time.perf_counter() - t0
+        self.timings['shoot_cells'] = self.t_shoot_cells
+        print_verbose(f"\nDone shooting cells. Elapsed time: {self.t_shoot_cells} seconds.", verbose, 1)
+
+        if self.write_parities:
+            self.pixels_minima = pixels[0].astype(self.dtype)
+            self.pixels_saddles = pixels[1].astype(self.dtype)
+            self.pixels = self.pixels_minima + self.pixels_saddles
+        else:
+            self.pixels_minima = None
+            self.pixels_saddles = None
+            self.pixels = pixels[0].astype(self.dtype)
+
+        return True
+
+    def map_fnames(self):
+        '''
+        names of the magnification map files, keyed by parity suffix
+        '''
+        keys = ['', '_minima', '_saddles'] if self.write_parities else ['']
+        return {key: f"{self.outfile_prefix}ipm_magnifications{key}.bin" for key in keys}
+
+    def tile_params(self, tile_num_pixels: int):
+        '''
+        parameters which determine a tiled map, as recorded in its progress
+        file: those of the star field and tree, and those of the region
+        '''
+        names = ['dtype', 'kappa_tot', 'shear', 'kappa_star', 'theta_star', 'mass_function', 'm_solar', 'm_lower',
+                 'm_upper', 'light_loss', 'rectangular', 'approx', 'safety_scale', 'starfile', 'random_seed']
+        params = dict(zip(names, self.session_params()))
+        params['dtype'] = np.dtype(params['dtype']).name
+        params['starfile'] = params['starfile'] or '-'
+        params.update({'center_y1': self.center_y1, 'center_y2': self.center_y2,
+                       'half_length_y1': self.half_length_y1, 'half_length_y2': self.half_length_y2,
+                       'num_pixels_y1': self.num_pixels_y1, 'num_pixels_y2': self.num_pixels_y2,
+                       'num_rays_y': self.num_rays_y, 'write_parities': self.write_parities,
+                       'tile_num_pixels': tile_num_pixels})
+        return params
+
+    def _read_tile_progress(self, fname: str, tile_num_pixels: int, verbose: int):
+        '''
+        tiles already completed according to a progress file, or None if the
+        file does not exist or belongs to a different map
+        '''
+        try:
+            with open(fname) as f:
+                lines = [line.strip().partition(' ') for line in f if line.strip()]
+        except OSError:
+            return None
+
+        params = {key: value for key, _, value in lines}
+        expected = self.tile_params(tile_num_pixels)
+        # a random star field is generated again from the recorded seed
+        if self.starfile != '' or self.random_seed == 0:
+            del expected['random_seed']
+        for key, value in expected.items():
+            if key not in params:
+                changed = True
+            elif isinstance(value, str):
+                changed = params[key] != value
+            else:
+                try:
+                    changed = not np.isclose(float(params[key]), value, rtol=1e-8, atol=0)
+                except ValueError:
+                    changed = True
+            if changed:
+                print_verbose(f"{key} differs from {fname}. Discarding the completed tiles.", verbose, 1)
+                return None
+
+        for fname in self.map_fnames().values():
+            try:
+                if open_array(fname, self.dtype).shape != (self.num_pixels_y2, self.num_pixels_y1):
+                    return None
+            except (OSError, ValueError):
+                return None
+
+        if self.starfile == '':
+            self.random_seed = int(params['random_seed'])
+        return {tuple(int(x) for x in value.split()) for key, _, value in lines if key == 'tile'}
+
+    def run_tiled(self, tile_num_pixels: int, verbose: int):
+        '''
+        shoot cells for the map one tile at a time, with a single star field
+        and tree, streaming each tile into memory mapped map files at the usual
+        output locations. completed tiles are recorded in
+        {outfile_prefix}ipm_tiles.txt, and are skipped when an interrupted run
+        is restarted with the same parameters
+
+        :param tile_num_pixels: number of pixels along each side of a tile.
+                                tiles should be large compared to the size of
+                                the region lost to light_loss, which is
+                                shot around every tile
+        :param verbose: verbosity level of messages
+        '''
+        if tile_num_pixels < 1:
+            print_error("Error. tile_num_pixels must be an integer > 0")
+            return False
+
+        self._session = None
+        self.timings = {}
+        if not self.check_input_params(verbose):
+            return False
+        if not self.calculate_derived_params(verbose):
+            return False
+
+        fname_progress = f"{self.outfile_prefix}ipm_tiles.txt"
+        shape = (self.num_pixels_y2, self.num_pixels_y1)
+        done = self._read_tile_progress(fname_progress, tile_num_pixels, verbose)
+
+        if not self.populate_star_array(verbose):
+            return False
+        if not self.create_tree(verbose):
+            return False
+        self._tree_alpha_error = self.alpha_error
+        self._session_corner = complex(abs(self.center_x.real) + self.half_length_x.real,
+                                       abs(self.center_x.imag) + self.half_length_x.imag)
+        self._session = self.session_params()
+
+        if done is None:
+            done = set()
+            maps = {key: open_array(fname, self.dtype, 'w+', shape) for key, fname in self.map_fnames().items()}
+            with open(fname_progress, 'w') as f:
+                for key, value in self.tile_params(tile_num_pixels).items():
+                    f.write(f"{key} {value}\n" if isinstance(value, str) else f"{key} {value:.17g}\n")
+        else:
+            print_verbose(f"Resuming from {len(done)} completed tiles in {fname_progress}", verbose, 1)
+            maps = {key: open_array(fname, self.dtype, 'r+') for key, fname in self.map_fnames().items()}
+
+        pixel_scale = complex(2 * self.half_length_y1 / self.num_pixels_y1,
+                              2 * self.half_length_y2 / self.num_pixels_y2)
+        tiles = [(row0, col0)
+                 for row0 in range(0, self.num_pixels_y2, tile_num_pixels)
+                 for col0 in range(0, self.num_pixels_y1, tile_num_pixels)]
+
+        print_verbose("Shooting cells...", verbose, 1)
+        t0 = time.perf_counter()
+
+        pool = self._pool()
+        try:
+            for i, (row0, col0) in enumerate(tiles):
+                if (row0, col0) in done:
+                    continue
+
+                row1 = min(row0 + tile_num_pixels, self.num_pixels_y2)
+                col1 = min(col0 + tile_num_pixels, self.num_pixels_y1)
+
+                # rows of the map run from the top of the region to the bottom
+                center_y = complex(self.center_y1 - self.half_length_y1 + (col0 + col1) / 2 * pixel_scale.real,
+                                   self.center_y2 + self.half_length_y2 - (row0 + row1) / 2 * pixel_scale.imag)
+                half_length_y = complex((col1 - col0) / 2 * pixel_scale.real, (row1 - row0) / 2 * pixel_scale.imag)
+
+                pixels = self.shoot_region(center_y, half_length_y, (col1 - col0, row1 - row0), pool)
+                if self.write_parities:
+                    maps['_minima'][row0: row1, col0: col1] = pixels[0]
+                    maps['_saddles'][row0: row1, col0: col1] = pixels[1]
+                    maps[''][row0: row1, col0: col1] = (pixels[0].astype(self.dtype)
+                                                        + pixels[1].astype(self.dtype))
+                else:
+                    maps[''][row0: row1, col0: col1] = pixels[0]
+
+                # a tile only counts as done once its pixels are on disk
+                for arr in maps.values():
+                    arr.flush()
+                with open(fname_progress, 'a') as f:
+                    f.write(f"tile {row0} {col0}\n")
+
+                if verbose >= 1:
+                    print(f"\r{i + 1} of {len(tiles)} tiles complete", end='', flush=True)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.t_shoot_cells = time.perf_counter() - t0
+        self.timings['shoot_cells'] = self.t_shoot_cells
+        print_verbose(f"\nDone shooting cells. Elapsed time: {self.t_shoot_cells} seconds.", verbose, 1)
+
+        del maps
+        fnames = self.map_fnames()
+        self.pixels = open_array(fnames[''], self.dtype)
+        if self.write_parities:
+            self.pixels_minima = open_array(fnames['_minima'], self.dtype)
+            self.pixels_saddles = open_array(fnames['_saddles'], self.dtype)
+        else:
+            self.pixels_minima = None
+            self.pixels_saddles = None
+        self.tiled = True
+
+        if not self.create_histograms(verbose):
+            return False
+        return True
+
+    def create_histograms(self, verbose: int):
+        if not self.write_histograms:
+            return True
+
+        print_verbose("Creating histograms...", verbose, 2)
+
+        # histograms are of the value * 1000 (i.e., accurate to 3 decimals)
+        factor = 1000
+        # rows read at a time, so memory mapped maps are not loaded at once
+        max_rows = max(1, 2**24 // self.num_pixels_y1)
+
+        maps = {'': self.pixels}
+        if self.write_parities:
+            maps['_minima'] = self.pixels_minima
+            maps['_saddles'] = self.pixels_saddles
+
+        mu_min_theory = 1 / (1 - self.kappa_tot + self.kappa_star)**2
+        for key, pixels in maps.items():
+            if key != '_saddles' and self.mu_ave > 1:
+                mu_min_actual = np.round(np.min(pixels) * factor) / factor
+                if mu_min_actual < mu_min_theory:
+                    parity = " positive parity" if key == '_minima' else ""
+                    print_error(f"Warning. Minimum{parity} magnification after shooting cells is less than the theoretical minimum.\n"
+                                f"   mu_min_actual = {mu_min_actual}\n"
+                                f"   mu_min_theory = 1 / (1 - (kappa_tot - kappa_star))^2\n"
+                                f"                 = 1 / (1 - ({self.kappa_tot} - {self.kappa_star}))^2 = {mu_min_theory}")
+
+        self.histograms = {}
+        self.log_histograms = {}
+        with stage(self.timings, 'create_histograms'):
+            for key, pixels in maps.items():
+                self.histograms[key], self.log_histograms[key] = _histogram(pixels, factor, max_rows)
+
+        print_verbose("Done creating histograms.", verbose, 2)
+        return True
+
+    def write_files(self, verbose: int):
+        if not super().write_files(verbose, 'ipm'):
+            return False
+
+        print_verbose("Writing IPM parameter info...", verbose, 2)
+        fname = f"{self.outfile_prefix}ipm_parameter_info.txt"
+        with open(fname, 'a') as f:
+            f.write(f"light_loss {self.light_loss:.9g}\n")
+            f.write(f"center_y1 {self.center_y1:.9g}\n")
+            f.write(f"center_y2 {self.center_y2:.9g}\n")
+            f.write(f"half_length_y1 {self.half_length_y1:.9g}\n")
+            f.write(f"half_length_y2 {self.half_length_y2:.9g}\n")
+            f.write(f"num_pixels_y1 {self.num_pixels_y1}\n")
+            f.write(f"num_pixels_y2 {self.num_pixels_y2}\n")
+            f.write(f"center_x1 {self.center_x.real:.9g}\n")
+            f.write(f"center_x2 {self.center_x.imag:.9g}\n")
+            f.write(f"half_length_x1 {self.half_length_x.real:.9g}\n")
+            f.write(f"half_length_x2 {self.half_length_x.imag:.9g}\n")
+            f.write(f"num_rays_y {self.num_rays_y}\n")
+            f.write(f"num_rays_x {self.num_rays_x:.9g}\n")
+            f.write(f"ray_half_sep_1 {self.ray_half_sep.real:.9g}\n")
+            f.write(f"ray_half_sep_2 {self.ray_half_sep.imag:.9g}\n")
+            f.write(f"num_ray_threads_1 {self.num_ray_threads[0]}\n")
+            f.write(f"num_ray_threads_2 {self.num_ray_threads[1]}\n")
+            f.write(f"t_shoot_cells {self.t_shoot_cells:.9g}\n")
+        print_verbose(f"Done writing IPM parameter info to file {fname}", verbose, 1)
+
+        if self.write_histograms:
+            print_verbose("Writing magnification histograms...", verbose, 2)
+            for key in self.histograms.keys():
+                for name, hist in [('mags', self.histograms[key]), ('log_mags', self.log_histograms[key])]:
+                    fname = f"{self.outfile_prefix}ipm_{name}_numpixels{key}.txt"
+                    write_hist(fname, *hist)
+                    print_verbose(f"Done writing magnification histogram to file {fname}", verbose, 1)
+
+        # tiled runs write the maps as they go
+        if self.write_maps and not self.tiled:
+            print_verbose("Writing magnifications...", verbose, 2)
+            maps = {'': self.pixels}
+            if self.write_parities:
+                maps['_minima'] = self.pixels_minima
+                maps['_saddles'] = self.pixels_saddles
+            for key, pixels in maps.items():
+                fname = f"{self.outfile_prefix}ipm_magnifications{key}.bin"
+                write_array(fname, pixels, self.dtype)
+                print_verbose(f"Done writing magnifications to file {fname}", verbose, 1)
+
+        return True
+
+    def session_params(self):
+        '''
+        parameters which determine the star field and tree, apart from the
+        region they were made for
+        '''
+        return (self.dtype, self.kappa_tot, self.shear, self.kappa_star, self.theta_star, self.mass_function,
+                self.m_solar, self.m_lower, self.m_upper, self.light_loss, self.rectangular, self.approx,
+                self.safety_scale, self.starfile, self.random_seed)
+
+    def create_session(self, verbose: int):
+        '''
+        generate the star field and tree for the current region, and keep them
+        for later calls of run_region
+        '''
+        self._session = None
+        self.timings = {}
+        if not self.check_input_params(verbose):
+            return False
+        if not self.calculate_derived_params(verbose):
+            return False
+        if not self.populate_star_array(verbose):
+            return False
+        if not self.create_tree(verbose):
+            return False
+        self._tree_alpha_error = self.alpha_error
+        self._session_corner = complex(abs(self.center_x.real) + self.half_length_x.real,
+                                       abs(self.center_x.imag) + self.half_length_x.imag)
+        self._session = self.session_params()
+        return True
+
+    def run_region(self, center_y1: float, center_y2: float, half_length_y1: float, half_length_y2: float,
+                   num_pixels_y1: int, num_pixels_y2: int, verbose: int):
+        '''
+        shoot cells for a region of the source plane with the star field and
+        tree of the previous run, so that only the cells are shot. the star
+        field and tree are generated first if there are none yet, or if any of
+        the parameters they depend on changed, for the region set at that time.
+        the star field must be large enough for the shooting region of the
+        new region. the tree is recalculated only if the new region needs a
+        smaller alpha_error
+        '''
+        if self._session is None or self._session != self.session_params():
+            if not self.create_session(verbose):
+                return False
+        else:
+            self.timings = {}
+
+        self.center_y1 = center_y1
+        self.center_y2 = center_y2
+        self.half_length_y1 = half_length_y1
+        self.half_length_y2 = half_length_y2
+        self.num_pixels_y1 = num_pixels_y1
+        self.num_pixels_y2 = num_pixels_y2
+        if not self.check_input_params(verbose):
+            return False
+
+        tmp_corner = self.calculate_region_params()
+        # regions within the one the star field was generated for are covered
+        # as well, up to the rounding of their shooting regions to whole cells
+        slack = 2 * self.ray_half_sep
+        if self.rectangular:
+            within = (tmp_corner.real <= self._session_corner.real + slack.real
+                      and tmp_corner.imag <= self._session_corner.imag + slack.imag)
+        else:
+            within = abs(tmp_corner) <= abs(self._session_corner) + abs(slack)
+        if not (within or self.covers(tmp_corner)):
+            print_error("Error. The star field is not large enough to cover the desired source plane region.\n"
+                        "Try increasing the safety_scale, or the region the star field is generated for.")
+            return False
+
+        if self.alpha_error < self._tree_alpha_error:
+            print_verbose("Region requires a smaller alpha_error. Recalculating tree.", verbose, 1)
+            if not self.calculate_taylor_smooth():
+                return False
+            if not self.create_tree(verbose):
+                return False
+            self._tree_alpha_error = self.alpha_error
+        else:
+            # the tree is as accurate as it was calculated to be
+            self.alpha_error = self._tree_alpha_error
+
+        self.tiled = False
+        if not self.shoot_cells(verbose):
+            return False
+        if not self.create_histograms(verbose):
+            return False
+        return True
+
+    def run(self, verbose: int):
+        if not self.create_session(verbose):
+            return False
+        self.tiled = False
+        if not self.shoot_cells(verbose):
+            return False
+        if not self.create_histograms(verbose):
+            return False
+        return True
+
+    def save(self, verbose: int):
+        with stage(self.timings, 'write_files'):
+            return self.write_files(verbose)
+
+
+lib = Library(IPM, np.float32)
+lib_double = Library(IPM, np.float64)
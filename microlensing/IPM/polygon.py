@@ -0,0 +1,191 @@
+import numpy as np
+
+
+def area(x, y, count):
+    '''
+    calculate the signed areas of a batch of polygons using the shoelace formula
+
+    :param x: x coordinates of the vertices, of shape (n, k). the vertices of
+              each polygon are packed at the start of its row
+    :param y: y coordinates of the vertices, of shape (n, k)
+    :param count: number of vertices in each polygon, of shape (n,)
+    :return area: signed area of each polygon
+    '''
+    k = x.shape[1]
+    idx = np.arange(k)
+    nxt = (idx + 1) % np.maximum(count, 1)[:, None]
+    valid = idx < count[:, None]
+
+    terms = x * np.take_along_axis(y, nxt, 1) - np.take_along_axis(x, nxt, 1) * y
+    return np.sum(terms, axis=1, where=valid) / 2
+
+def clip(x, y, count, value, along_x: bool, keep_greater: bool):
+    '''
+    clip a batch of convex polygons along a vertical or horizontal line, one
+    step of the Sutherland-Hodgman algorithm
+
+    :param x: x coordinates of the vertices, of shape (n, k)
+    :param y: y coordinates of the vertices, of shape (n, k)
+    :param count: number of vertices in each polygon, of shape (n,)
+    :param value: x or y value of the line for each polygon, of shape (n,)
+    :param along_x: whether the line is vertical (x = value) or horizontal
+    :param keep_greater: whether to keep the region above or below the line
+    :return x, y, count: vertices of the clipped polygons
+    '''
+    n, k = x.shape
+    idx = np.arange(k)
+    nxt = (idx + 1) % np.maximum(count, 1)[:, None]
+    valid = idx < count[:, None]
+    value = np.asarray(value, dtype=x.dtype).reshape(-1, 1)
+
+    x_next = np.take_along_axis(x, nxt, 1)
+    y_next = np.take_along_axis(y, nxt, 1)
+
+    if along_x:
+        c, c_next = x, x_next
+    else:
+        c, c_next = y, y_next
+
+    if keep_greater:
+        inside = c >= value
+        inside_next = c_next >= value
+    else:
+        inside = c <= value
+        inside_next = c_next <= value
+
+    keep_vertex = inside & valid
+    keep_crossing = (inside != inside_next) & valid
+
+    denom = np.where(keep_crossing, c_next - c, 1)
+    t = np.where(keep_crossing, (value - c) / denom, 0)
+    if along_x:
+        x_cross = np.broadcast_to(value, x.shape)
+        y_cross = y + t * (y_next - y)
+    else:
+        x_cross = x + t * (x_next - x)
+        y_cross = np.broadcast_to(value, y.shape)
+
+    # vertex i is followed by the intersection of edge (i, i + 1), if any
+    x_out = np.stack((x, x_cross), axis=2).reshape(n, 2 * k)
+    y_out = np.stack((y, y_cross), axis=2).reshape(n, 2 * k)
+    keep = np.stack((keep_vertex, keep_crossing), axis=2).reshape(n, 2 * k)
+
+    # pack the kept vertices at the start of each row
+    position = np.cumsum(keep, axis=1)
+    count = position[:, -1]
+    width = max(1, int(count.max(initial=0)))
+    dest = (np.arange(n)[:, None] * width + position - 1)[keep]
+
+    x_packed = np.zeros((n, width), dtype=x.dtype)
+    y_packed = np.zeros((n, width), dtype=y.dtype)
+    x_packed.ravel()[dest] = x_out[keep]
+    y_packed.ravel()[dest] = y_out[keep]
+
+    return x_packed, y_packed, count
+
+def _expand(lower, upper):
+    '''
+    expand integer ranges [lower, upper] into (owner, value) pairs
+
+    :param lower: inclusive lower bounds, of shape (n,)
+    :param upper: inclusive upper bounds, of shape (n,)
+    :return owner: index of the range each pair belongs to
+    :return value: integer value of each pair
+    '''
+    lengths = upper - lower + 1
+    owner = np.repeat(np.arange(lengths.size), lengths)
+    starts = np.cumsum(lengths) - lengths
+    value = np.arange(owner.size) - starts[owner] + lower[owner]
+    return owner, value
+
+def _batches(lengths, max_pairs: int):
+    '''
+    split consecutive items into batches whose summed lengths are at most
+    max_pairs (or a single item, if it alone exceeds max_pairs)
+    '''
+    ends = np.cumsum(lengths)
+    i = 0
+    while i < lengths.size:
+        j = max(i + 1, int(np.searchsorted(ends, (ends[i - 1] if i > 0 else 0) + max_pairs, side='right')))
+        yield i, j
+        i = j
+
+def allocate_area_among_pixels(points, factor: float, num_pixels, max_pairs: int = 2**20):
+    '''
+    allocate the area of a batch of triangles among the pixels they overlap.
+    each pixel receives factor * (overlapping area / triangle area)
+
+    :param points: complex triangle vertices in pixel coordinates, of shape
+                   (n, 3)
+    :param factor: total value to distribute for each triangle
+    :param num_pixels: (num_pixels_y1, num_pixels_y2) of the pixel array
+    :param max_pairs: maximum number of (polygon, pixel) pairs clipped at once
+    :return pixel_index: flat indices into the (num_pixels_y2, num_pixels_y1)
+                         pixel array
+    :return values: values to add to the corresponding pixels
+    '''
+    npix1, npix2 = num_pixels
+
+    x = np.ascontiguousarray(points.real, dtype=np.float64)
+    y = np.ascontiguousarray(points.imag, dtype=np.float64)
+    count = np.full(x.shape[0], 3)
+
+    xmin, xmax = x.min(axis=1), x.max(axis=1)
+    ymin, ymax = y.min(axis=1), y.max(axis=1)
+
+    whole_area = np.abs(area(x, y, count))
+
+    # skip degenerate triangles and those entirely outside the pixel region
+    use = ((whole_area > 0) & np.isfinite(whole_area)
+           & (xmin < npix1) & (xmax > 0) & (ymin < npix2) & (ymax > 0))
+    x, y, count, whole_area = x[use], y[use], count[use], whole_area[use]
+    xmin, xmax, ymin, ymax = xmin[use], xmax[use], ymin[use], ymax[use]
+
+    col0 = np.maximum(np.floor(xmin), 0).astype(np.int64)
+    col1 = np.minimum(np.ceil(xmax) - 1, npix1 - 1).astype(np.int64)
+    row0 = np.maximum(np.floor(ymin), 0).astype(np.int64)
+    row1 = np.minimum(np.ceil(ymax) - 1, npix2 - 1).astype(np.int64)
+
+    pixel_index = []
+    values = []
+
+    # triangles entirely within a single pixel need no clipping
+    single = ((col0 == col1) & (row0 == row1) & (xmin >= 0) & (xmax <= npix1)
+              & (ymin >= 0) & (ymax <= npix2))
+    pixel_index.append(npix1 * row0[single] + col0[single])
+    values.append(np.full(np.count_nonzero(single), factor, dtype=np.float64))
+
+    multi = ~single
+    x, y, count, whole_area = x[multi], y[multi], count[multi], whole_area[multi]
+    col0, col1, row0, row1 = col0[multi], col1[multi], row0[multi], row1[multi]
+    weight = factor / whole_area
+
+    # first clip triangles into vertical strips one pixel wide, then clip the
+    # strips into pixels, so that only pixels the triangles overlap are visited
+    for i, j in _batches(col1 - col0 + 1, max_pairs):
+        tri, col = _expand(col0[i: j], col1[i: j])
+        tri += i
+
+        sx, sy, sc = clip(x[tri], y[tri], count[tri], col, True, True)
+        sx, sy, sc = clip(sx, sy, sc, col + 1, True, False)
+
+        valid = np.arange(sx.shape[1]) < sc[:, None]
+        strip_ymin = np.min(sy, axis=1, where=valid, initial=np.inf)
+        strip_ymax = np.max(sy, axis=1, where=valid, initial=-np.inf)
+        use = (sc >= 3) & (strip_ymin < npix2) & (strip_ymax > 0)
+        tri, col, sx, sy, sc = tri[use], col[use], sx[use], sy[use], sc[use]
+        strip_row0 = np.maximum(np.floor(strip_ymin[use]), 0).astype(np.int64)
+        strip_row1 = np.minimum(np.ceil(strip_ymax[use]) - 1, npix2 - 1).astype(np.int64)
+        strip_row1 = np.maximum(strip_row0, strip_row1)
+
+        for k, l in _batches(strip_row1 - strip_row0 + 1, max_pairs):
+            strip, row = _expand(strip_row0[k: l], strip_row1[k: l])
+            strip += k
+
+            px, py, pc = clip(sx[strip], sy[strip], sc[strip], row, False, True)
+            px, py, pc = clip(px, py, pc, row + 1, False, False)
+
+            pixel_index.append(npix1 * row + col[strip])
+            values.append(np.abs(area(px, py, pc)) * weight[tri[strip]])
+
+    return np.concatenate(pixel_index), np.concatenate(values)
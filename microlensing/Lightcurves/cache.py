@@ -0,0 +1,173 @@
+try:
+    import cupy as np
+except ImportError:
+    import numpy as np
+
+from collections import OrderedDict
+import hashlib
+import os
+
+import numpy
+
+
+def array_hash(arr):
+    '''
+    hash of the shape, dtype, and contents of an array
+
+    :param arr: numpy or cupy array
+    :return hash: hex digest
+    '''
+    try:
+        arr = arr.get()
+    except AttributeError:
+        arr = numpy.asarray(arr)
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((arr.shape, arr.dtype.str)).encode())
+    h.update(numpy.ascontiguousarray(arr).data)
+    return h.hexdigest()
+
+def _read_only(arr):
+    '''
+    mark an array as read-only, so that callers cannot modify a map that later
+    hits of the cache return. cupy arrays have no such flag
+    '''
+    if hasattr(arr, 'setflags'):
+        arr.setflags(write=False)
+    return arr
+
+
+class ConvolvedMapCache():
+    '''
+    cache of magnification maps cross correlated with source profiles, keyed by
+    a hash of the map, the kernel, and its weight. maps are kept in memory up
+    to a number of bytes, evicting the least recently used first. evicted maps
+    are written to spill_dir if provided, and read back on a later request
+    '''
+
+    def __init__(self, max_bytes: int = 2**30, spill_dir: str = None):
+        '''
+        :param max_bytes: maximum number of bytes of convolved maps held in memory
+        :param spill_dir: directory to write evicted maps to. if None, evicted
+                          maps are discarded
+        '''
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+
+        self._maps = OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        if value < 0:
+            raise ValueError("max_bytes must be >= 0")
+        self._max_bytes = value
+
+    @property
+    def stats(self):
+        '''
+        hit and miss counts of the cache, and its current size
+        '''
+        requests = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.disk_hits) / requests if requests > 0 else 0,
+                'num_maps': len(self._maps),
+                'nbytes': self.nbytes}
+
+    def key(self, values, kernel, weight):
+        '''
+        :param values: magnification map
+        :param kernel: 2D kernel of the source profile
+        :param weight: sum of the kernel
+        :return key: hash identifying the convolved map
+        '''
+        return f"{array_hash(values)}-{array_hash(kernel)}-{float(weight)!r}"
+
+    def _spill_fname(self, key: str):
+        return os.path.join(self.spill_dir, f"convolved_map_{key}.npy")
+
+    def get(self, values, kernel, weight, convolve, key: str = None):
+        '''
+        return the convolved map, calculating it on a miss
+
+        :param values: magnification map
+        :param kernel: 2D kernel of the source profile
+        :param weight: sum of the kernel
+        :param convolve: function of (values, kernel, weight) that calculates
+                         the convolved map
+        :param key: key of the convolved map, if already known
+        :return convolved: convolved map, which is shared with later hits of
+                           the cache. numpy maps are read-only, and cupy maps
+                           must not be modified in place
+        '''
+        if key is None:
+            key = self.key(values, kernel, weight)
+
+        if key in self._maps:
+            self._maps.move_to_end(key)
+            self.hits += 1
+            return self._maps[key]
+
+        if self.spill_dir is not None and os.path.exists(self._spill_fname(key)):
+            self.disk_hits += 1
+            convolved = np.asarray(numpy.load(self._spill_fname(key)))
+        else:
+            self.misses += 1
+            convolved = convolve(values, kernel, weight)
+        convolved = _read_only(convolved)
+
+        self._insert(key, convolved)
+        return convolved
+
+    def _insert(self, key: str, convolved):
+        if convolved.nbytes > self.max_bytes:
+            self._spill(key, convolved)
+            return
+
+        self._maps[key] = convolved
+        self.nbytes += convolved.nbytes
+        while self.nbytes > self.max_bytes:
+            old_key, old = self._maps.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+            self._spill(old_key, old)
+
+    def _spill(self, key: str, convolved):
+        if self.spill_dir is None:
+            return
+        fname = self._spill_fname(key)
+        if os.path.exists(fname):
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        try:
+            convolved = convolved.get()
+        except AttributeError:
+            pass
+        # write then rename, so an interrupted write is never read back
+        numpy.save(fname + ".tmp.npy", convolved)
+        os.replace(fname + ".tmp.npy", fname)
+
+    def clear(self, disk: bool = False):
+        '''
+        remove all maps held in memory, and optionally those spilled to disk
+
+        :param disk: whether to also remove spilled maps
+        '''
+        self._maps.clear()
+        self.nbytes = 0
+        if disk and self.spill_dir is not None and os.path.isdir(self.spill_dir):
+            for fname in os.listdir(self.spill_dir):
+                if fname.startswith("convolved_map_") and fname.endswith(".npy"):
+                    os.remove(os.path.join(self.spill_dir, fname))
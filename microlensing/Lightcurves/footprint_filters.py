@@ -0,0 +1,188 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+'''
+minimum and maximum filters over arbitrary footprints for the CPU. the
+footprint is decomposed into runs of consecutive pixels within each of its
+rows. a 1D running minimum (or maximum) of each distinct run length is
+calculated once along the rows of the map with the van Herk/Gil-Werman
+algorithm, which takes 3 comparisons per pixel regardless of the length.
+the filter is then the minimum over the runs of the shifted running minima,
+so the cost is O(pixels * kernel_height) rather than O(pixels * kernel_area).
+for a disk every row is a single run, and there are at most kernel_height
+distinct lengths. the runs are grouped by length, and each running minimum is
+folded into the filter and dropped before the next is calculated, so the
+memory does not grow with the number of lengths
+'''
+
+
+def footprint_runs(footprint):
+    '''
+    decompose a 2D footprint into runs of consecutive nonzero pixels within
+    each row
+
+    :param footprint: 2D array, nonzero where the footprint is
+    :return runs: list of (row, start column, length) of every run
+    '''
+    footprint = np.asarray(footprint) != 0
+    if footprint.ndim != 2:
+        raise ValueError("footprint must be a 2D array")
+
+    runs = []
+    for row in range(footprint.shape[0]):
+        # starts and ends of runs are where the row changes value
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], footprint[row].astype(np.int8), [0]))))
+        for start, end in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+            runs.append((row, start, end - start))
+    return runs
+
+def _running_extremum(values, length: int, minimum: bool):
+    '''
+    running minimum or maximum along the last axis of a 2D array over windows
+    of a given length, with the van Herk/Gil-Werman algorithm
+
+    :param values: 2D array
+    :param length: length of the windows
+    :param minimum: whether to take the minimum or the maximum
+    :return result: array of shape (values.shape[0], values.shape[1] - length + 1),
+                    where result[i, j] is the extremum of values[i, j: j + length]
+    '''
+    func = np.minimum if minimum else np.maximum
+    if length == 1:
+        return values.copy()
+
+    n = values.shape[1]
+    num_blocks = -(-n // length)
+    if np.issubdtype(values.dtype, np.floating):
+        fill = np.inf if minimum else -np.inf
+    else:
+        fill = np.iinfo(values.dtype).max if minimum else np.iinfo(values.dtype).min
+
+    blocks = np.full((values.shape[0], num_blocks * length), fill, dtype=values.dtype)
+    blocks[:, :n] = values
+    blocks = blocks.reshape(values.shape[0], num_blocks, length)
+
+    # extremum from the start of each block, and to the end of each block
+    prefix = func.accumulate(blocks, axis=2).reshape(values.shape[0], -1)
+    suffix = func.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(values.shape[0], -1)
+
+    # a window starting at j covers the end of the block containing j and
+    # the start of the next one
+    num_windows = n - length + 1
+    return func(suffix[:, :num_windows], prefix[:, length - 1: length - 1 + num_windows])
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _running_extremum_numba(values, length, minimum):
+        num_rows, n = values.shape
+        num_windows = n - length + 1
+        result = np.empty((num_rows, num_windows), dtype=values.dtype)
+        for i in numba.prange(num_rows):
+            prefix = np.empty(n, dtype=values.dtype)
+            suffix = np.empty(n, dtype=values.dtype)
+            for j in range(n):
+                if j % length == 0 or (values[i, j] < prefix[j - 1]) == minimum:
+                    prefix[j] = values[i, j]
+                else:
+                    prefix[j] = prefix[j - 1]
+            for j in range(n - 1, -1, -1):
+                if j == n - 1 or (j + 1) % length == 0 or (values[i, j] < suffix[j + 1]) == minimum:
+                    suffix[j] = values[i, j]
+                else:
+                    suffix[j] = suffix[j + 1]
+            for j in range(num_windows):
+                a = suffix[j]
+                b = prefix[j + length - 1]
+                result[i, j] = a if (a < b) == minimum else b
+        return result
+
+def _footprint_filter(values, footprint, mode: str, cval, minimum: bool, use_numba: bool):
+    if mode != 'constant':
+        raise ValueError("only mode='constant' is supported")
+
+    values = np.asarray(values)
+    if values.ndim != 2:
+        raise ValueError("values must be a 2D array")
+    footprint = np.asarray(footprint)
+    if footprint.ndim != 2:
+        raise ValueError("footprint must be a 2D array")
+
+    runs = footprint_runs(footprint)
+    if len(runs) == 0:
+        raise ValueError("footprint must contain at least one nonzero element")
+
+    if use_numba is None:
+        use_numba = numba is not None
+    if use_numba and numba is None:
+        raise ValueError("numba is not installed")
+
+    # work in a type that can hold cval, e.g. infinities
+    dtype = values.dtype
+    if np.issubdtype(dtype, np.integer) or dtype == np.bool_:
+        if (not np.isfinite(cval) or not float(cval).is_integer()
+                or not np.can_cast(np.min_scalar_type(cval), dtype)):
+            dtype = np.float64
+    func = np.minimum if minimum else np.maximum
+
+    # pad so that the footprint is centered on each pixel, as for
+    # scipy.ndimage filters with origin 0
+    fy, fx = footprint.shape
+    cy, cx = fy // 2, fx // 2
+    padded = np.pad(values.astype(dtype, copy=False), ((cy, fy - 1 - cy), (cx, fx - 1 - cx)),
+                    mode='constant', constant_values=cval)
+
+    num_rows, num_cols = values.shape
+    runs_by_length = {}
+    for row, start, length in runs:
+        runs_by_length.setdefault(length, []).append((row, start))
+
+    result = None
+    for length in sorted(runs_by_length):
+        if use_numba:
+            extremum = _running_extremum_numba(padded, length, minimum)
+        else:
+            extremum = _running_extremum(padded, length, minimum)
+
+        for row, start in runs_by_length[length]:
+            shifted = extremum[row: row + num_rows, start: start + num_cols]
+            if result is None:
+                result = shifted.copy()
+            else:
+                func(result, shifted, out=result)
+        del extremum
+
+    return result
+
+def minimum_filter(values, footprint, mode: str = 'constant', cval=0.0, use_numba: bool = None):
+    '''
+    minimum of a 2D array over a footprint centered on every pixel. gives the
+    same result as scipy.ndimage.minimum_filter with origin 0
+
+    :param values: 2D array to filter
+    :param footprint: 2D array, nonzero where the footprint is
+    :param mode: how the borders are handled. only 'constant' is supported
+    :param cval: value beyond the borders
+    :param use_numba: whether to use the numba implementation of the running
+                      minimum. default is to use it if numba is installed
+    '''
+    return _footprint_filter(values, footprint, mode, cval, True, use_numba)
+
+def maximum_filter(values, footprint, mode: str = 'constant', cval=0.0, use_numba: bool = None):
+    '''
+    maximum of a 2D array over a footprint centered on every pixel. gives the
+    same result as scipy.ndimage.maximum_filter with origin 0
+
+    :param values: 2D array to filter
+    :param footprint: 2D array, nonzero where the footprint is
+    :param mode: how the borders are handled. only 'constant' is supported
+    :param cval: value beyond the borders
+    :param use_numba: whether to use the numba implementation of the running
+                      maximum. default is to use it if numba is installed
+    '''
+    return _footprint_filter(values, footprint, mode, cval, False, use_numba)
@@ -1,15 +1,25 @@
 try:
     import cupy as np
     from cupyx.scipy.signal import correlate
+    from cupyx.scipy import fft
 except ImportError:
     import numpy as np
     from scipy.signal import correlate
+    from scipy import fft
 
 from microlensing.IPM.ipm import IPM
 from . import util
+from .cache import ConvolvedMapCache
+from microlensing.Util.timings import profiled
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy
 
-def constant_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
+
+@profiled
+def constant_source(ipm: IPM, source, positions = 1, return_pos: bool = False,
+                    cache: ConvolvedMapCache = None):
     '''
     Return the magnification(s) for the provided magnification map,
     constant source profile, and position(s)
@@ -23,6 +33,8 @@ def constant_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
                       a collection of positions,
                       or an integer number of random positions
     :param return_pos: whether to also return positions used
+    :param cache: ConvolvedMapCache to use for the convolved map. default is
+                  the module cache convolved_maps
     '''
     if np.ndim(source.profile) != 2:
         raise ValueError("source.profile must be a 2D array")
@@ -35,27 +47,21 @@ def constant_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
         if not util.valid_positions(positions, ipm, source.profile):
             raise ValueError("provided positions do not lie within the necessary border")
 
-    # cross correlate map and profile and normalize
-    # contrary to what is commonly stated, microlensing is technically a cross 
-    # correlation  with the source profile, NOT a convolution
-    # the difference only matters for non-radially symmetric sources
-    if not isinstance(ipm.magnifications, np.ndarray):
-        vals = np.array(ipm.magnifications)
-    else:
-        vals = ipm.magnifications
-    if not isinstance(source.profile, np.ndarray):
-        kernel = np.array(source.profile)
+    if isinstance(ipm.magnifications, numpy.memmap):
+        # maps on disk, e.g. from IPM.run_tiled, are only read around the
+        # positions
+        if not isinstance(source.profile, np.ndarray):
+            kernel = np.array(source.profile)
+        else:
+            kernel = source.profile
+        magnifications = util.correlated_values(ipm.magnifications, kernel, source.weight, positions,
+                                                ipm.center, ipm.half_length, ipm.num_pixels)
     else:
-        kernel = source.profile
-    if not isinstance(source.weight, np.ndarray):
-        weight = np.array(source.weight)
-    else:
-        weight = source.weight
-    correlated_map = correlate(vals, kernel, mode='same', method='fft') / weight
-    interp = util.interpolated_map(correlated_map, ipm.center, 
-                                   ipm.half_length, ipm.num_pixels)
-    
-    magnifications = interp(positions)
+        correlated_map = convolved_map(ipm.magnifications, source.profile, source.weight, cache)
+        interp = util.interpolated_map(correlated_map, ipm.center, 
+                                       ipm.half_length, ipm.num_pixels)
+        
+        magnifications = interp(positions)
     
     try:
         if return_pos:
@@ -66,7 +72,9 @@ def constant_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
             return magnifications, positions
         return magnifications
 
-def changing_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
+@profiled
+def changing_source(ipm: IPM, source, positions = 1, return_pos: bool = False,
+                    max_bytes: int = 2**30):
     '''
     Return the magnifications for the provided magnification map, 
     changing source profiles, and position(s)
@@ -81,6 +89,8 @@ def changing_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
                       a collection of positions,
                       or an integer number of random positions
     :param return_pos: whether to also return positions used
+    :param max_bytes: approximate memory budget in bytes. positions are
+                      processed in blocks small enough to fit within it
     '''
     if np.ndim(source.profiles) != 3:
         raise ValueError("source.profiles must be a 3D array")
@@ -111,18 +121,6 @@ def changing_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
     x = x * ipm.pixel_scales[0]
     y = y * ipm.pixel_scales[1]
 
-    # add desired positions to source profile x,y values 
-    # (i.e. recenter source profile at each position)
-    # axes -2 and -1 are now the source profile axes
-    # earlier axes are the collection of positions
-    x = x + np.expand_dims(positions[...,0], (-2,-1))
-    y = y + np.expand_dims(positions[...,1], (-2,-1))
-
-    # add additional (time) axis for the changing profile
-    # axis -3 is time axis, -2 and -1 are still source profile
-    x = np.expand_dims(x, -3)
-    y = np.expand_dims(y, -3)
-
     if not isinstance(source.profiles, np.ndarray):
         kernels = np.array(source.profiles)
     else:
@@ -132,24 +130,185 @@ def changing_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
     else:
         weights = source.weights
 
-    # interpolate magnifications on the source profile location grid
-    # in the transpose, we want all axes to stay the same 
-    # EXCEPT the coordinates need to become the last axis
-    # the roll makes sure the transpose moves axes like
-    # [0,1,2,3,...n] -> [1,2,3,...n,0]
-    # multiply and sum over source profile axes
-    new_axes = np.roll(np.arange(x.ndim + 1),-1)
+    # every profile shares the same grid, so the map only needs to be
+    # interpolated once per position. the sum over each profile is then a
+    # matrix product of the interpolated values with the flattened kernels
+    kernels = kernels.reshape(kernels.shape[0], -1).T
+
+    shape = positions.shape[:-1]
+    flat_positions = positions.reshape(-1, 2)
+    num_positions = flat_positions.shape[0]
+
+    # coordinates, interpolation weights, and indices for every point of a
+    # profile take a number of float64 arrays
+    bytes_per_position = 16 * 8 * x.size
+    chunk_size = int(max(1, max_bytes // bytes_per_position))
+
+    magnifications = np.empty((num_positions, kernels.shape[1]))
+    for i in range(0, num_positions, chunk_size):
+        chunk = flat_positions[i: i + chunk_size]
+
+        # add desired positions to source profile x,y values 
+        # (i.e. recenter source profile at each position)
+        # axes -2 and -1 are now the source profile axes
+        # earlier axis is the collection of positions
+        points = np.stack([x + chunk[:, 0, None, None],
+                           y + chunk[:, 1, None, None]], axis=-1)
+
+        # interpolate magnifications on the source profile location grid,
+        # multiply and sum over source profile axes
+        values = interp(points).reshape(chunk.shape[0], -1)
+        magnifications[i: i + chunk_size] = values @ kernels
+
+    # and normalize!
+    magnifications = magnifications.reshape(shape + (kernels.shape[1],)) / weights
+    
     try:
-        new_axes = new_axes.get()
+        if return_pos:
+            return magnifications.get(), positions.get()
+        return magnifications.get()
     except AttributeError:
-        pass
-    
-    magnifications = (np.sum(kernels
-                             * interp(np.transpose(np.array([x, y]), 
-                                                   axes=new_axes)), 
-                             axis=(-2,-1)) 
-                      / weights) # and normalize!
-    
+        if return_pos:
+            return magnifications, positions
+        return magnifications
+
+# cache of convolved maps shared by the light curve functions
+convolved_maps = ConvolvedMapCache()
+
+def _correlate(values, kernel, weight):
+    # cross correlate map and profile and normalize
+    # contrary to what is commonly stated, microlensing is technically a cross 
+    # correlation  with the source profile, NOT a convolution
+    # the difference only matters for non-radially symmetric sources
+    if not isinstance(values, np.ndarray):
+        values = np.array(values)
+    if not isinstance(kernel, np.ndarray):
+        kernel = np.array(kernel)
+    return correlate(values, kernel, mode='same', method='fft') / weight
+
+@profiled
+def convolved_map(values, kernel, weight, cache: ConvolvedMapCache = None):
+    '''
+    Return the cross correlation of a map with a kernel, normalized by the
+    weight of the kernel. Results are cached by a hash of the map, the kernel,
+    and the weight
+
+    :param values: magnification map
+    :param kernel: 2D kernel of the source profile
+    :param weight: sum of the kernel
+    :param cache: ConvolvedMapCache to use. default is the module cache
+                  convolved_maps
+    '''
+    if cache is None:
+        cache = convolved_maps
+    return cache.get(values, kernel, weight, _correlate)
+
+def iter_convolved_maps(values, kernels, weights, num_threads: int = 1):
+    '''
+    Cross correlate a map with a stack of kernels of the same shape, yielding
+    the normalized maps one kernel at a time. The Fourier transform of the map
+    is calculated only once, and at most num_threads convolved maps are held
+    in memory at any time besides the one being used
+
+    :param values: magnification map
+    :param kernels: 3D array of 2D kernels, e.g. source.profiles
+    :param weights: sums of the kernels, e.g. source.weights
+    :param num_threads: number of kernels to convolve in parallel. threads
+                        are only used on the CPU
+    :return index, convolved_map: index of the kernel and its convolved map
+    '''
+    if np.ndim(kernels) != 3:
+        raise ValueError("kernels must be a 3D array")
+    if num_threads < 1:
+        raise ValueError("num_threads must be >= 1")
+
+    if not isinstance(values, np.ndarray):
+        values = np.array(values)
+    if not isinstance(kernels, np.ndarray):
+        kernels = np.array(kernels)
+    if not isinstance(weights, np.ndarray):
+        weights = np.array(weights)
+
+    map_shape = values.shape
+    kernel_shape = kernels.shape[1:]
+    # size of the full linear correlation, rounded up to a fast FFT length
+    shape = tuple(fft.next_fast_len(n + k - 1, real=True) for n, k in zip(map_shape, kernel_shape))
+    # start of the central part of the full correlation, as for mode='same'
+    start = tuple((k - 1) // 2 for k in kernel_shape)
+
+    map_spectrum = fft.rfft2(values, shape)
+
+    def convolve(i):
+        # correlation is convolution with the kernel flipped along both axes
+        kernel_spectrum = fft.rfft2(kernels[i, ::-1, ::-1], shape)
+        full = fft.irfft2(map_spectrum * kernel_spectrum, shape)
+        return np.ascontiguousarray(full[start[0]: start[0] + map_shape[0],
+                                         start[1]: start[1] + map_shape[1]]) / weights[i]
+
+    num_kernels = kernels.shape[0]
+    if num_threads == 1 or np is not numpy:
+        for i in range(num_kernels):
+            yield i, convolve(i)
+        return
+
+    # scipy.fft releases the GIL, so threads convolve kernels in parallel.
+    # results are yielded in order with at most num_threads in flight
+    with ThreadPoolExecutor(num_threads) as executor:
+        futures = deque()
+        for i in range(num_kernels):
+            futures.append(executor.submit(convolve, i))
+            if len(futures) == num_threads:
+                yield i - num_threads + 1, futures.popleft().result()
+        while futures:
+            yield num_kernels - len(futures), futures.popleft().result()
+
+@profiled
+def constant_sources(ipm: IPM, source, positions = 1, return_pos: bool = False, num_threads: int = 1):
+    '''
+    Return the magnifications for the provided magnification map, a stack of
+    constant source profiles, and position(s). The map is correlated with each
+    profile in turn, reusing its Fourier transform, so this is much faster than
+    calling constant_source once per profile
+
+    :param ipm: formally, an IPM instance that has ran and has a magnification
+                map. in general, any object that has attributes magnifications,
+                center, half_length, num_pixels, and pixel_scales, in (y1,y2) coordinates
+    :param source: source object that must contain a list of 2D kernels as source.profiles
+                   and weights (sums of the kernels) as source.weights, e.g.
+                   Gaussians or UniformDisks. kernels must all have the same shape
+    :param positions: either a position in the magnification map, 
+                      a collection of positions,
+                      or an integer number of random positions
+    :param return_pos: whether to also return positions used
+    :param num_threads: number of profiles to convolve in parallel on the CPU
+    :return magnifications: array with the profiles as the last axis
+    '''
+    if np.ndim(source.profiles) != 3:
+        raise ValueError("source.profiles must be a 3D array")
+
+    if isinstance(positions, int):
+        positions = util.random_position(ipm, source.profiles[-1], positions)
+    else:
+        positions = np.atleast_1d(positions)
+
+        if not util.valid_positions(positions, ipm, source.profiles[-1]):
+            raise ValueError("provided positions do not lie within the necessary border")
+
+    col, row = util.fractional_pixels(positions, ipm.center, ipm.half_length, ipm.num_pixels)
+
+    magnifications = np.empty(positions.shape[:-1] + (np.shape(source.profiles)[0],))
+    if isinstance(ipm.magnifications, numpy.memmap):
+        # maps on disk, e.g. from IPM.run_tiled, are only read around the
+        # positions
+        for i in range(magnifications.shape[-1]):
+            magnifications[..., i] = util.correlated_values(ipm.magnifications, np.asarray(source.profiles[i]),
+                                                            source.weights[i], positions,
+                                                            ipm.center, ipm.half_length, ipm.num_pixels)
+    else:
+        for i, correlated_map in iter_convolved_maps(ipm.magnifications, source.profiles,
+                                                     source.weights, num_threads):
+            magnifications[..., i] = util.bilinear(correlated_map, col, row)
+
     try:
         if return_pos:
             return magnifications.get(), positions.get()
@@ -158,3 +317,82 @@ def changing_source(ipm: IPM, source, positions = 1, return_pos: bool = False):
         if return_pos:
             return magnifications, positions
         return magnifications
+
+@profiled
+def constant_source_tracks(ipm: IPM, source, starts=None, velocities=None, times=None,
+                           tracks=None, num_points: int = None, max_points: int = 2**22,
+                           cache: ConvolvedMapCache = None):
+    '''
+    Return light curves for many tracks across the provided magnification map
+    at once, for a constant source profile. The convolved map is cached and
+    sampled bilinearly at the track positions
+
+    Tracks are either straight lines, given by starts, velocities, and times,
+    or polylines, given by tracks
+
+    :param ipm: formally, an IPM instance that has ran and has a magnification
+                map. in general, any object that has attributes magnifications,
+                center, half_length, num_pixels, and pixel_scales, in (y1,y2) coordinates
+    :param source: source object that must contain a 2D kernel as source.profile
+                   and weight (sum of the kernel) as source.weight
+    :param starts: starting positions of the tracks, of shape (N, 2)
+    :param velocities: velocities of the tracks in map units per unit time,
+                       of shape (N, 2)
+    :param times: times at which to sample the tracks, of shape (T,) or (N, T)
+    :param tracks: vertices of polyline tracks, of shape (N, K, 2)
+    :param num_points: number of points spaced evenly along the length of each
+                       polyline. default is to sample the vertices themselves
+    :param max_points: maximum number of positions sampled at once
+    :param cache: ConvolvedMapCache to use for the convolved map. default is
+                  the module cache convolved_maps
+    :return magnifications: light curves of shape (N, T)
+    '''
+    if np.ndim(source.profile) != 2:
+        raise ValueError("source.profile must be a 2D array")
+
+    if tracks is not None:
+        if starts is not None or velocities is not None or times is not None:
+            raise ValueError("provide either tracks, or starts, velocities, and times")
+        positions = np.asarray(tracks, dtype=np.float64)
+        if positions.ndim != 3 or positions.shape[-1] != 2:
+            raise ValueError("tracks must have shape (N, K, 2)")
+        if num_points is not None:
+            positions = util.resample_polylines(positions, num_points)
+    else:
+        if starts is None or velocities is None or times is None:
+            raise ValueError("provide either tracks, or starts, velocities, and times")
+        starts = np.atleast_2d(np.asarray(starts, dtype=np.float64))
+        velocities = np.atleast_2d(np.asarray(velocities, dtype=np.float64))
+        times = np.asarray(times, dtype=np.float64)
+        if times.ndim == 1:
+            times = times[None, :]
+        positions = starts[:, None, :] + velocities[:, None, :] * times[:, :, None]
+
+    if not util.valid_positions(positions, ipm, source.profile):
+        raise ValueError("provided positions do not lie within the necessary border")
+
+    if isinstance(ipm.magnifications, numpy.memmap):
+        # maps on disk, e.g. from IPM.run_tiled, are only read around the
+        # positions
+        if not isinstance(source.profile, np.ndarray):
+            kernel = np.array(source.profile)
+        else:
+            kernel = source.profile
+        magnifications = util.correlated_values(ipm.magnifications, kernel, source.weight, positions,
+                                                ipm.center, ipm.half_length, ipm.num_pixels)
+    else:
+        correlated_map = convolved_map(ipm.magnifications, source.profile, source.weight, cache)
+
+        shape = positions.shape[:-1]
+        flat_positions = positions.reshape(-1, 2)
+        magnifications = np.empty(flat_positions.shape[0])
+        for i in range(0, flat_positions.shape[0], max_points):
+            col, row = util.fractional_pixels(flat_positions[i: i + max_points],
+                                              ipm.center, ipm.half_length, ipm.num_pixels)
+            magnifications[i: i + max_points] = util.bilinear(correlated_map, col, row)
+        magnifications = magnifications.reshape(shape)
+
+    try:
+        return magnifications.get()
+    except AttributeError:
+        return magnifications
@@ -1,15 +1,19 @@
 try:
     import cupy as np
     from cupyx.scipy.ndimage import minimum_filter, maximum_filter
-except ImportError as error:
-    print("cupy not installed. We do not recommend using these features without GPUs, as the min/max filter runtime is high")
-    raise error
+except ImportError:
+    import numpy as np
+    # disk footprints are decomposed into row runs, which is much faster on
+    # the CPU than scipy.ndimage filters with an arbitrary footprint
+    from .footprint_filters import minimum_filter, maximum_filter
 
 from microlensing.NCC.ncc import NCC
 from microlensing.SourceProfiles.uniform_disk import UniformDisk, UniformDisks
 from . import util
+from microlensing.Util.timings import profiled
 
 
+@profiled
 def constant_source(ncc: NCC, source, positions = 1, return_pos: bool = False):
     '''
     Return the minimum and maximum number of caustic crossings for the provided
@@ -75,6 +79,7 @@ def constant_source(ncc: NCC, source, positions = 1, return_pos: bool = False):
             return ncc_min, ncc_max, positions
         return ncc_min, ncc_max
 
+@profiled
 def changing_source(ncc: NCC, source, positions = 1, return_pos: bool = False):
     '''
     Return the magnifications for the provided magnification map, 
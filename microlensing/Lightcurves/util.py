@@ -1,9 +1,11 @@
 try:
     import cupy as np
     from cupyx.scipy.interpolate import RegularGridInterpolator
+    from cupyx.scipy.signal import correlate
 except ImportError:
     import numpy as np
     from scipy.interpolate import RegularGridInterpolator
+    from scipy.signal import correlate
 
 
 def pixel_to_point(pixel, center, half_length, num_pixels):
@@ -105,3 +107,110 @@ def interpolated_map(values, center, half_length, num_pixels):
     # python arrays is top left corner and we want it to be bottom left
     return RegularGridInterpolator((x,y), values[::-1].T,
                                    bounds_error=False, fill_value=None)
+
+def fractional_pixels(positions, center, half_length, num_pixels):
+    '''
+    convert points in the source plane into fractional pixel coordinates of a
+    map array, relative to the pixel centers. rows are counted from the top of
+    the map, as in the map arrays
+
+    :param positions: array of positions, with the coordinates as the last axis
+    :param center: center of the map
+    :param half_length: half_length of the map
+    :param num_pixels: number of pixels of the map along the axes
+    :return col, row: fractional column and row of each position
+    '''
+    col = (positions[..., 0] - (center[0] - half_length[0])) * num_pixels[0] / (2 * half_length[0]) - 0.5
+    row = (center[1] + half_length[1] - positions[..., 1]) * num_pixels[1] / (2 * half_length[1]) - 0.5
+    return col, row
+
+def bilinear(values, col, row, row_offset: int = 0, num_rows: int = None):
+    '''
+    bilinearly interpolate a map at fractional pixel coordinates, extrapolating
+    linearly beyond the outermost pixel centers like interpolated_map
+
+    :param values: map, or a band of rows of it
+    :param col: fractional columns of the positions
+    :param row: fractional rows of the positions in the full map
+    :param row_offset: row of the full map that the first row of values is
+    :param num_rows: number of rows of the full map. default is the number of
+                     rows of values
+    '''
+    if num_rows is None:
+        num_rows = values.shape[0] + row_offset
+
+    c0 = np.clip(np.floor(col), 0, max(values.shape[1] - 2, 0)).astype(int)
+    r0 = np.clip(np.floor(row), 0, max(num_rows - 2, 0)).astype(int)
+    tc = col - c0
+    tr = row - r0
+    c1 = np.minimum(c0 + 1, values.shape[1] - 1)
+    r0 = r0 - row_offset
+    r1 = np.minimum(r0 + 1, values.shape[0] - 1)
+
+    return ((1 - tr) * ((1 - tc) * values[r0, c0] + tc * values[r0, c1])
+            + tr * ((1 - tc) * values[r1, c0] + tc * values[r1, c1]))
+
+def correlated_values(values, kernel, weight, positions, center, half_length, num_pixels, max_rows: int = 1024):
+    '''
+    cross correlate a map with a kernel and interpolate the result at the
+    given positions, reading and correlating only bands of rows around the
+    positions. this allows memory mapped maps larger than memory to be used,
+    and gives the same values as correlating the whole map
+
+    :param values: map to correlate, e.g. a numpy.memmap
+    :param kernel: 2D kernel of the source profile
+    :param weight: normalization of the kernel
+    :param positions: array of positions, with the coordinates as the last axis
+    :param center: center of the map
+    :param half_length: half_length of the map
+    :param num_pixels: number of pixels of the map along the axes
+    :param max_rows: number of rows of positions per band
+    '''
+    shape = positions.shape[:-1]
+    positions = positions.reshape(-1, 2)
+    col, row = fractional_pixels(positions, center, half_length, num_pixels)
+
+    num_rows = values.shape[0]
+    band = np.clip(np.floor(row), 0, max(num_rows - 2, 0)).astype(int) // max_rows
+    # margin of rows so that the edges of a band do not affect the
+    # correlation at the rows needed for interpolation
+    margin = np.shape(kernel)[0] + 1
+
+    result = np.zeros(positions.shape[0])
+    for b in np.unique(band).tolist():
+        where = band == b
+        lower = max(b * max_rows - margin, 0)
+        upper = min((b + 1) * max_rows + 1 + margin, num_rows)
+
+        vals = np.array(values[lower: upper])
+        correlated = correlate(vals, kernel, mode='same', method='fft') / weight
+        result[where] = bilinear(correlated, col[where], row[where], lower, num_rows)
+
+    return result.reshape(shape)
+
+def resample_polylines(vertices, num_points: int):
+    '''
+    sample points spaced evenly along the length of polylines
+
+    :param vertices: vertices of the polylines, of shape (N, K, 2)
+    :param num_points: number of points to sample along each polyline,
+                       including both ends
+    :return positions: array of shape (N, num_points, 2)
+    '''
+    if not isinstance(vertices, np.ndarray):
+        vertices = np.array(vertices)
+
+    segment_lengths = np.linalg.norm(np.diff(vertices, axis=1), axis=-1)
+    lengths = np.concatenate((np.zeros((vertices.shape[0], 1)), np.cumsum(segment_lengths, axis=1)), axis=1)
+
+    # distance along each polyline of every sample
+    s = lengths[:, -1:] * np.linspace(0, 1, num_points)[None, :]
+    segment = np.clip(np.sum(lengths[:, None, 1:] < s[:, :, None], axis=-1), 0, vertices.shape[1] - 2)
+
+    start = np.take_along_axis(lengths, segment, axis=1)
+    length = np.take_along_axis(segment_lengths, segment, axis=1)
+    t = np.where(length > 0, (s - start) / np.where(length > 0, length, 1), 0)
+
+    p0 = np.take_along_axis(vertices, segment[..., None], axis=1)
+    p1 = np.take_along_axis(vertices, segment[..., None] + 1, axis=1)
+    return p0 + t[..., None] * (p1 - p0)
@@ -0,0 +1,992 @@
+from microlensing.Deflection import deflection_angles
+from microlensing.Deflection.deflector import Deflector
+from microlensing.Util.microlensing_cpu import Microlensing, Library, print_verbose, print_error
+from microlensing.Util.timings import stage
+from microlensing.Util.util import write_array
+
+import numpy as np
+import time
+
+
+'''
+images of a source moving along the track w0 + t * v are followed from one
+position to the next. the images at each position are found with Newton's
+method on the lens equation, starting from the images at the previous position
+moved along the tangent of their image lines, so each position costs a few
+evaluations of the deflection angles of the tracked images through the tree
+
+images are only created or annihilated where the track crosses a caustic, in
+pairs at the corresponding point of a critical curve. these points are found
+once per track on a grid of the image plane region of the track, whose cells
+map into the source plane with opposite orientations on either side of a
+critical curve. from each fold of the grid crossed by the image line of the
+track, Newton's method on 1/mu and the distance from the track locates the
+point of the critical curve. the second order expansion of the lens equation
+there gives the side of the caustic with two more images and their positions
+just after the crossing, from which they are followed like the others. images
+which no longer converge, or which converge onto another image or onto the
+other side of a critical curve, are annihilated. the initial images are found
+in the grid cells whose mapped triangles contain the first position, and next
+to each star within max_r of the track. around stars close to another star,
+where the grid does not resolve the map, they are found in the cells of finer
+grids instead. the images inside the grid at each position are checked against
+the winding number of its mapped boundary around the position
+'''
+
+
+class ImageTracker():
+    '''
+    images of a source moving along a straight track, followed from one
+    position to the next with Newton's method
+    '''
+
+    # |w(z) - w| in units of theta_star below which a position is an image, as
+    # in the CUDA code
+    TOLERANCE = 1e-9
+
+    # distance in units of theta_star below which two images are the same
+    SAME_IMAGE = 1e-6
+
+    MAX_NUM_ITERS = 30
+
+    # numbers of steps between consecutive positions with which images that
+    # were not found are followed again
+    SUBSTEPS = (4, 16)
+
+    # number of cells of the finer grids along each side of a cell of the
+    # grid, and number of cells of the grid on either side of a star close to
+    # another star which they cover
+    REFINEMENT = 6
+    REFINED_CELLS = 3
+
+    # number of cells along either axis within which two stars are close
+    CLOSE_CELLS = 10
+
+    def __init__(self, deflector: Deflector, w0: complex, v: complex, max_r: float, grid_spacing: float):
+        '''
+        :param deflector: deflector of the star field
+        :param w0: complex source position at t = 0
+        :param v: complex source velocity
+        :param max_r: distance from the track within which stars and images
+                      are used
+        :param grid_spacing: spacing of the image plane grid used to find
+                             initial images and critical curve crossings
+        '''
+        if v == 0:
+            raise ValueError("v must be nonzero")
+
+        self.deflector = deflector
+        self.w0 = complex(w0)
+        self.v = complex(v)
+        self.u = self.v / abs(self.v)
+        self.max_r = max_r
+        self.grid_spacing = grid_spacing
+        # Newton steps are limited so positions next to a star or a critical
+        # curve do not jump across the field
+        self.max_step = 10 * grid_spacing
+
+    def macro_z(self, w):
+        '''
+        :return z: image of w under the macro lens equation alone
+        '''
+        d = self.deflector
+        w = np.asarray(w)
+        return w.real / (1 - d.kappa + d.gamma) + 1j * w.imag / (1 - d.kappa - d.gamma)
+
+    def track_coordinates(self, w):
+        '''
+        :return t: parameter of the closest point of the track
+        :return dist: signed distance from the track
+        '''
+        dw = (np.asarray(w) - self.w0) * np.conj(self.u)
+        return dw.real / abs(self.v), dw.imag
+
+    def derivatives(self, z, second: bool = False):
+        '''
+        :param z: complex image plane positions
+        :param second: whether to also return the second derivative
+        :return d_w_d_z: real derivative of the lens equation with respect to z
+        :return d_w_d_zbar: derivative with respect to z_bar
+        :return d2_w_d_zbar2: second derivative with respect to z_bar, if second
+        '''
+        d = self.deflector
+        d_alpha_star_d_zbar, d2_alpha_star_d_zbar2 = d.alpha_star_derivatives(z)
+        d_w_d_z = 1 - d.kappa - deflection_angles.d_alpha_smooth_d_z(z, d.kappastar, d.rectangular, d.corner, d.approx)
+        d_w_d_zbar = (d.gamma - d_alpha_star_d_zbar
+                      - deflection_angles.d_alpha_smooth_d_zbar(z, d.kappastar, d.rectangular, d.corner,
+                                                                d.approx, d.taylor_smooth))
+        if not second:
+            return np.real(d_w_d_z), d_w_d_zbar
+        d2_w_d_zbar2 = (-d2_alpha_star_d_zbar2
+                        - deflection_angles.d2_alpha_smooth_d_zbar2(z, d.kappastar, d.rectangular, d.corner,
+                                                                    d.approx, d.taylor_smooth))
+        return np.real(d_w_d_z), d_w_d_zbar, d2_w_d_zbar2
+
+    @staticmethod
+    def step(d_w_d_z, d_w_d_zbar, dw):
+        '''
+        :return dz: change in image position for a change dw in source position,
+                    to first order
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dz = (d_w_d_z * dw - d_w_d_zbar * np.conj(dw)) / (d_w_d_z**2 - np.abs(d_w_d_zbar)**2)
+        return np.where(np.isfinite(dz), dz, 0)
+
+    def limit(self, dz):
+        with np.errstate(divide='ignore'):
+            return dz * np.minimum(1, self.max_step / np.abs(dz))
+
+    def newton(self, z, w):
+        '''
+        :param z: complex initial positions
+        :param w: complex source position
+        :return z: positions after the iterations
+        :return found: whether each position is an image of w
+        '''
+        d = self.deflector
+        z = np.array(z, dtype=np.complex128)
+        found = np.zeros(z.shape, dtype=bool)
+        active = np.arange(z.size)
+
+        for i in range(self.MAX_NUM_ITERS + 1):
+            dw = w - d.w(z[active])
+            done = np.abs(dw) / d.theta < self.TOLERANCE
+            found[active[done]] = True
+            active, dw = active[~done], dw[~done]
+            if active.size == 0 or i == self.MAX_NUM_ITERS:
+                break
+            d_w_d_z, d_w_d_zbar = self.derivatives(z[active])
+            z[active] += self.limit(self.step(d_w_d_z, d_w_d_zbar, dw))
+
+        return z, found
+
+    def follow(self, z, d_w_d_z, d_w_d_zbar, w_start: complex, w_path):
+        '''
+        follow images through a sequence of source positions, starting each
+        step from the tangent of the image line
+
+        :param z: complex images of w_start
+        :param d_w_d_z: derivatives of the lens equation with respect to z at z
+        :param d_w_d_zbar: derivatives with respect to z_bar at z
+        :param w_start: complex source position of the images
+        :param w_path: complex source positions to follow the images through
+        :return z: images of the last source position
+        :return d_w_d_z: derivatives with respect to z at the new images
+        :return d_w_d_zbar: derivatives with respect to z_bar at the new images
+        :return found: whether each image was followed to the last source
+                       position without crossing a critical curve
+        '''
+        z = z.copy()
+        d_w_d_z = d_w_d_z.copy()
+        d_w_d_zbar = d_w_d_zbar.copy()
+        parity = np.sign(d_w_d_z**2 - np.abs(d_w_d_zbar)**2)
+        found = np.ones(z.size, dtype=bool)
+
+        for w_last, w in zip(np.r_[w_start, w_path[:-1]], w_path):
+            idx = np.flatnonzero(found)
+            z_new, converged = self.newton(z[idx] + self.limit(self.step(d_w_d_z[idx], d_w_d_zbar[idx], w - w_last)), w)
+            a, b = self.derivatives(z_new)
+            converged &= np.sign(a**2 - np.abs(b)**2) == parity[idx]
+            found[idx[~converged]] = False
+            idx = idx[converged]
+            z[idx], d_w_d_z[idx], d_w_d_zbar[idx] = z_new[converged], a[converged], b[converged]
+
+        return z, d_w_d_z, d_w_d_zbar, found
+
+    def unique(self, z, priority):
+        '''
+        :param z: complex image positions
+        :param priority: value for each position. of several positions of the
+                         same image, the one with the lowest value is kept
+        :return keep: boolean array of the positions to keep
+        '''
+        if z.size == 0:
+            return np.zeros(0, dtype=bool)
+        order = np.argsort(z.real)
+        # sorted by x1, positions of the same image are next to each other
+        new = np.r_[True, np.abs(np.diff(z[order])) / self.deflector.theta >= self.SAME_IMAGE]
+        cluster = np.cumsum(new) - 1
+        best = np.lexsort((priority[order], cluster))
+        first = np.r_[True, np.diff(cluster[best]) != 0]
+        keep = np.zeros(z.size, dtype=bool)
+        keep[order[best[first]]] = True
+        return keep
+
+    def create_grid(self, t_min: float, t_max: float):
+        '''
+        grid of the image plane region within max_r of the track between
+        t_min and t_max, under the macro lens equation. its axes are the
+        images of the directions along and across the track
+        '''
+        d = self.deflector
+        h = self.grid_spacing
+
+        e1 = self.macro_z(self.u)
+        e2 = self.macro_z(1j * self.u)
+        length1 = (t_max - t_min) * abs(self.v) + 2 * self.max_r
+        length2 = 2 * self.max_r
+        n1 = int(np.ceil(length1 * abs(e1) / h)) + 1
+        n2 = int(np.ceil(length2 * abs(e2) / h)) + 1
+
+        self.origin = self.macro_z(self.w0 + self.u * (t_min * abs(self.v) - self.max_r) - 1j * self.u * self.max_r)
+        self.step1 = e1 * length1 / (n1 - 1)
+        self.step2 = e2 * length2 / (n2 - 1)
+
+        self.grid_z = self.origin + np.arange(n1)[:, None] * self.step1 + np.arange(n2)[None, :] * self.step2
+        self.grid_w = d.w(self.grid_z)
+        self.grid_t, self.grid_dist = self.track_coordinates(self.grid_w)
+
+        # orientation of each cell in the source plane relative to the image
+        # plane, which is the sign of 1/mu where the map is smooth
+        dw1 = self.grid_w[1:, :-1] - self.grid_w[:-1, :-1]
+        dw2 = self.grid_w[:-1, 1:] - self.grid_w[:-1, :-1]
+        self.cell_parity = (np.sign(np.imag(np.conj(dw1) * dw2))
+                            * np.sign(np.imag(np.conj(self.step1) * self.step2))).astype(np.int8)
+
+        # the map is not resolved by cells next to stars, which are excluded
+        i1, i2 = self.cell_index(d.stars[:, 0] + 1j * d.stars[:, 1])
+        inside = (i1 >= -2) & (i1 < n1 + 1) & (i2 >= -2) & (i2 < n2 + 1)
+        for di in range(-2, 3):
+            for dj in range(-2, 3):
+                j1 = np.clip(i1[inside] + di, 0, n1 - 2)
+                j2 = np.clip(i2[inside] + dj, 0, n2 - 2)
+                self.cell_parity[j1, j2] = 0
+
+        self.create_refined_grids()
+
+    def create_refined_grids(self):
+        '''
+        finer grids over the cells within REFINED_CELLS cells of each star
+        within CLOSE_CELLS cells of another star. images between such stars
+        may lie in excluded cells, where star_images only seeds the image of
+        each star, or in cells next to them which do not resolve the map of
+        both stars, so these grids seed the others. their cells are aligned
+        with those of the grid, and exclude the cells of the finer grid next
+        to each star
+        '''
+        d = self.deflector
+        r = self.REFINEMENT
+        h = self.REFINED_CELLS
+        size = (2 * h + 1) * r
+        n1, n2 = self.cell_parity.shape
+
+        x1, x2 = self.cell_coordinates(d.stars[:, 0] + 1j * d.stars[:, 1])
+        i1, i2 = np.floor(x1).astype(int), np.floor(x2).astype(int)
+        inside = np.flatnonzero((i1 >= -h) & (i1 < n1 + h) & (i2 >= -h) & (i2 < n2 + h))
+
+        # pairs of close stars, found by binning the stars into blocks of
+        # cells at least as large as the distance between them
+        bins = {}
+        for k in inside:
+            bins.setdefault((i1[k] // (self.CLOSE_CELLS + 1), i2[k] // (self.CLOSE_CELLS + 1)), []).append(k)
+        first, second = [], []
+        for (b1, b2), members in bins.items():
+            members = np.array(members)
+            others = np.array([k for d1 in range(-1, 2) for d2 in range(-1, 2) for k in bins.get((b1 + d1, b2 + d2), [])])
+            close = ((np.abs(i1[members][:, None] - i1[others][None, :]) <= self.CLOSE_CELLS)
+                     & (np.abs(i2[members][:, None] - i2[others][None, :]) <= self.CLOSE_CELLS))
+            j, k = np.nonzero(close)
+            first.append(members[j])
+            second.append(others[k])
+        first = np.concatenate(first + [np.zeros(0, dtype=int)])
+        second = np.concatenate(second + [np.zeros(0, dtype=int)])
+
+        # each pair includes the star with itself
+        stars = np.unique(first[first != second])
+        block = np.full(d.stars.shape[0], -1)
+        block[stars] = np.arange(stars.size)
+        keep = block[first] >= 0
+        first, second = first[keep], second[keep]
+
+        # corners of the finer grid around each star, in units of the cells of
+        # the grid
+        f = np.arange(size + 1) / r
+        c1 = i1[stars] - h
+        c2 = i2[stars] - h
+        self.fine_z = (self.origin + (c1[:, None, None] + f[None, :, None]) * self.step1
+                       + (c2[:, None, None] + f[None, None, :]) * self.step2)
+        self.fine_w = d.w(self.fine_z)
+        self.fine_t, self.fine_dist = self.track_coordinates(self.fine_w)
+
+        dw1 = self.fine_w[:, 1:, :-1] - self.fine_w[:, :-1, :-1]
+        dw2 = self.fine_w[:, :-1, 1:] - self.fine_w[:, :-1, :-1]
+        self.fine_parity = (np.sign(np.imag(np.conj(dw1) * dw2))
+                            * np.sign(np.imag(np.conj(self.step1) * self.step2))).astype(np.int8)
+
+        # only cells of the grid are refined
+        j1 = c1[:, None, None] + np.arange(size)[None, :, None] // r
+        j2 = c2[:, None, None] + np.arange(size)[None, None, :] // r
+        self.fine_parity[(j1 < 0) | (j1 >= n1) | (j2 < 0) | (j2 >= n2)] = 0
+
+        # the map is not resolved by cells of the finer grids next to stars
+        k1 = np.floor((x1[second] - c1[block[first]]) * r).astype(int)
+        k2 = np.floor((x2[second] - c2[block[first]]) * r).astype(int)
+        for di in range(-2, 3):
+            for dj in range(-2, 3):
+                valid = (k1 + di >= 0) & (k1 + di < size) & (k2 + dj >= 0) & (k2 + dj < size)
+                self.fine_parity[block[first][valid], k1[valid] + di, k2[valid] + dj] = 0
+
+        # pairs of stars within a cell of each other, whose excluded cells of
+        # the finer grids may cover the images between them, are seeded where
+        # their deflections cancel
+        pair = (first < second) & (np.abs(x1[first] - x1[second]) <= 1) & (np.abs(x2[first] - x2[second]) <= 1)
+        z1 = d.stars[first[pair], 0] + 1j * d.stars[first[pair], 1]
+        z2 = d.stars[second[pair], 0] + 1j * d.stars[second[pair], 1]
+        m1 = d.stars[first[pair], 2]
+        m2 = d.stars[second[pair], 2]
+        self.pair_z = z1 + (z2 - z1) * m1 / (m1 + m2)
+
+    def cell_coordinates(self, z):
+        '''
+        :return x1: position of z along the first axis of the grid, in units
+                    of its cells
+        :return x2: position along the second axis
+        '''
+        dz = np.asarray(z) - self.origin
+        det = np.imag(np.conj(self.step1) * self.step2)
+        x1 = np.imag(np.conj(dz) * self.step2) / det
+        x2 = np.imag(np.conj(self.step1) * dz) / det
+        return x1, x2
+
+    def cell_index(self, z):
+        '''
+        :return i1: index of the cell containing z along the first axis
+        :return i2: index along the second axis
+        '''
+        x1, x2 = self.cell_coordinates(z)
+        return np.floor(x1).astype(int), np.floor(x2).astype(int)
+
+    def grid_images(self, w):
+        '''
+        :return z: approximate images of w in the cells of the grid and of the
+                   finer grids whose mapped triangles contain w
+        '''
+        return np.concatenate([self.triangle_images(self.grid_z, self.grid_w, self.cell_parity != 0, w),
+                               self.triangle_images(self.fine_z, self.fine_w, self.fine_parity != 0, w)])
+
+    @staticmethod
+    def triangle_images(z, gw, valid, w):
+        '''
+        :param z: complex positions of a grid along its last two axes
+        :param gw: mapped positions of the grid
+        :param valid: boolean array of the cells of the grid to use
+        :param w: complex source position
+        :return z: approximate images of w in the valid cells whose mapped
+                   triangles contain w
+        '''
+        seeds = []
+        # the two triangles of each cell
+        for a, b, c in [((0, 0), (1, 0), (0, 1)), ((1, 1), (0, 1), (1, 0))]:
+            corner = [(..., slice(i, z.shape[-2] - 1 + i), slice(j, z.shape[-1] - 1 + j)) for i, j in (a, b, c)]
+            wa, wb, wc = (gw[idx][valid] for idx in corner)
+            za, zb, zc = (z[idx][valid] for idx in corner)
+            e1 = wb - wa
+            e2 = wc - wa
+            q = w - wa
+            with np.errstate(divide='ignore', invalid='ignore'):
+                det = np.imag(np.conj(e1) * e2)
+                s = np.imag(np.conj(q) * e2) / det
+                r = np.imag(np.conj(e1) * q) / det
+            inside = (s >= 0) & (r >= 0) & (s + r <= 1)
+            seeds.append(za[inside] + s[inside] * (zb[inside] - za[inside]) + r[inside] * (zc[inside] - za[inside]))
+        return np.concatenate(seeds)
+
+    def star_images(self, w):
+        '''
+        :return z: approximate image of w next to each star within max_r of
+                   the track or next to the grid, where the deflection of the
+                   star dominates, and between the pairs of stars within a
+                   cell of each other
+        '''
+        d = self.deflector
+        positions = d.stars[:, 0] + 1j * d.stars[:, 1]
+        t, dist = self.track_coordinates((1 - d.kappa) * positions + d.gamma * np.conj(positions))
+        # the images of stars just outside the grid may lie inside it
+        x1, x2 = self.cell_coordinates(positions)
+        n1, n2 = self.grid_z.shape
+        near = (np.abs(dist) <= self.max_r) | ((x1 >= -2) & (x1 <= n1 + 1) & (x2 >= -2) & (x2 <= n2 + 1))
+        positions = positions[near]
+        masses = d.stars[near, 2]
+
+        # lens equation at each star without the star itself
+        eps = 1e-6 * d.theta
+        rest = d.w(positions + eps) + d.theta**2 * masses / eps - eps
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dz = d.theta**2 * masses / np.conj(rest - w)
+        return np.concatenate([positions + np.where(np.isfinite(dz), dz, eps), self.pair_z])
+
+    def find_folds(self):
+        '''
+        :return z: positions between neighboring cells of the grid or of the
+                   finer grids with opposite parities, which are crossed by
+                   the image line of the track
+        '''
+        return np.concatenate([self.grid_folds(self.grid_z, self.grid_dist, self.cell_parity),
+                               self.grid_folds(self.fine_z, self.fine_dist, self.fine_parity)])
+
+    @staticmethod
+    def grid_folds(z, dist, p):
+        '''
+        :param z: complex positions of a grid along its last two axes
+        :param dist: signed distances of the mapped positions from the track
+        :param p: parities of the cells of the grid, 0 for excluded cells
+        :return z: positions between neighboring cells with opposite
+                   parities, which are crossed by the image line of the track
+        '''
+        centers = (z[..., :-1, :-1] + z[..., 1:, 1:]) / 2
+
+        corners = [dist[..., i: i + p.shape[-2], j: j + p.shape[-1]] for i in range(2) for j in range(2)]
+        dist_min = np.minimum.reduce(corners)
+        dist_max = np.maximum.reduce(corners)
+
+        folds = []
+        for a, b in [((..., slice(None, -1), slice(None)), (..., slice(1, None), slice(None))),
+                     ((..., slice(None), slice(None, -1)), (..., slice(None), slice(1, None)))]:
+            fold = ((p[a] * p[b] < 0)
+                    & (np.minimum(dist_min[a], dist_min[b]) <= 0) & (np.maximum(dist_max[a], dist_max[b]) >= 0))
+            folds.append(((centers[a] + centers[b]) / 2)[fold])
+        return np.concatenate(folds)
+
+    def find_crossings(self):
+        '''
+        find the points of the critical curves on the image line of the track,
+        with Newton's method on 1/mu and the distance of the mapped position
+        from the track, starting from the folds of the grid
+
+        :return z: complex positions of the points
+        :return t: track parameters at which the source crosses the caustics
+        :return e: null direction of the Jacobian at each point, along which
+                   images are created
+        :return tangent: tangent to the caustic at each crossing
+        :return normal: second order displacement of the caustic, towards the
+                        side with two more images
+        '''
+        d = self.deflector
+        z = self.find_folds()
+        found = np.zeros(z.size, dtype=bool)
+        active = np.arange(z.size)
+
+        for i in range(self.MAX_NUM_ITERS + 1):
+            a, b, c = self.derivatives(z[active], second=True)
+            inv_mu = a**2 - np.abs(b)**2
+            _, dist = self.track_coordinates(d.w(z[active]))
+            done = (np.abs(inv_mu) < self.TOLERANCE) & (np.abs(dist) / d.theta < self.TOLERANCE)
+            found[active[done]] = True
+            if np.all(done) or i == self.MAX_NUM_ITERS:
+                break
+            active, a, b, c, inv_mu, dist = (x[~done] for x in (active, a, b, c, inv_mu, dist))
+
+            # gradients with respect to x1 and x2 of both functions. d_w_d_z
+            # is constant wherever it is differentiable
+            grad_inv_mu = -2 * c * np.conj(b)
+            grad_dist = np.imag(np.conj(self.u) * (a + b)), np.imag(1j * np.conj(self.u) * (a - b))
+            m11, m12 = grad_inv_mu.real, grad_inv_mu.imag
+            m21, m22 = grad_dist
+            with np.errstate(divide='ignore', invalid='ignore'):
+                det = m11 * m22 - m12 * m21
+                dx1 = (m22 * inv_mu - m12 * dist) / det
+                dx2 = (m11 * dist - m21 * inv_mu) / det
+            dz = dx1 + 1j * dx2
+            z[active] -= self.limit(np.where(np.isfinite(dz), dz, 0))
+
+        z = z[found]
+        z = z[self.unique(z, np.zeros(z.size))]
+        a, b, c = self.derivatives(z, second=True)
+        t, _ = self.track_coordinates(d.w(z))
+
+        # along the null direction e of the Jacobian, w(z + s * e) is
+        # w(z) + s^2 / 2 * c * e_bar^2 to second order, while the orthogonal
+        # direction maps onto the caustic, which is generally not
+        # perpendicular to the former
+        e = np.exp(1j * np.angle(b) / 2) * np.where(a > 0, 1j, 1)
+        return z, t, e, a * 1j * e + b * np.conj(1j * e), c * np.conj(e)**2
+
+    @staticmethod
+    def decompose(dw, tangent, normal):
+        '''
+        :return x: component of dw along the tangent to the caustic
+        :return y: component of dw along the second order displacement
+        '''
+        x = np.imag(dw * np.conj(normal)) / np.imag(tangent * np.conj(normal))
+        y = np.imag(dw * np.conj(tangent)) / np.imag(normal * np.conj(tangent))
+        return x, y
+
+    def create_images(self, z, t_c: float, e: complex, tangent: complex, normal: complex, t_path):
+        '''
+        follow the images created at a point of a critical curve as the source
+        moves past the caustic
+
+        :param z: complex position of the point
+        :param t_c: track parameter at which the source crosses the caustic
+        :param e: null direction of the Jacobian at z
+        :param tangent: tangent to the caustic, as from find_crossings
+        :param normal: second order displacement, as from find_crossings
+        :param t_path: increasing track parameters after t_c to follow the
+                       images through
+        :return z: images of the last source position
+        :return d_w_d_z: derivatives with respect to z at the images
+        :return d_w_d_zbar: derivatives with respect to z_bar at the images
+        '''
+        w_c = self.w0 + t_c * self.v
+        # start where the images are close enough to the critical curve for
+        # the second order expansion, and move away from it in geometric
+        # steps as their distance from it grows as the square root of time
+        t_start = t_c + 1e-6 * (t_path[0] - t_c)
+        w_start = self.w0 + t_start * self.v
+        x, y = self.decompose(w_start - w_c, tangent, normal)
+        s = np.sqrt(2 * np.abs(y))
+        images, found = self.newton(np.array([z + x * 1j * e + s * e, z + x * 1j * e - s * e]), w_start)
+        images = images[found]
+        if images.size == 0:
+            return images, np.zeros(0), np.zeros(0, dtype=np.complex128)
+        d_w_d_z, d_w_d_zbar = self.derivatives(images)
+
+        t_geom = t_c + (t_path[0] - t_c) * np.geomspace(1e-5, 1, 11)
+        w_path = self.w0 + np.r_[t_geom, t_path[1:]] * self.v
+        images, d_w_d_z, d_w_d_zbar, found = self.follow(images, d_w_d_z, d_w_d_zbar, w_start, w_path)
+        return images[found], d_w_d_z[found], d_w_d_zbar[found]
+
+    @staticmethod
+    def pair(z, parity):
+        '''
+        pair images of opposite parities closest to each other, as images are
+        created and annihilated
+
+        :return groups: list of arrays of the indices of each pair, or of
+                        single images which have no partner
+        '''
+        groups = []
+        remaining = list(range(z.size))
+        while remaining:
+            i = remaining.pop(0)
+            partners = [j for j in remaining if parity[j] != parity[i]]
+            if partners:
+                j = min(partners, key=lambda j: abs(z[j] - z[i]))
+                remaining.remove(j)
+                groups.append(np.array([i, j]))
+            else:
+                groups.append(np.array([i]))
+        return groups
+
+    def track(self, t):
+        '''
+        :param t: increasing track parameters of the source positions
+        :return images: list of the complex image positions at each position
+        :return d_w_d_z: list of the derivatives of the lens equation with
+                         respect to z at the images
+        :return d_w_d_zbar: list of the derivatives with respect to z_bar
+        :return events: array of shape (num_events, 4) of the index of the
+                        position, the change in the number of images, and the
+                        mean position of the created or annihilated images
+        '''
+        t = np.asarray(t, dtype=np.float64)
+        w = self.w0 + t * self.v
+
+        z = np.concatenate([self.grid_images(w[0]), self.star_images(w[0])])
+        z, found = self.newton(z, w[0])
+        z = z[found]
+        z = z[self.unique(z, np.zeros(z.size))]
+        d_w_d_z, d_w_d_zbar = self.derivatives(z)
+
+        # caustics crossed towards the side with two more images, after the
+        # first position and up to the last
+        z_c, t_c, e_c, tangent_c, normal_c = self.find_crossings()
+        index = np.searchsorted(t, t_c, side='left')
+        creation = (self.decompose(self.v, tangent_c, normal_c)[1] > 0) & (t_c > t[0]) & (index < t.size)
+
+        images = [z]
+        derivatives_z = [d_w_d_z]
+        derivatives_zbar = [d_w_d_zbar]
+        events = []
+
+        for k in range(1, t.size):
+            z_new, a_new, b_new, found = self.follow(z, d_w_d_z, d_w_d_zbar, w[k - 1], w[k: k + 1])
+            # images close to critical curves move too fast for a single step
+            # to stay on their own side of it
+            for num_steps in self.SUBSTEPS:
+                retry = np.flatnonzero(~found)
+                if retry.size == 0:
+                    break
+                w_path = w[k - 1] + (w[k] - w[k - 1]) * np.arange(1, num_steps + 1) / num_steps
+                (z_new[retry], a_new[retry], b_new[retry],
+                 found[retry]) = self.follow(z[retry], d_w_d_z[retry], d_w_d_zbar[retry], w[k - 1], w_path)
+
+            created = [self.create_images(z_c[i], t_c[i], e_c[i], tangent_c[i], normal_c[i], t[k: k + 1])
+                       for i in np.flatnonzero(creation & (index == k))]
+            crossing = np.concatenate([np.full(new[0].size, i) for i, new in enumerate(created)] + [np.zeros(0, dtype=int)])
+
+            # several positions may have converged onto the same image, of
+            # which the tracked one that moved least is kept
+            candidates = np.concatenate([z_new[found]] + [new[0] for new in created])
+            priority = np.concatenate([np.abs(z_new - z)[found], np.full(crossing.size, np.inf)])
+            keep = self.unique(candidates, priority)
+            num_found = np.count_nonzero(found)
+
+            parity = np.sign(d_w_d_z**2 - np.abs(d_w_d_zbar)**2)
+            lost = np.ones(z.size, dtype=bool)
+            lost[np.flatnonzero(found)[keep[:num_found]]] = False
+            for group in self.pair(z[lost], parity[lost]):
+                position = np.mean(z[lost][group])
+                events.append((k, -group.size, position.real, position.imag))
+            positions = z_c[creation & (index == k)]
+            for i, position in enumerate(positions):
+                num_created = np.count_nonzero(keep[num_found:][crossing == i])
+                if num_created > 0:
+                    events.append((k, num_created, position.real, position.imag))
+
+            z = candidates[keep]
+            d_w_d_z = np.concatenate([a_new[found]] + [new[1] for new in created])[keep]
+            d_w_d_zbar = np.concatenate([b_new[found]] + [new[2] for new in created])[keep]
+            images.append(z)
+            derivatives_z.append(d_w_d_z)
+            derivatives_zbar.append(d_w_d_zbar)
+
+        return images, derivatives_z, derivatives_zbar, np.array(events, dtype=np.float64).reshape(-1, 4)
+
+    def boundary(self):
+        '''
+        :return z: closed loop of positions around the boundary of the grid,
+                   bisected where the mapped loop takes steps longer than the
+                   grid spacing, as it does next to stars
+        :return w: mapped positions of the loop
+        '''
+        d = self.deflector
+        z = np.concatenate([self.grid_z[:-1, 0], self.grid_z[-1, :-1], self.grid_z[:0:-1, -1], self.grid_z[0, :0:-1]])
+        w = np.concatenate([self.grid_w[:-1, 0], self.grid_w[-1, :-1], self.grid_w[:0:-1, -1], self.grid_w[0, :0:-1]])
+        for _ in range(self.MAX_NUM_ITERS):
+            long = np.flatnonzero(np.abs(np.roll(w, -1) - w) > self.grid_spacing)
+            if long.size == 0:
+                break
+            mid = (z[long] + np.roll(z, -1)[long]) / 2
+            z = np.insert(z, long + 1, mid)
+            w = np.insert(w, long + 1, d.w(mid))
+        return z, w
+
+    def missing_images(self, t, images, d_w_d_z, d_w_d_zbar):
+        '''
+        by the argument principle, the number of times the mapped boundary of
+        the grid winds around a source position is the number of images
+        inside the grid counted with their parities, plus the number of stars
+        inside it, each of which winds once around its own neighborhood. the
+        winding number at each position of the track is the signed number of
+        times the mapped boundary crosses the track after it
+
+        :param t: track parameters of the source positions
+        :param images: list of the complex image positions at each position
+        :param d_w_d_z: list of the derivatives with respect to z
+        :param d_w_d_zbar: list of the derivatives with respect to z_bar
+        :return missing: boolean array of the positions at which the images
+                         inside the grid do not add up to the winding number.
+                         positions within the grid spacing of the mapped
+                         boundary, which its points do not resolve, are not
+                         checked
+        '''
+        d = self.deflector
+        t = np.asarray(t)
+        n1, n2 = self.grid_z.shape
+
+        def inside(z):
+            x1, x2 = self.cell_coordinates(z)
+            return (x1 >= 0) & (x1 <= n1 - 1) & (x2 >= 0) & (x2 <= n2 - 1)
+
+        # crossings of the track by the segments of the mapped boundary. far
+        # along the track the winding number is 0, and it changes by one at
+        # each crossing, depending on the direction of the segment
+        _, w = self.boundary()
+        t_a, dist_a = self.track_coordinates(w)
+        t_b, dist_b = np.roll(t_a, -1), np.roll(dist_a, -1)
+        crossing = (dist_a <= 0) != (dist_b <= 0)
+        t_c = t_a[crossing] + (t_b - t_a)[crossing] * dist_a[crossing] / (dist_a - dist_b)[crossing]
+        direction = np.sign(dist_b - dist_a)[crossing] * np.sign(np.imag(np.conj(self.step1) * self.step2))
+        order = np.argsort(t_c)
+        t_c = t_c[order]
+        after = np.r_[np.cumsum(direction[order][::-1])[::-1], 0]
+        winding = after[np.searchsorted(t_c, t, side='right')]
+
+        num_stars = np.count_nonzero(inside(d.stars[:, 0] + 1j * d.stars[:, 1]))
+        epoch = np.repeat(np.arange(t.size), [z.size for z in images])
+        z = np.concatenate(images)
+        parity = np.sign(np.concatenate(d_w_d_z)**2 - np.abs(np.concatenate(d_w_d_zbar))**2)
+        signed = np.bincount(epoch[inside(z)], weights=parity[inside(z)], minlength=t.size)
+
+        # distance of each position from the closest crossing
+        index = np.searchsorted(t_c, t)
+        t_c = np.r_[-np.inf, t_c, np.inf]
+        resolved = np.minimum(t - t_c[index], t_c[index + 1] - t) * abs(self.v) > self.grid_spacing
+        return resolved & (np.rint(signed).astype(int) + num_stars != winding)
+
+class MIF(Microlensing):
+    '''
+    CPU implementation of the parameters, star field, and point images of the
+    CUDA library, which follows the images along the track instead of tracing
+    image lines
+    '''
+
+    def __init__(self, dtype=np.float64):
+        super().__init__(dtype)
+
+        self.light_loss = 0.001
+        self.y1 = 0
+        self.y2 = 0
+        self.v1 = 2
+        self.v2 = 3
+        self.write_images = 1
+        self.write_image_lines = 0
+        self.write_magnifications = 1
+
+        # 0 derives the spacing from the masses of the stars
+        self.grid_spacing = 0
+
+        self.max_r = 0
+        self.t = np.zeros(1)
+        self.tracker = None
+
+        self.images = np.zeros(0, dtype=np.complex128)
+        self.images_mags = np.zeros((0, 2), dtype=np.complex128)
+        self.track_num_images = np.zeros(0, dtype=np.int32)
+        self.track_magnifications = np.zeros(0)
+        self.track_centroids = np.zeros(0, dtype=np.complex128)
+        self.track_events = np.zeros((0, 4))
+
+    @property
+    def w0(self):
+        return complex(self.y1, self.y2)
+
+    @property
+    def v(self):
+        return complex(self.v1, self.v2)
+
+    def get_corner_x1(self):
+        return self.corner.real if self.rectangular else abs(self.corner)
+
+    def get_corner_x2(self):
+        return self.corner.imag if self.rectangular else 0
+
+    def get_stars(self):
+        return self.stars
+
+    def get_num_images(self):
+        return self.images.size
+
+    def get_images(self):
+        return self.images.view(np.float64).reshape(-1, 2)
+
+    def get_images_mags(self):
+        return self.images_mags.view(np.float64).reshape(-1, 2, 2)
+
+    def get_num_epochs(self):
+        return self.t.size
+
+    def get_track_centroids(self):
+        return self.track_centroids.view(np.float64).reshape(-1, 2)
+
+    def get_num_track_events(self):
+        return self.track_events.shape[0]
+
+    def check_input_params(self, verbose: int):
+        print_verbose("Checking MIF input parameters...", verbose, 3)
+
+        if not super().check_input_params(verbose):
+            return False
+
+        tiny = np.finfo(self.dtype).tiny
+        if self.light_loss < tiny:
+            print_error(f"Error. light_loss must be >= {tiny}")
+            return False
+        if self.light_loss > 0.01:
+            print_error("Error. light_loss must be <= 0.01")
+            return False
+
+        if self.v == 0:
+            print_error("Error. v must be nonzero")
+            return False
+
+        for name in ['write_images', 'write_image_lines', 'write_magnifications']:
+            if getattr(self, name) not in [0, 1]:
+                print_error(f"Error. {name} must be 1 (true) or 0 (false).")
+                return False
+
+        if self.write_image_lines:
+            print_error("Error. The CPU implementation follows images and does not trace image lines. "
+                        "write_image_lines must be 0 (false).")
+            return False
+
+        if self.grid_spacing < 0:
+            print_error("Error. grid_spacing must be >= 0")
+            return False
+
+        t = self.t
+        if t.ndim != 1 or t.size < 1 or not np.all(np.isfinite(t)) or np.any(np.diff(t) <= 0):
+            print_error("Error. Track parameters must be a strictly increasing 1D array of finite values")
+            return False
+
+        print_verbose("Done checking MIF input parameters.", verbose, 3)
+        return True
+
+    def calculate_derived_params(self, verbose: int):
+        print_verbose("Calculating MIF derived parameters...", verbose, 3)
+
+        if not super().calculate_derived_params(verbose):
+            return False
+
+        self.max_r = self.theta_star * np.sqrt(self.kappa_star * self.mean_mass2 / (self.mean_mass * self.light_loss))
+        print_verbose(f"max_r set to {self.max_r}", verbose, 2)
+
+        # the star field covers the image plane region of every position of
+        # the track, as it does for w0 in the CUDA code
+        w = self.w0 + self.t * self.v
+        region = complex((np.max(np.abs(w.real)) + self.max_r) / abs(1 - self.kappa_tot + self.shear),
+                         (np.max(np.abs(w.imag)) + self.max_r) / abs(1 - self.kappa_tot - self.shear))
+
+        if self.starfile == '':
+            if self.rectangular:
+                self.num_stars = int(np.ceil(self.safety_scale * 2 * region.real * self.safety_scale * 2 * region.imag
+                                             * self.kappa_star / (np.pi * self.theta_star**2 * self.mean_mass)))
+                self.corner = (complex(np.sqrt(region.real / region.imag), np.sqrt(region.imag / region.real))
+                               * np.sqrt(np.pi * self.theta_star**2 * self.num_stars * self.mean_mass / (4 * self.kappa_star)))
+            else:
+                self.num_stars = int(np.ceil(self.safety_scale**2 * abs(region)**2
+                                             * self.kappa_star / (self.theta_star**2 * self.mean_mass)))
+                self.corner = (region / abs(region)
+                               * np.sqrt(self.theta_star**2 * self.num_stars * self.mean_mass / self.kappa_star))
+            print_verbose(f"num_stars set to {self.num_stars}", verbose, 2)
+            print_verbose(f"corner set to {self.corner}", verbose, 2)
+        else:
+            if not self.rectangular:
+                self.corner = region / abs(region) * abs(self.corner)
+                print_verbose(f"corner set to {self.corner}", verbose, 2)
+
+            if ((self.rectangular and (self.corner.real < self.safety_scale * region.real
+                                       or self.corner.imag < self.safety_scale * region.imag))
+                    or (not self.rectangular and abs(self.corner) < self.safety_scale * abs(region))):
+                print_error("Error. The provided star field is not large enough to cover the necessary image plane region.\n"
+                            "Try decreasing the safety_scale, or providing a larger field of stars.")
+                return False
+
+        # error is 10^-7 einstein radii
+        self.alpha_error = self.theta_star * 1e-7
+
+        if not self.calculate_taylor_smooth():
+            return False
+        print_verbose(f"taylor_smooth set to {self.taylor_smooth}", verbose, 2)
+
+        # a tenth of the typical Einstein radius resolves the critical curves
+        # around all but the lightest stars
+        if self.grid_spacing == 0:
+            self.grid_spacing = self.theta_star * np.sqrt(self.mean_mass2 / self.mean_mass) / 10
+        print_verbose(f"grid_spacing set to {self.grid_spacing}", verbose, 2)
+
+        print_verbose("Done calculating MIF derived parameters.", verbose, 3)
+        return True
+
+    def create_tracker(self, verbose: int):
+        print_verbose("Creating image plane grid...", verbose, 1)
+        with stage(self.timings, 'create_grid'):
+            self.tracker = ImageTracker(self.deflector, self.w0, self.v, self.max_r, self.grid_spacing)
+            self.tracker.create_grid(self.t[0], self.t[-1])
+        print_verbose(f"Done creating image plane grid of {self.tracker.grid_z.size} points, "
+                      f"with {self.tracker.fine_z.shape[0]} finer grids around close stars. "
+                      f"Elapsed time: {self.timings['create_grid']} seconds.", verbose, 1)
+        return True
+
+    def find_images(self, verbose: int):
+        print_verbose("Following images along the track...", verbose, 1)
+        t0 = time.perf_counter()
+        with stage(self.timings, 'track_images'):
+            images, d_w_d_z, d_w_d_zbar, self.track_events = self.tracker.track(self.t)
+        print_verbose(f"Done following images. Elapsed time: {time.perf_counter() - t0} seconds.", verbose, 1)
+        print_verbose(f"Number of image creation and annihilation events: {self.track_events.shape[0]}", verbose, 1)
+
+        num_missing = np.count_nonzero(self.tracker.missing_images(self.t, images, d_w_d_z, d_w_d_zbar))
+        if num_missing > 0:
+            print_error(f"Warning. The images at {num_missing} of {self.t.size} positions do not add up to the "
+                        "winding number of the grid boundary. Some images may have been missed.\n"
+                        "Try decreasing the grid_spacing.")
+
+        self.track_num_images = np.array([z.size for z in images], dtype=np.int32)
+        self.images = np.concatenate(images)
+        self.images_mags = np.stack([np.concatenate(d_w_d_z).astype(np.complex128), np.concatenate(d_w_d_zbar)], axis=1)
+
+        mags = np.abs(1 / (self.images_mags[:, 0].real**2 - np.abs(self.images_mags[:, 1])**2))
+        epoch = np.repeat(np.arange(self.t.size), self.track_num_images)
+        self.track_magnifications = np.bincount(epoch, weights=mags, minlength=self.t.size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.track_centroids = (np.bincount(epoch, weights=mags * self.images.real, minlength=self.t.size)
+                                    + 1j * np.bincount(epoch, weights=mags * self.images.imag, minlength=self.t.size)
+                                    ) / self.track_magnifications
+        return True
+
+    def write_files(self, verbose: int):
+        if not super().write_files(verbose, 'mif'):
+            return False
+
+        print_verbose("Writing MIF parameter info...", verbose, 2)
+        fname = f"{self.outfile_prefix}mif_parameter_info.txt"
+        with open(fname, 'a') as f:
+            f.write(f"light_loss {self.light_loss:.9g}\n")
+            f.write(f"w0_1 {self.y1:.9g}\n")
+            f.write(f"w0_2 {self.y2:.9g}\n")
+            f.write(f"v_1 {self.v1:.9g}\n")
+            f.write(f"v_2 {self.v2:.9g}\n")
+            f.write(f"max_r {self.max_r:.9g}\n")
+            f.write(f"grid_spacing {self.grid_spacing:.9g}\n")
+            f.write(f"num_epochs {self.t.size}\n")
+        print_verbose(f"Done writing MIF parameter info to file {fname}", verbose, 1)
+
+        if self.write_images:
+            print_verbose("Writing point images...", verbose, 2)
+            fname = f"{self.outfile_prefix}mif_images.bin"
+            write_array(fname, self.images[None, :], self.dtype)
+            print_verbose(f"Done writing point images to file {fname}", verbose, 1)
+
+            print_verbose("Writing point image magnifications...", verbose, 2)
+            fname = f"{self.outfile_prefix}mif_images_magnifications.bin"
+            write_array(fname, self.images_mags, self.dtype)
+            print_verbose(f"Done writing point image magnifications to file {fname}", verbose, 1)
+
+        if self.write_magnifications and self.t.size > 1:
+            print_verbose("Writing track magnifications and centroids...", verbose, 2)
+            fname = f"{self.outfile_prefix}mif_track.bin"
+            # t, number of images, magnification, centroid x1 and x2
+            write_array(fname, np.column_stack([self.t, self.track_num_images, self.track_magnifications,
+                                                self.track_centroids.real, self.track_centroids.imag]), self.dtype)
+            print_verbose(f"Done writing track magnifications and centroids to file {fname}", verbose, 1)
+
+            print_verbose("Writing track events...", verbose, 2)
+            fname = f"{self.outfile_prefix}mif_track_events.bin"
+            write_array(fname, self.track_events, self.dtype)
+            print_verbose(f"Done writing track events to file {fname}", verbose, 1)
+
+        return True
+
+    def run_track(self, t, verbose: int):
+        '''
+        :param t: increasing track parameters of the source positions
+                  w0 + t * v
+        '''
+        self.t = np.asarray(t, dtype=np.float64)
+        self.timings = {}
+        if not self.check_input_params(verbose):
+            return False
+        if not self.calculate_derived_params(verbose):
+            return False
+        if not self.populate_star_array(verbose):
+            return False
+        if not self.create_tree(verbose):
+            return False
+        if not self.create_tracker(verbose):
+            return False
+        if not self.find_images(verbose):
+            return False
+        return True
+
+    def run(self, verbose: int):
+        # point images of w0 alone
+        return self.run_track(np.zeros(1), verbose)
+
+    def save(self, verbose: int):
+        with stage(self.timings, 'write_files'):
+            return self.write_files(verbose)
+
+
+lib = Library(MIF, np.float64)
@@ -1,10 +1,70 @@
-from . import lib_mif
 from microlensing.Stars.stars import Stars
-from . import plotting
+from microlensing.Util.library_object import LibraryObject, library_state, restore_library_state
+from microlensing.Util.timings import peak_memory, profiled, stage
 
 import numpy as np
-import matplotlib.axes
-from scipy.interpolate import RegularGridInterpolator
+from typing import TYPE_CHECKING
+
+# matplotlib and shapely are only imported once something is plotted
+if TYPE_CHECKING:
+    import matplotlib.axes
+
+
+@profiled
+def accumulate_lines(x, y, lengths, distances, max_deposits: int = 2**20):
+    '''
+    sum over lines of their linear interpolation at the given distances, with
+    each line contributing only between its extreme points. lines that change
+    direction are equivalent to a sum over their monotone segments, and the
+    interpolation of a monotone segment is piecewise linear between
+    consecutive points, so every pair of consecutive points deposits its
+    interpolation onto the distances between them. only those distances are
+    evaluated, and all pairs are processed at once in chunks of at most
+    max_deposits values
+
+    :param x: positions of the points of all lines, concatenated
+    :param y: values of the points of all lines, concatenated
+    :param lengths: number of points in each line
+    :param distances: increasing positions to evaluate the sum at
+    :param max_deposits: maximum number of interpolated values held at once
+    :return result: sum of the interpolated lines at each distance
+    '''
+    result = np.zeros(distances.shape)
+    if x.size < 2:
+        return result
+
+    # pairs of consecutive points within the same line
+    last = np.cumsum(lengths)[lengths > 0] - 1
+    valid = np.ones(x.size - 1, dtype=bool)
+    valid[last[last < x.size - 1]] = False
+    valid &= x[1:] != x[:-1]
+    i = np.flatnonzero(valid)
+
+    x0, x1 = x[i], x[i + 1]
+    y0, y1 = y[i], y[i + 1]
+    slope = (y1 - y0) / (x1 - x0)
+
+    # half open ranges of distances between the points of each pair
+    start = np.searchsorted(distances, np.minimum(x0, x1), side='left')
+    end = np.searchsorted(distances, np.maximum(x0, x1), side='left')
+    counts = end - start
+
+    keep = counts > 0
+    x0, y0, slope, start, counts = x0[keep], y0[keep], slope[keep], start[keep], counts[keep]
+
+    # split the pairs into chunks of about max_deposits deposited values
+    total = np.cumsum(counts)
+    splits = np.searchsorted(total, np.arange(max_deposits, total[-1] if total.size > 0 else 0, max_deposits))
+    for lo, hi in zip(np.concatenate(([0], splits)), np.concatenate((splits, [counts.size]))):
+        if hi <= lo:
+            continue
+        c = counts[lo:hi]
+        owner = np.repeat(np.arange(lo, hi), c)
+        idx = start[owner] + np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+        values = y0[owner] + slope[owner] * (distances[idx] - x0[owner])
+        result += np.bincount(idx, weights=values, minlength=distances.size)
+
+    return result
 
 
 class MIF(object):
@@ -13,7 +73,8 @@ class MIF(object):
                  light_loss: float = None, rectangular: bool = None, approx: bool = None, safety_scale: float = None,
                  starfile: str = None, y1: float = None, y2: float = None, v1: float = None, v2: float = None, random_seed: int = None,
                  write_stars: bool = False, write_images: bool = False, write_image_lines: bool = False, write_magnifications: bool = False,
-                 outfile_prefix: str = None, verbose: int = 0):
+                 outfile_prefix: str = None, verbose: int = 0, backend: str = 'gpu',
+                 grid_spacing: float = None, zero_copy: bool = False):
         '''
         :param kappa_tot: total convergence
         :param shear: shear
@@ -42,11 +103,23 @@ class MIF(object):
         :param write_magnifications: whether to write magnifications or not
         :param outfile_prefix: prefix to be used in output file names
         :param verbose: verbosity level of messages. must be 0, 1, 2, or 3
+        :param backend: library to run on. Options are: gpu (the CUDA library) and cpu (a NumPy implementation
+                        that needs no GPU, and follows the images of a moving source with track)
+        :param grid_spacing: spacing of the image plane grid that the cpu backend finds the initial images and
+                             the caustic crossings of a track with. default is a tenth of the mean Einstein radius
+        :param zero_copy: whether results should be read-only views of the library's memory instead of copies of it
         '''
-        self.lib = lib_mif.lib
+        self.lib = self._library(backend)
+        self.backend = backend
 
-        self.obj = self.lib.MIF_init()
+        # the library object is kept alive by any views of its memory
+        self._handle = LibraryObject(self.lib, 'MIF')
+        self.obj = self._handle.obj
         self.verbose = verbose
+        self.zero_copy = zero_copy
+
+        # time in seconds of each stage of the last run and save
+        self._timings = {}
 
         self.kappa_tot = kappa_tot
         self.shear = shear
@@ -83,10 +156,27 @@ class MIF(object):
         self.write_magnifications = write_magnifications
         
         self.outfile_prefix = outfile_prefix
+        self.grid_spacing = grid_spacing
+
+    @staticmethod
+    def _library(backend: str):
+        '''
+        load the library of a backend on first use
+        '''
+        if backend == 'gpu':
+            from . import lib_mif
+            return lib_mif.lib
+        elif backend == 'cpu':
+            from . import lib_mif_cpu
+            return lib_mif_cpu.lib
+        raise ValueError("backend must be gpu or cpu")
+
+    def __getstate__(self):
+        return library_state(self)
+
+    def __setstate__(self, state):
+        restore_library_state(self, state, self._library(state['backend']), 'MIF')
 
-    def __del__(self):
-        self.lib.MIF_delete(self.obj)
-        
     @property
     def kappa_tot(self):
         return self.lib.get_kappa_tot(self.obj)
@@ -349,6 +439,21 @@ class MIF(object):
         if value is not None:
             self.lib.set_outfile_prefix(self.obj, value.encode('utf-8'))
 
+    @property
+    def grid_spacing(self):
+        if self.backend != 'cpu':
+            return None
+        return self.lib.get_grid_spacing(self.obj)
+    
+    @grid_spacing.setter
+    def grid_spacing(self, value):
+        if value is not None:
+            if self.backend != 'cpu':
+                raise ValueError("grid_spacing is only used by the cpu backend")
+            if value <= 0:
+                raise ValueError("grid_spacing must be > 0")
+            self.lib.set_grid_spacing(self.obj, value)
+
     @property
     def num_stars(self):
         return self.lib.get_num_stars(self.obj)
@@ -357,55 +462,164 @@ class MIF(object):
     def corner(self):
         return (self.lib.get_corner_x1(self.obj), self.lib.get_corner_x2(self.obj))
 
+    def _release_results(self):
+        if self.zero_copy:
+            # results of a previous run are views of memory the library is
+            # about to overwrite
+            self.images = None
+            self.images_inv_mags = None
+            self.images_mags = None
+            self.image_lines = None
+            self.source_lines = None
+            self.image_lines_mags = None
+            self.stars = None
+            self.track_images = None
+            self.track_images_mags = None
+            self.track_magnifications = None
+            self.track_centroids = None
+            self.track_events = None
+            if self._handle.in_use():
+                raise Exception("Results of a previous MIF run are still referenced. "
+                                "Copy or delete them before running again")
+
+    @profiled
     def run(self):
-        if not self.lib.run(self.obj, self.verbose):
-            raise Exception("Error running MIF")
-        
-        self.images = np.ctypeslib.as_array(self.lib.get_images(self.obj),
-                                            shape=(self.lib.get_num_images(self.obj),2)).copy()
-        self.images_inv_mags = np.ctypeslib.as_array(self.lib.get_images_mags(self.obj),
-                                                     shape=(self.lib.get_num_images(self.obj),2,2)).copy()
-        
-        m11 = self.images_inv_mags[:,0,0] + self.images_inv_mags[:,1,0]
-        m12 = self.images_inv_mags[:,1,1] - self.images_inv_mags[:,0,1]
-        m21 = self.images_inv_mags[:,0,1] + self.images_inv_mags[:,1,1]
-        m22 = self.images_inv_mags[:,0,0] - self.images_inv_mags[:,1,0]
-
-        self.images_inv_mags = np.transpose([[m11,m12],[m21,m22]],(2,0,1))
-        self.images_mags = 1 / np.linalg.det(self.images_inv_mags)
-        
-        if self.write_image_lines:
-            n_image_lines = self.lib.get_num_image_lines(self.obj)
-            image_lines_lengths = np.ctypeslib.as_array(self.lib.get_image_lines_lengths(self.obj),
-                                                        shape=(n_image_lines,)).copy()
-            
-            self.image_lines = np.ctypeslib.as_array(self.lib.get_image_lines(self.obj),
-                                                    shape=(self.lib.get_total_image_lines_length(self.obj),2)).copy()
-            self.image_lines = np.split(self.image_lines, np.cumsum(image_lines_lengths))
-            
-            self.source_lines = np.ctypeslib.as_array(self.lib.get_source_lines(self.obj),
-                                                      shape=(self.lib.get_total_image_lines_length(self.obj),2)).copy()
-            self.source_lines = np.split(self.source_lines, np.cumsum(image_lines_lengths))
-            
-            self.image_lines_mags = np.ctypeslib.as_array(self.lib.get_image_lines_mags(self.obj),
-                                                          shape=(self.lib.get_total_image_lines_length(self.obj),)).copy()
-            self.image_lines_mags = np.split(self.image_lines_mags, np.cumsum(image_lines_lengths))
+        self._release_results()
+
+        self._timings = {}
+        with stage(self._timings, 'run'):
+            if not self.lib.run(self.obj, self.verbose):
+                raise Exception("Error running MIF")
+
+        with stage(self._timings, 'copy_out'):
+            self.images = self._handle.array(self.lib.get_images(self.obj),
+                                             shape=(self.lib.get_num_images(self.obj),2), zero_copy=self.zero_copy)
+            self.images_inv_mags = self._inv_mags(self._handle.array(self.lib.get_images_mags(self.obj),
+                                                                     shape=(self.lib.get_num_images(self.obj),2,2),
+                                                                     zero_copy=self.zero_copy))
+            self.images_mags = 1 / np.linalg.det(self.images_inv_mags)
+
+            if self.write_image_lines:
+                n_image_lines = self.lib.get_num_image_lines(self.obj)
+                image_lines_lengths = self._handle.array(self.lib.get_image_lines_lengths(self.obj),
+                                                         shape=(n_image_lines,), zero_copy=self.zero_copy)
+
+                self.image_lines = self._handle.array(self.lib.get_image_lines(self.obj),
+                                                     shape=(self.lib.get_total_image_lines_length(self.obj),2), zero_copy=self.zero_copy)
+                self.image_lines = np.split(self.image_lines, np.cumsum(image_lines_lengths))
+
+                self.source_lines = self._handle.array(self.lib.get_source_lines(self.obj),
+                                                       shape=(self.lib.get_total_image_lines_length(self.obj),2), zero_copy=self.zero_copy)
+                self.source_lines = np.split(self.source_lines, np.cumsum(image_lines_lengths))
+
+                self.image_lines_mags = self._handle.array(self.lib.get_image_lines_mags(self.obj),
+                                                           shape=(self.lib.get_total_image_lines_length(self.obj),), zero_copy=self.zero_copy)
+                self.image_lines_mags = np.split(self.image_lines_mags, np.cumsum(image_lines_lengths))
+
+                self.image_lines = self.image_lines[:-1]
+                self.source_lines = self.source_lines[:-1]
+                self.image_lines_mags = self.image_lines_mags[:-1]
+            else:
+                self.image_lines = None
+                self.source_lines = None
+                self.image_lines_mags = None
+
+            self.stars = Stars(self._handle.array(self.lib.get_stars(self.obj),
+                                                  shape=(self.num_stars, 3), zero_copy=self.zero_copy),
+                               self.rectangular, self.corner, self.theta_star)
+
+        # the light curve depends on the new source lines
+        attrs = ['_magnifications']
+        if getattr(self, '_derived_bins', False):
+            attrs += ['_bins', '_distances']
+        for attr in attrs:
+            if hasattr(self, attr):
+                delattr(self, attr)
+    
+    @staticmethod
+    def _inv_mags(derivatives):
+        '''
+        :param derivatives: real and imaginary parts of dw/dz and dw/dz_bar
+                            at each image, with shape (n, 2, 2)
+        :return inv_mags: inverse magnification matrices, with shape (n, 2, 2)
+        '''
+        m11 = derivatives[:,0,0] + derivatives[:,1,0]
+        m12 = derivatives[:,1,1] - derivatives[:,0,1]
+        m21 = derivatives[:,0,1] + derivatives[:,1,1]
+        m22 = derivatives[:,0,0] - derivatives[:,1,0]
+        return np.transpose([[m11,m12],[m21,m22]],(2,0,1))
+
+    @profiled
+    def track(self, t):
+        '''
+        find the images of the source at the positions w0 + t * v, following
+        them from each position to the next instead of running for each one.
+        only available for the cpu backend
+
+        :param t: increasing track parameters of the source positions
+        :return track_images: list of the image positions at each position,
+                              with shape (n, 2)
+        :return track_magnifications: total magnification at each position
+        :return track_centroids: magnification weighted centroid of the
+                                 images at each position
+        '''
+        if self.backend != 'cpu':
+            raise ValueError("track is only available for the cpu backend")
+        t = np.asarray(t, dtype=float)
+        self._release_results()
+
+        self._timings = {}
+        with stage(self._timings, 'track'):
+            if not self.lib.run_track(self.obj, t, self.verbose):
+                raise Exception("Error running MIF")
+
+        with stage(self._timings, 'copy_out'):
+            num_epochs = self.lib.get_num_epochs(self.obj)
+            num_images = self.lib.get_num_images(self.obj)
+            self.track_num_images = self._handle.array(self.lib.get_track_num_images(self.obj), shape=(num_epochs,))
+            split = np.cumsum(self.track_num_images)[:-1]
+
+            self.images = self._handle.array(self.lib.get_images(self.obj),
+                                             shape=(num_images,2), zero_copy=self.zero_copy)
+            self.images_inv_mags = self._inv_mags(self._handle.array(self.lib.get_images_mags(self.obj),
+                                                                     shape=(num_images,2,2), zero_copy=self.zero_copy))
+            self.images_mags = 1 / np.linalg.det(self.images_inv_mags)
+            self.track_images = np.split(self.images, split)
+            self.track_images_mags = np.split(self.images_mags, split)
+
+            self.track_magnifications = self._handle.array(self.lib.get_track_magnifications(self.obj),
+                                                           shape=(num_epochs,), zero_copy=self.zero_copy)
+            self.track_centroids = self._handle.array(self.lib.get_track_centroids(self.obj),
+                                                      shape=(num_epochs,2), zero_copy=self.zero_copy)
+            # epoch, number of images created (> 0) or annihilated (< 0),
+            # and position of the event
+            self.track_events = self._handle.array(self.lib.get_track_events(self.obj),
+                                                   shape=(self.lib.get_num_track_events(self.obj),4), zero_copy=self.zero_copy)
 
-            self.image_lines = self.image_lines[:-1]
-            self.source_lines = self.source_lines[:-1]
-            self.image_lines_mags = self.image_lines_mags[:-1]
-        else:
             self.image_lines = None
             self.source_lines = None
             self.image_lines_mags = None
-        
-        self.stars = Stars(np.ctypeslib.as_array(self.lib.get_stars(self.obj),
-                                                 shape=(self.num_stars, 3)).copy(),
-                           self.rectangular, self.corner, self.theta_star)
-    
+            self.stars = Stars(self._handle.array(self.lib.get_stars(self.obj),
+                                                  shape=(self.num_stars, 3), zero_copy=self.zero_copy),
+                               self.rectangular, self.corner, self.theta_star)
+
+        return self.track_images, self.track_magnifications, self.track_centroids
+
+    @profiled
     def save(self):
-        if not self.lib.save(self.obj, self.verbose):
-            raise Exception("Error saving MIF")
+        with stage(self._timings, 'save'):
+            if not self.lib.save(self.obj, self.verbose):
+                raise Exception("Error saving MIF")
+
+    @property
+    def timings(self):
+        '''
+        time in seconds of each stage of the last run and save, and the peak
+        memory of the process in bytes. the cpu backend also reports the
+        stages within the library
+        '''
+        timings = dict(self.lib.get_timings(self.obj)) if self.backend == 'cpu' else {}
+        return {**timings, **self._timings, 'peak_memory': peak_memory()}
 
     # contours containing 90, 99, and 99.9 % of the magnification on average
     @property
@@ -427,22 +641,70 @@ class MIF(object):
                          [self.y2 * self.mu2 - self.stars.r999 * np.abs(self.mu2),
                           self.y2 * self.mu2 + self.stars.r999 * np.abs(self.mu2)]])
 
+    def set_bins(self, dw: float = None, x_min: float = None, x_max: float = None, num_bins: int = None):
+        '''
+        set the bins of the light curve along the direction of travel. values
+        that are not provided are derived from the source lines
+
+        :param dw: step size in the source plane. default is 0.001 unless
+                   num_bins is provided
+        :param x_min: start of the bins. default is the smallest distance of
+                      the source lines from w0
+        :param x_max: end of the bins. default is the largest distance of the
+                      source lines from w0
+        :param num_bins: number of bins between x_min and x_max. takes
+                         precedence over dw
+        '''
+        # a range taken from the source lines is derived again from those of
+        # later runs
+        derived = x_min is None or x_max is None
+        if derived:
+            if getattr(self, 'source_lines', None) is None:
+                raise ValueError("source lines are needed to derive the range of the bins. "
+                                 "Provide x_min and x_max or set write_image_lines to True")
+            x = self._source_distances()[0]
+            if x.size == 0:
+                raise ValueError("source lines have no points to derive the range of the bins from. "
+                                 "Provide x_min and x_max")
+            if x_min is None:
+                x_min = np.min(x)
+            if x_max is None:
+                x_max = np.max(x)
+        if x_max <= x_min:
+            raise ValueError("x_max must be > x_min")
+
+        if num_bins is not None:
+            if num_bins < 1:
+                raise ValueError("num_bins must be >= 1")
+            self.bins = np.linspace(x_min, x_max, num_bins + 1)
+        else:
+            if dw is None:
+                dw = 0.001 # arbitrary step size in source plane
+            if dw <= 0:
+                raise ValueError("dw must be > 0")
+            bins = np.arange(x_min, x_max, dw)
+            self.bins = np.insert(bins, bins.size, x_max)
+        self._derived_bins = derived
+
     @property
     def bins(self):
         try:
             return self._bins
         except AttributeError:
-            dw = 0.001 # arbitrary step size in source plane
-
-            # x = [np.dot(what - self.w0, self.v / np.linalg.norm(self.v)) for what in self.source_lines]
-            # x_min = np.min([np.min(what) for what in x])
-            # x_max = np.max([np.max(what) for what in x])
-            x_min = -25
-            x_max = 25
-
-            self._bins = np.arange(x_min, x_max, dw)
-            self._bins = np.insert(self._bins, self._bins.size, x_max)
+            self.set_bins()
             return self._bins
+
+    @bins.setter
+    def bins(self, value):
+        value = np.asarray(value, dtype=float)
+        if value.ndim != 1 or value.size < 2 or np.any(np.diff(value) <= 0):
+            raise ValueError("bins must be an increasing 1D array of at least 2 values")
+        self._bins = value
+        self._derived_bins = False
+        # light curve must be calculated again for the new bins
+        for attr in ['_distances', '_magnifications']:
+            if hasattr(self, attr):
+                delattr(self, attr)
         
     @property
     def distances(self):
@@ -451,48 +713,38 @@ class MIF(object):
         except AttributeError:
             self._distances = (self.bins[:-1] + self.bins[1:]) / 2
             return self._distances
+
+    def _source_distances(self):
+        '''
+        distances of all source line points from w0 along the direction of
+        travel, and the number of points in each line
+        '''
+        lengths = np.array([len(src) for src in self.source_lines], dtype=int)
+        if lengths.sum() == 0:
+            return np.zeros(0), lengths
+        x = np.dot(np.concatenate(self.source_lines) - self.w0, self.v / np.linalg.norm(self.v))
+        return x, lengths
         
     @property
     def magnifications(self):
         try:
             return self._magnifications
         except AttributeError:
-            self._magnifications = np.zeros(self.distances.shape)
-
-            for src, mu in zip(self.source_lines, self.image_lines_mags):
-                tmp_x = np.dot(src - self.w0, self.v / np.linalg.norm(self.v))
-                tmp_y = np.abs(mu)
-
-                # find where direction changes in source plane
-                sgn = np.sign(tmp_x[1:] - tmp_x[:-1])
-                sgn = np.insert(sgn, 0, sgn[0])
-
-                # riffle so that slices start and end where sgn changes
-                where = np.where(sgn[1:] != sgn[:-1])[0]
-                where = np.ravel(np.column_stack((where + 1, where)))
-
-                # split and remove empty slices
-                tmp_x = np.split(tmp_x, where)
-                tmp_x = [what for what in tmp_x if not len(what)==0]
-
-                tmp_y = np.split(tmp_y, where)
-                tmp_y = [what for what in tmp_y if not len(what)==0]
-
-                # interpolate and evaluate at bin centers
-                for a, b in zip(tmp_x, tmp_y):
-                    interp = RegularGridInterpolator([a], b, bounds_error=False, fill_value=0)
-                    self._magnifications += interp(self._distances)
-            
+            with stage(self._timings, 'magnifications'):
+                x, lengths = self._source_distances()
+                mu = np.abs(np.concatenate(self.image_lines_mags)) if lengths.sum() > 0 else np.zeros(0)
+                self._magnifications = accumulate_lines(x, mu, lengths, self.distances)
             return self._magnifications
         
     @property
     def magnitudes(self):
         return -2.5 * np.log10(np.abs(self.magnifications / self.mu_ave))
 
-    def plot_images(self, ax: matplotlib.axes.Axes, s=1,
+    def plot_images(self, ax: 'matplotlib.axes.Axes', s=1,
                     is_ellipse=True, log_area=False, mu_min=10**-3,
                     center_of_light = False,
                     **kwargs):
+        from . import plotting
 
         ax.add_collection(plotting.Images(self.images, self.images_inv_mags,
                                           s, is_ellipse, log_area, mu_min))
@@ -500,12 +752,12 @@ class MIF(object):
         if center_of_light:            
             ax.add_patch(plotting.CenterOfLight(self.images, self.images_inv_mags, s=s))
 
-    def plot_image_lines(self, ax: matplotlib.axes.Axes, color='black', **kwargs):
+    def plot_image_lines(self, ax: 'matplotlib.axes.Axes', color='black', **kwargs):
 
         for what in self.image_lines:
             ax.plot(*what.T, color=color, **kwargs)
 
-    def plot_lightcurve(self, ax: matplotlib.axes.Axes, plot_magnitudes=False, **kwargs):
+    def plot_lightcurve(self, ax: 'matplotlib.axes.Axes', plot_magnitudes=False, **kwargs):
         if plot_magnitudes:
             dat = self.magnitudes
         else:
@@ -1,13 +1,124 @@
 try:
     import cupy as np
-    from cupyx.scipy.ndimage import distance_transform_edt, rotate
+    from cupyx.scipy.ndimage import distance_transform_edt
 except ImportError:
     import numpy as np
-    from scipy.ndimage import distance_transform_edt, rotate
+    from scipy.ndimage import distance_transform_edt
 
 from .ncc import NCC
+from microlensing.Util.timings import profiled
 
+import numpy
 
+
+def _run_distances(vals, no_distance: int):
+    '''
+    distance along the rows from every pixel to the nearest pixel with a
+    different value, in pixels
+
+    :param vals: 2D array of values
+    :param no_distance: distance for pixels whose row has no different value
+    '''
+    num_rows, num_cols = vals.shape
+    cols = np.broadcast_to(np.arange(num_cols), vals.shape)
+
+    # columns of the nearest different pixels before and after each pixel
+    change = np.ones(vals.shape, dtype=bool)
+    change[:, 1:] = vals[:, 1:] != vals[:, :-1]
+    run_first = np.maximum.accumulate(np.where(change, cols, 0), axis=1)
+    run_end = np.ones(vals.shape, dtype=bool)
+    run_end[:, :-1] = change[:, 1:]
+    run_last = np.minimum.accumulate(np.where(run_end, cols, num_cols - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    before = np.where(run_first > 0, cols - run_first + 1, no_distance)
+    after = np.where(run_last < num_cols - 1, run_last - cols + 1, no_distance)
+    return np.minimum(before, after), run_last
+
+def label_distances_squared(vals):
+    '''
+    squared distance from every pixel to the nearest pixel with a different
+    value, in pixels. this is the same as running distance_transform_edt on
+    the mask of each value in turn, but takes a single pass over the map
+
+    the transform is separable. for a pixel of value L and another column x'
+    in its row, the distance within column x' to the nearest pixel not of
+    value L is 0 if pixel x' is not of value L, and is otherwise the distance
+    g(x') to the nearest different pixel in the column, which does not depend
+    on L. the squared distance is then the smaller of the squared distance to
+    the ends of the run of value L containing the pixel, and the minimum of
+    (x - x')^2 + g(x')^2 over the run. the latter is found with the lower
+    envelope of parabolas of Meijster et al. (2000), restarted at every run,
+    for all rows at once
+
+    :param vals: 2D array of values
+    :return distances: int64 squared distances. pixels without any different
+                       pixel in their row or column use a distance of
+                       num_rows + num_cols there
+    '''
+    num_rows, num_cols = vals.shape
+    no_distance = num_rows + num_cols
+
+    g = _run_distances(vals.T, no_distance)[0].T.astype(np.int64)
+    h, run_last = _run_distances(vals, no_distance)
+    f = g**2
+
+    change = np.ones(vals.shape, dtype=bool)
+    change[:, 1:] = vals[:, 1:] != vals[:, :-1]
+
+    # stacks of parabolas forming the lower envelope of each row, with the
+    # column s of each parabola and the column t where it becomes lowest.
+    # each run occupies a contiguous part of the stack starting at base
+    s = np.zeros(vals.shape, dtype=np.int64)
+    t = np.zeros(vals.shape, dtype=np.int64)
+    top = np.zeros(vals.shape, dtype=np.int64)
+    q = np.zeros(num_rows, dtype=np.int64)
+    base = np.zeros(num_rows, dtype=np.int64)
+
+    for u in range(1, num_cols):
+        new = np.flatnonzero(change[:, u])
+        q[new] += 1
+        base[new] = q[new]
+        s[new, q[new]] = u
+        t[new, q[new]] = u
+
+        # remove parabolas that are nowhere lower than the new one within the run
+        old = np.flatnonzero(~change[:, u])
+        pop = old
+        while pop.size > 0:
+            qp = q[pop]
+            tp = t[pop, qp]
+            sp = s[pop, qp]
+            pop = pop[(tp - sp)**2 + f[pop, sp] > (tp - u)**2 + f[pop, u]]
+            q[pop] -= 1
+            pop = pop[q[pop] >= base[pop]]
+
+        empty = old[q[old] < base[old]]
+        rest = old[q[old] >= base[old]]
+
+        q[empty] = base[empty]
+        s[empty, q[empty]] = u
+
+        sr = s[rest, q[rest]]
+        w = 1 + (u**2 - sr**2 + f[rest, u] - f[rest, sr]) // (2 * (u - sr))
+        rest, w = rest[w <= run_last[rest, u]], w[w <= run_last[rest, u]]
+        q[rest] += 1
+        s[rest, q[rest]] = u
+        t[rest, q[rest]] = w
+
+        top[:, u] = q
+
+    rows = np.arange(num_rows)
+    distances = np.empty(vals.shape, dtype=np.int64)
+    for u in range(num_cols - 1, -1, -1):
+        last = run_last[:, u] == u
+        q[last] = top[last, u]
+        su = s[rows, q]
+        distances[:, u] = (u - su)**2 + f[rows, su]
+        q[t[rows, q] == u] -= 1
+
+    return np.minimum(distances, h.astype(np.int64)**2)
+
+@profiled
 def expanding_source(ncc: NCC):
     '''
     :param ncc: formally, an NCC instance that has ran and has a number of
@@ -23,20 +134,16 @@ def expanding_source(ncc: NCC):
     else:
         vals = ncc.num_caustic_crossings
 
-    d_caustic = np.zeros(vals.shape)
-
-    try:
+    if isinstance(vals, numpy.ndarray):
+        # one pass over the map regardless of the number of values
+        d_caustic = np.sqrt(label_distances_squared(vals))
+    else:
+        d_caustic = np.zeros(vals.shape)
         for i in range(np.min(vals).get(), 
                        np.max(vals).get() + 1):
             mask = (vals==i)
             distances = distance_transform_edt(mask)
             d_caustic[mask] = distances[mask]
-    except AttributeError:
-        for i in range(np.min(vals), 
-                       np.max(vals) + 1):
-            mask = (vals==i)
-            distances = distance_transform_edt(mask)
-            d_caustic[mask] = distances[mask]
     d_caustic = d_caustic * ncc.pixel_scales[0]
 
     try:
@@ -44,53 +151,98 @@ def expanding_source(ncc: NCC):
     except AttributeError:
         return d_caustic
 
-def moving_source(ncc: NCC, angle: float = 90):
+def _distances_along_lines(vals, slope: float):
+    '''
+    distance to the nearest different valued pixel, traveling left along
+    digital lines of the given slope. the line through a pixel moves one column
+    left each step, and up by the change in round(column * slope), so every
+    pixel lies on exactly one line and no values are resampled. borders count
+    as different pixel values, and distances are in units of pixels
+
+    :param vals: 2D array of values
+    :param slope: rows moved up per column moved left, between 0 and 1
+    '''
+    num_rows, num_cols = vals.shape
+
+    offsets = np.floor(np.arange(num_cols) * slope + 0.5).astype(int)
+    max_offset = int(offsets[-1])
+
+    # shear the array so that each line is a row. entries outside the array
+    # are invalid, and only occur at the ends of lines
+    rows = np.arange(num_rows + max_offset)[:, None] - max_offset + offsets[None, :]
+    valid = (rows >= 0) & (rows < num_rows)
+    cols = np.broadcast_to(np.arange(num_cols), rows.shape)
+    sheared = vals[np.clip(rows, 0, num_rows - 1), cols]
+
+    # runs of equal values along the lines start at the first valid pixel of
+    # each line and wherever the value changes
+    change = np.ones(rows.shape, dtype=bool)
+    change[:, 1:] = ~valid[:, :-1] | (sheared[:, 1:] != sheared[:, :-1])
+    change = (change | ~valid).ravel()
+
+    run = np.cumsum(change) - 1
+    run_start = np.flatnonzero(change)
+    steps = np.arange(change.size) - run_start[run]
+
+    # each step along a line moves one column and up to one row
+    step_length = np.sqrt(1 + slope**2)
+    distances = np.zeros(vals.shape)
+    distances[rows[valid], cols[valid]] = (steps.reshape(rows.shape)[valid] + 0.5) * step_length
+    return distances
+
+@profiled
+def moving_source(ncc: NCC, angle = 90):
     '''
     :param ncc: formally, an NCC instance that has ran and has a number of
                 caustic crossings map. In general, any object that has
                 attributes num_caustic_crossings, center, half_length,
                 num_pixels, and pixel_scales, in (y1,y2) coordinates
-    :param angle: angle the source travels at with respect to the y1 axis
+    :param angle: angle the source travels at with respect to the y1 axis, in
+                  degrees. may be a collection of angles, in which case the
+                  distances for each angle are stacked along the first axis
+    :return d_caustic: distance from every pixel to the next caustic crossing
+                       in the direction of travel
     '''
     # pixels must be square for distance calculations
     assert ncc.pixel_scales[0] == ncc.pixel_scales[1]
 
-    def closest_distance_per_row(a):
-        '''
-        calculate the distance to the nearest different valued pixel, 
-        traveling left along the row. borders count as different pixel values.
-        we note that distances have a minimum of 0.5, as the center of a pixel
-        is at least 0.5 from its border. for example,
-        [1,2,2,1,1,2,2,2] returns [0.5, 0.5, 1.5, 0.5, 1.5, 0.5, 1.5, 2.5]
-        '''
-        distances = np.ones(a.shape, dtype=int)
-        mask = np.ones(a.shape)
-        mask[:,1:] = (a[:, 1:] != a[:, :-1])
-        for i, _ in enumerate(a):
-            idx = np.flatnonzero(mask[i])
-            if idx.size > 0:
-                distances[i, idx[1:]] = idx[:-1] - idx[1:] + 1
-
-        return distances.cumsum(1) - 0.5
-
     if not isinstance(ncc.num_caustic_crossings, np.ndarray):
         vals = np.array(ncc.num_caustic_crossings)
     else:
         vals = ncc.num_caustic_crossings
 
-    # add 180 to angle since we calculate distances left along a row, 
-    # but an angle of 0 is to the right
-    # negate the angle, as array is rotated opposite relative to direction of travel
-    d_caustic = closest_distance_per_row(rotate(vals, 
-                                                -(angle + 180), reshape=True, order=0))
-    d_caustic = rotate(d_caustic, angle + 180, reshape=True, order=0)
-    d_caustic = d_caustic * ncc.pixel_scales[0] # scale pixel distances to physical
+    angles = np.atleast_1d(np.asarray(angle, dtype=float))
+    try:
+        angles = angles.get()
+    except AttributeError:
+        pass
 
-    # remove borders from rotations
-    dy1 = (d_caustic.shape[1] - ncc.num_pixels_y1) // 2
-    dy2 = (d_caustic.shape[0] - ncc.num_pixels_y2) // 2
-    d_caustic = d_caustic[dy2:dy2 + ncc.num_pixels_y2,
-                          dy1:dy1 + ncc.num_pixels_y1]
+    d_caustic = np.zeros((angles.size,) + vals.shape)
+    for i, theta in enumerate(angles.tolist()):
+        # direction of travel in array coordinates. row 0 is the top of the
+        # map, so travel in +y2 is toward lower rows
+        dcol = np.cos(np.radians(theta)).item()
+        drow = -np.sin(np.radians(theta)).item()
+
+        # orient the array so that travel is left along the columns and up
+        # along the rows, with at most one row per column
+        transpose = abs(drow) > abs(dcol)
+        if transpose:
+            dcol, drow = drow, dcol
+        flip_cols = dcol > 0
+        flip_rows = drow > 0
+
+        a = vals.T if transpose else vals
+        a = a[::-1 if flip_rows else 1, ::-1 if flip_cols else 1]
+
+        distances = _distances_along_lines(a, abs(drow) / abs(dcol))
+
+        distances = distances[::-1 if flip_rows else 1, ::-1 if flip_cols else 1]
+        d_caustic[i] = distances.T if transpose else distances
+
+    d_caustic = d_caustic * ncc.pixel_scales[0] # scale pixel distances to physical
+    if np.ndim(angle) == 0:
+        d_caustic = d_caustic[0]
 
     try:
         return d_caustic.get()
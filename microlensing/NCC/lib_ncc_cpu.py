@@ -0,0 +1,353 @@
+from microlensing.Util.microlensing_cpu import Library, print_verbose, print_error
+from microlensing.Util.timings import stage
+from microlensing.Util.util import write_array, write_hist
+
+import numpy as np
+import os
+import time
+
+
+'''
+number of caustic crossings maps from the caustics written by CCF, without a
+GPU. rather than testing every pixel against every caustic segment, each
+segment deposits a signed crossing at the pixel where it crosses the center
+line of each row of pixels, and a prefix sum along the rows turns these into
+the number of caustics crossed by a line from the pixel to infinity in the +y1
+direction. this is polygon scan conversion with a winding number, and costs
+O(segments * rows crossed + pixels)
+
+maps are oversampled by 2^over_sample along both axes and reduced by taking
+the maximum over each final pixel, as in the CUDA library. the oversampled map
+is computed one tile at a time, so only a tile of it is ever held in memory
+'''
+
+
+def read_complex_array(fname: str):
+    '''
+    Read in a binary file of a 2d array of complex numbers, determining the
+    precision from the size of the file
+
+    :param fname: name of the .bin file to read
+    :return vals: complex array of shape (nrows, ncols)
+    '''
+    if not fname.endswith('.bin'):
+        raise ValueError(f"File {fname} is not a .bin file")
+
+    fsize = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        nrows, ncols = (int(n) for n in np.fromfile(f, dtype=np.int32, count=2))
+        if nrows < 1 or ncols < 1:
+            raise ValueError(f"File {fname} does not contain valid values for num_rows and num_cols")
+
+        for dtype in [np.float32, np.float64]:
+            if fsize == 8 + nrows * ncols * 2 * np.dtype(dtype).itemsize:
+                vals = np.fromfile(f, dtype=dtype).astype(np.float64)
+                return (vals[0::2] + 1j * vals[1::2]).reshape(nrows, ncols)
+
+    raise ValueError(f"Size of file {fname} does not match num_rows and num_cols")
+
+
+class CrossingRaster():
+    '''
+    signed crossings of caustic segments with the center lines of the rows of
+    an oversampled pixel grid. rows are counted from the bottom of the map
+    '''
+
+    def __init__(self, caustics, center_y: complex, half_length_y: complex, num_pixels_y):
+        '''
+        :param caustics: complex array of caustics of shape (nrows, ncols).
+                         consecutive points of a row form the segments
+        :param center_y: center of the map
+        :param half_length_y: half lengths of the map
+        :param num_pixels_y: (num_pixels_y1, num_pixels_y2) of the oversampled grid
+        '''
+        self.num_pixels_y = num_pixels_y
+
+        # positions in units of pixels from the lower left corner of the map
+        w = caustics - center_y + half_length_y
+        w = (w.real * num_pixels_y[0] / (2 * half_length_y.real)
+             + 1j * w.imag * num_pixels_y[1] / (2 * half_length_y.imag))
+
+        p0 = w[:, :-1].ravel()
+        p1 = w[:, 1:].ravel()
+
+        # a segment crosses the center line k + 0.5 of the rows k it spans
+        lo = np.floor(np.minimum(p0.imag, p1.imag) + 0.5)
+        hi = np.floor(np.maximum(p0.imag, p1.imag) + 0.5)
+        valid = np.isfinite(p0) & np.isfinite(p1)
+        lo = np.clip(np.where(valid, lo, 0), 0, num_pixels_y[1]).astype(np.int64)
+        hi = np.clip(np.where(valid, hi, 0), 0, num_pixels_y[1]).astype(np.int64)
+
+        # segments on which a line from a pixel center to the right leaves a
+        # caustic region (segments going up, as caustics are traced
+        # clockwise) subtract one from the pixels to their left, and segments
+        # going down add one
+        keep = hi > lo
+        self.p0 = p0[keep]
+        self.p1 = p1[keep]
+        self.lo = lo[keep]
+        self.hi = hi[keep]
+        self.sign = np.where(self.p0.imag < self.p1.imag, -1, 1).astype(np.int32)
+
+    def band_segments(self, num_rows: int):
+        '''
+        segments crossing each band of num_rows rows
+
+        :param num_rows: number of rows in a band
+        :return segments: list with the indices of the segments of each band
+        '''
+        num_bands = -(-self.num_pixels_y[1] // num_rows)
+        first = self.lo // num_rows
+        count = (self.hi - 1) // num_rows - first + 1
+
+        idx = np.repeat(np.arange(first.size), count)
+        band = np.repeat(first - np.cumsum(count) + count, count) + np.arange(idx.size)
+        order = np.argsort(band, kind='stable')
+        edges = np.searchsorted(band[order], np.arange(num_bands + 1))
+        return [idx[order[edges[i]: edges[i + 1]]] for i in range(num_bands)]
+
+    def crossings(self, segments, row0: int, row1: int):
+        '''
+        crossings of segments with rows [row0, row1)
+
+        :param segments: indices of the segments
+        :return rows: rows of the crossings, relative to row0
+        :return cols: last column of pixels whose center is left of the
+                      crossing. may be < 0 or >= num_pixels_y1
+        :return sign: sign of the crossing
+        '''
+        lo = np.maximum(self.lo[segments], row0)
+        hi = np.minimum(self.hi[segments], row1)
+        count = hi - lo
+
+        seg = np.repeat(segments, count)
+        rows = np.repeat(lo - np.cumsum(count) + count, count) + np.arange(seg.size)
+
+        p0 = self.p0[seg]
+        p1 = self.p1[seg]
+        x = p0.real + (rows + 0.5 - p0.imag) * (p1.real - p0.real) / (p1.imag - p0.imag)
+        cols = np.floor(x + 0.5).astype(np.int64) - 1
+
+        return rows - row0, cols, self.sign[seg]
+
+
+def _accumulate_tile(rows, cols, sign, num_rows: int, col0: int, col1: int):
+    '''
+    number of caustic crossings of a tile of the oversampled grid, from the
+    crossings of the rows of the tile
+
+    :param rows: rows of the crossings within the tile
+    :param cols: last column of pixels each crossing applies to
+    :param sign: sign of the crossings
+    :param num_rows: number of rows of the tile
+    :param col0: first column of the tile
+    :param col1: one past the last column of the tile
+    :return num: array of shape (num_rows, col1 - col0)
+    '''
+    width = col1 - col0
+
+    # a crossing applies to columns [0, col], so the tile starts with every
+    # crossing with col >= col0 and drops each one after its column
+    use = cols >= col0
+    rows, cols, sign = rows[use], cols[use], sign[use]
+
+    delta = np.bincount(rows * (width + 1), sign, minlength=num_rows * (width + 1))
+    end = np.minimum(cols - col0 + 1, width)
+    delta -= np.bincount(rows * (width + 1) + end, sign, minlength=num_rows * (width + 1))
+
+    delta = delta.reshape(num_rows, width + 1)[:, :width]
+    return np.cumsum(delta, axis=1).astype(np.int32)
+
+
+class NCC():
+    '''
+    CPU implementation of the number of caustic crossings of the CUDA library
+    '''
+
+    # maximum number of oversampled pixels in a tile
+    MAX_TILE_PIXELS = 2**22
+
+    def __init__(self, dtype=np.float64):
+        self.dtype = dtype
+
+        self.infile_prefix = './'
+        self.center_y1 = 0
+        self.center_y2 = 0
+        self.half_length_y1 = 5
+        self.half_length_y2 = 5
+        self.num_pixels_y1 = 1000
+        self.num_pixels_y2 = 1000
+        self.over_sample = 2
+        self.write_maps = 1
+        self.write_histograms = 1
+        self.outfile_prefix = './'
+
+        self.caustics = None
+        self.num_crossings = None
+        self.histogram = None
+        self.t_ncc = 0
+        self.t_reduce = 0
+
+        # time in seconds of each stage of the last run
+        self.timings = {}
+
+    def check_input_params(self, verbose: int):
+        print_verbose("Checking input parameters...", verbose, 3)
+
+        tiny = np.finfo(self.dtype).tiny
+
+        if self.half_length_y1 < tiny or self.half_length_y2 < tiny:
+            print_error(f"Error. half_length_y1 and half_length_y2 must both be >= {tiny}")
+            return False
+
+        if self.num_pixels_y1 < 1 or self.num_pixels_y2 < 1:
+            print_error("Error. num_pixels_y1 and num_pixels_y2 must both be integers > 0")
+            return False
+
+        if self.over_sample < 0:
+            print_error("Error. over_sample must be an integer >= 0")
+            return False
+
+        for name in ['write_maps', 'write_histograms']:
+            if getattr(self, name) not in [0, 1]:
+                print_error(f"Error. {name} must be 1 (true) or 0 (false).")
+                return False
+
+        print_verbose("Done checking input parameters.", verbose, 3)
+        return True
+
+    def read_caustics(self, verbose: int):
+        print_verbose("Reading in caustics...", verbose, 1)
+        t0 = time.perf_counter()
+
+        fname = f"{self.infile_prefix}ccf_caustics.bin"
+        try:
+            self.caustics = read_complex_array(fname)
+        except (OSError, ValueError) as e:
+            print_error(f"Error. Unable to read caustics from file {fname}\n{e}")
+            return False
+
+        num_rows, num_cols = self.caustics.shape
+        print_verbose(f"num_rows set to: {num_rows}\nnum_cols set to: {num_cols}", verbose, 2)
+        if num_cols < 2:
+            print_error(f"Error. File {fname} does not contain valid values for num_rows and num_cols.")
+            return False
+
+        print_verbose(f"Done reading in caustics. Elapsed time: {time.perf_counter() - t0} seconds.", verbose, 1)
+        return True
+
+    def tile_shape(self):
+        '''
+        :return num_rows: number of rows of final pixels in a tile
+        :return num_cols: number of columns of final pixels in a tile
+        '''
+        factor = 4**self.over_sample
+        num_cols = min(self.num_pixels_y1, max(1, self.MAX_TILE_PIXELS // factor))
+        num_rows = min(self.num_pixels_y2, max(1, self.MAX_TILE_PIXELS // (factor * num_cols)))
+        return num_rows, num_cols
+
+    def calculate_num_caustic_crossings(self, verbose: int):
+        print_verbose("Calculating number of caustic crossings...", verbose, 1)
+        t0 = time.perf_counter()
+
+        f = 2**self.over_sample
+        npix1, npix2 = self.num_pixels_y1, self.num_pixels_y2
+        raster = CrossingRaster(self.caustics, complex(self.center_y1, self.center_y2),
+                                complex(self.half_length_y1, self.half_length_y2), (npix1 * f, npix2 * f))
+
+        tile_rows, tile_cols = self.tile_shape()
+        bands = raster.band_segments(tile_rows * f)
+
+        # rows of the map are counted from the top
+        num = np.empty((npix2, npix1), dtype=np.int32)
+        self.t_reduce = 0
+        for i, segments in enumerate(bands):
+            j0 = i * tile_rows
+            j1 = min(j0 + tile_rows, npix2)
+            rows, cols, sign = raster.crossings(segments, j0 * f, j1 * f)
+
+            for k0 in range(0, npix1, tile_cols):
+                k1 = min(k0 + tile_cols, npix1)
+                tile = _accumulate_tile(rows, cols, sign, (j1 - j0) * f, k0 * f, k1 * f)
+
+                t1 = time.perf_counter()
+                # a final pixel is the maximum of the pixels it was oversampled into
+                tile = tile.reshape(j1 - j0, f, k1 - k0, f).max(axis=(1, 3))
+                num[npix2 - j1: npix2 - j0, k0: k1] = tile[::-1]
+                self.t_reduce += time.perf_counter() - t1
+
+            if verbose >= 1:
+                print(f"\r{100 * (i + 1) // len(bands)}% complete", end='', flush=True)
+
+        self.num_crossings = num
+        self.t_ncc = time.perf_counter() - t0 - self.t_reduce
+        print_verbose(f"\nDone calculating number of caustic crossings. Elapsed time: {self.t_ncc + self.t_reduce} seconds.",
+                      verbose, 1)
+
+        if np.min(num) < 0:
+            print_error("Error. Number of caustic crossings should be >= 0")
+            return False
+
+        return True
+
+    def create_histograms(self, verbose: int):
+        if not self.write_histograms:
+            return True
+
+        print_verbose("Creating histograms...", verbose, 2)
+        min_num = int(np.min(self.num_crossings))
+        counts = np.bincount((self.num_crossings - min_num).ravel())
+        self.histogram = (np.arange(min_num, min_num + counts.size), counts)
+        print_verbose("Done creating histograms.", verbose, 2)
+        return True
+
+    def write_files(self, verbose: int):
+        print_verbose("Writing NCC parameter info...", verbose, 2)
+        fname = f"{self.outfile_prefix}ncc_parameter_info.txt"
+        with open(fname, 'w') as f:
+            f.write(f"center_y1 {self.center_y1:.9g}\n")
+            f.write(f"center_y2 {self.center_y2:.9g}\n")
+            f.write(f"half_length_y1 {self.half_length_y1:.9g}\n")
+            f.write(f"half_length_y2 {self.half_length_y2:.9g}\n")
+            f.write(f"num_pixels_y1 {self.num_pixels_y1}\n")
+            f.write(f"num_pixels_y2 {self.num_pixels_y2}\n")
+            f.write(f"over_sample {self.over_sample}\n")
+            f.write(f"t_ncc {self.t_ncc:.9g}\n")
+            f.write(f"t_reduce {self.t_reduce:.9g}\n")
+        print_verbose(f"Done writing NCC parameter info to file {fname}", verbose, 1)
+
+        if self.write_histograms:
+            print_verbose("Writing number of caustic crossings histogram...", verbose, 2)
+            fname = f"{self.outfile_prefix}ncc_ncc_numpixels.txt"
+            write_hist(fname, *self.histogram)
+            print_verbose(f"Done writing number of caustic crossings histogram to file {fname}", verbose, 1)
+
+        if self.write_maps:
+            print_verbose("Writing number of caustic crossings...", verbose, 2)
+            fname = f"{self.outfile_prefix}ncc_ncc.bin"
+            write_array(fname, self.num_crossings, np.int32)
+            print_verbose(f"Done writing number of caustic crossings to file {fname}", verbose, 1)
+
+        return True
+
+    def run(self, verbose: int):
+        self.timings = {}
+        if not self.check_input_params(verbose):
+            return False
+        with stage(self.timings, 'read_caustics'):
+            if not self.read_caustics(verbose):
+                return False
+        with stage(self.timings, 'find_num_caustic_crossings'):
+            if not self.calculate_num_caustic_crossings(verbose):
+                return False
+        with stage(self.timings, 'create_histograms'):
+            if not self.create_histograms(verbose):
+                return False
+        return True
+
+    def save(self, verbose: int):
+        with stage(self.timings, 'write_files'):
+            return self.write_files(verbose)
+
+
+lib = Library(NCC, np.float64)
@@ -1,8 +1,12 @@
-from . import lib_ncc
+from microlensing.Util.library_object import LibraryObject, library_state, restore_library_state
+from microlensing.Util.timings import peak_memory, profiled, stage
 
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.axes import Axes
+from typing import TYPE_CHECKING
+
+# matplotlib is only imported once something is plotted
+if TYPE_CHECKING:
+    from matplotlib.axes import Axes
 
 
 class NCC(object):
@@ -10,7 +14,8 @@ class NCC(object):
                  center_y1: float = None, center_y2: float = None, half_length_y1: float = None, half_length_y2: float = None,
                  num_pixels_y1: int = None, num_pixels_y2: int = None, over_sample: int = None,
                  write_maps: bool = False, write_histograms: bool = False,
-                 outfile_prefix: str = None, verbose: int = 0):
+                 outfile_prefix: str = None, verbose: int = 0, backend: str = 'gpu',
+                 zero_copy: bool = False):
         '''
         :param infile_prefix: prefix to be used when reading in files
         :param center_y1: y1 coordinate of the center of the number of caustic crossings map
@@ -26,11 +31,21 @@ class NCC(object):
         :param write_histograms: whether to write histograms or not
         :param outfile_prefix: prefix to be used in output file names
         :param verbose: verbosity level of messages. must be 0, 1, 2, or 3
+        :param backend: library to run on. Options are: gpu (the CUDA library) and cpu (a NumPy implementation
+                        that needs no GPU, and only holds one tile of the oversampled map in memory at a time)
+        :param zero_copy: whether results should be read-only views of the library's memory instead of copies of it
         '''
-        self.lib = lib_ncc.lib
+        self.lib = self._library(backend)
+        self.backend = backend
 
-        self.obj = self.lib.NCC_init()
+        # the library object is kept alive by any views of its memory
+        self._handle = LibraryObject(self.lib, 'NCC')
+        self.obj = self._handle.obj
         self.verbose = verbose
+        self.zero_copy = zero_copy
+
+        # time in seconds of each stage of the last run and save
+        self._timings = {}
 
         self.infile_prefix = infile_prefix
         
@@ -48,8 +63,24 @@ class NCC(object):
         
         self.outfile_prefix = outfile_prefix
 
-    def __del__(self):
-        self.lib.NCC_delete(self.obj)
+    @staticmethod
+    def _library(backend: str):
+        '''
+        load the library of a backend on first use
+        '''
+        if backend == 'gpu':
+            from . import lib_ncc
+            return lib_ncc.lib
+        elif backend == 'cpu':
+            from . import lib_ncc_cpu
+            return lib_ncc_cpu.lib
+        raise ValueError("backend must be gpu or cpu")
+
+    def __getstate__(self):
+        return library_state(self)
+
+    def __setstate__(self, state):
+        restore_library_state(self, state, self._library(state['backend']), 'NCC')
 
     @property
     def infile_prefix(self):
@@ -177,13 +208,35 @@ class NCC(object):
         if value is not None:
             self.lib.set_outfile_prefix(self.obj, value.encode('utf-8'))
 
+    @profiled
     def run(self):
-        if not self.lib.run(self.obj, self.verbose):
-            raise Exception("Error running NCC")
-        
-        self.num_caustic_crossings = np.ctypeslib.as_array(self.lib.get_num_crossings(self.obj), 
-                                                           shape=(self.num_pixels_y2,
-                                                                  self.num_pixels_y1)).copy()
+        if self.zero_copy:
+            # results of a previous run are views of memory the library is
+            # about to overwrite
+            self.num_caustic_crossings = None
+            if self._handle.in_use():
+                raise Exception("Results of a previous NCC run are still referenced. "
+                                "Copy or delete them before running again")
+
+        self._timings = {}
+        with stage(self._timings, 'run'):
+            if not self.lib.run(self.obj, self.verbose):
+                raise Exception("Error running NCC")
+
+        with stage(self._timings, 'copy_out'):
+            self.num_caustic_crossings = self._handle.array(self.lib.get_num_crossings(self.obj),
+                                                            shape=(self.num_pixels_y2,
+                                                                   self.num_pixels_y1), zero_copy=self.zero_copy)
+
+    @property
+    def timings(self):
+        '''
+        time in seconds of each stage of the last run and save, and the peak
+        memory of the process in bytes. the cpu backend also reports the
+        stages of the library (read_caustics, find_num_caustic_crossings, etc.)
+        '''
+        timings = dict(self.lib.get_timings(self.obj)) if self.backend == 'cpu' else {}
+        return {**timings, **self._timings, 'peak_memory': peak_memory()}
     
     @property
     def extent(self):
@@ -192,11 +245,15 @@ class NCC(object):
                          [(self.center[1] - self.half_length[1]),
                           (self.center[1] + self.half_length[1])]])
 
+    @profiled
     def save(self):
-        if not self.lib.save(self.obj, self.verbose):
-            raise Exception("Error saving NCC")
+        with stage(self._timings, 'save'):
+            if not self.lib.save(self.obj, self.verbose):
+                raise Exception("Error saving NCC")
+
+    def plot(self, ax: 'Axes', cmap='viridis', **kwargs):
+        import matplotlib.pyplot as plt
 
-    def plot(self, ax: Axes, cmap='viridis', **kwargs):
         if 'vmin' not in kwargs.keys():
             kwargs['vmin'] = np.min(self.num_caustic_crossings) - 0.5
         if 'vmax' not in kwargs.keys():
@@ -214,7 +271,7 @@ class NCC(object):
         ax.set_xlabel('$y_1$')
         ax.set_ylabel('$y_2$')
 
-    def plot_hist(self, ax: Axes, bins=None, **kwargs):
+    def plot_hist(self, ax: 'Axes', bins=None, **kwargs):
         if bins is None:
             vmin, vmax = (np.min(self.num_caustic_crossings) - 0.5, 
                           np.max(self.num_caustic_crossings) + 0.5)
@@ -0,0 +1,239 @@
+import numpy as np
+
+
+def power_integral(x1, x2, a, b=1):
+    '''
+    calculate the integral of b * x^a from x1 to x2, assuming 0 < x1 <= x2
+
+    :param x1: lower limit
+    :param x2: upper limit
+    :param a: slope of the power law
+    :param b: normalization of the power law
+    :return result: b * (x2^(a + 1) - x1^(a + 1)) / (a + 1), or
+                    b * (log(x2) - log(x1)) if a == -1
+    '''
+    if a != -1:
+        return b * (x2**(a + 1) - x1**(a + 1)) / (a + 1)
+    return b * (np.log(x2) - np.log(x1))
+
+def power_log_integral(x1, x2, a, b=1):
+    '''
+    calculate the integral of b * x^a * ln(x) from x1 to x2, assuming 0 < x1 <= x2
+
+    :param x1: lower limit
+    :param x2: upper limit
+    :param a: slope of the power law
+    :param b: normalization of the power law
+    :return result: value of the integral
+    '''
+    if a != -1:
+        return b * (x2**(a + 1) * ((a + 1) * np.log(x2) - 1)
+                    - x1**(a + 1) * ((a + 1) * np.log(x1) - 1)) / (a + 1)**2
+    return b * (np.log(x2)**2 - np.log(x1)**2) / 2
+
+def invert_power_integral(p, x1, a, b):
+    '''
+    calculate the value of x such that the integral of b * x^a from x1 to x
+    equals p, assuming 0 < x1
+
+    :param p: value of the integral
+    :param x1: lower limit
+    :param a: slope of the power law
+    :param b: normalization of the power law
+    :return x: upper limit of the integral
+    '''
+    if a != -1:
+        return (p * (a + 1) / b + x1**(a + 1))**(1 / (a + 1))
+    return x1 * np.exp(p / b)
+
+
+class MassFunction():
+    '''
+    base class for mass functions. masses, mass limits, and the solar mass are
+    all in the same arbitrary units, mirroring the massfunctions namespace of
+    the CUDA library
+    '''
+
+    def mass(self, p, m_lower: float, m_upper: float, m_solar: float):
+        '''
+        :param p: number(s) drawn uniformly in [0, 1]
+        :param m_lower: lower mass cutoff for the distribution
+        :param m_upper: upper mass cutoff for the distribution
+        :param m_solar: solar mass
+        :return m: mass(es) corresponding to the given probabilities
+        '''
+        raise NotImplementedError
+
+    def mean_mass(self, m_lower: float, m_upper: float, m_solar: float):
+        raise NotImplementedError
+
+    def mean_mass2(self, m_lower: float, m_upper: float, m_solar: float):
+        raise NotImplementedError
+
+    def mean_mass2_ln_mass(self, m_lower: float, m_upper: float, m_solar: float):
+        raise NotImplementedError
+
+
+class Equal(MassFunction):
+    '''
+    equal mass point lenses. mass can be arbitrarily scaled, so all masses are 1
+    '''
+
+    def mass(self, p, m_lower, m_upper, m_solar):
+        return np.ones_like(p, dtype=np.float64)
+
+    def mean_mass(self, m_lower, m_upper, m_solar):
+        return 1
+
+    def mean_mass2(self, m_lower, m_upper, m_solar):
+        return 1
+
+    def mean_mass2_ln_mass(self, m_lower, m_upper, m_solar):
+        return 0
+
+
+class BrokenPowerLaw(MassFunction):
+    '''
+    continuous broken power law p(m) ~ m^slopes[i] between breaks[i - 1] and
+    breaks[i]. breaks are in units of solar mass
+    '''
+
+    def __init__(self, slopes, breaks=()):
+        if len(slopes) != len(breaks) + 1:
+            raise ValueError("there must be one more slope than breaks")
+        self.slopes = tuple(slopes)
+        self.breaks = tuple(breaks)
+
+    def _segments(self, m_lower, m_upper, m_solar):
+        '''
+        split [m_lower, m_upper] into the power law segments it overlaps
+
+        :return segments: list of (x1, x2, slope, b, prob) where b is the
+                          normalization of the segment and prob the
+                          probability of drawing a mass within it
+        '''
+        breaks = [m * m_solar for m in self.breaks]
+
+        segments = []
+        b = 1
+        x1 = m_lower
+        for i, slope in enumerate(self.slopes):
+            upper = breaks[i] if i < len(breaks) else np.inf
+            if i > 0:
+                # continuity of the density at the previous break
+                b *= breaks[i - 1]**(self.slopes[i - 1] - slope)
+            if x1 >= upper:
+                continue
+            x2 = min(m_upper, upper)
+            segments.append([x1, x2, slope, b, power_integral(x1, x2, slope, b)])
+            x1 = x2
+            if x1 >= m_upper:
+                break
+
+        norm = sum(segment[4] for segment in segments)
+        for segment in segments:
+            segment[3] /= norm
+            segment[4] /= norm
+
+        return segments
+
+    def mass(self, p, m_lower, m_upper, m_solar):
+        p = np.asarray(p, dtype=np.float64)
+        if m_lower == m_upper:
+            return np.full(p.shape, m_lower, dtype=np.float64)
+
+        segments = self._segments(m_lower, m_upper, m_solar)
+        cumulative = np.cumsum([0] + [segment[4] for segment in segments])
+
+        idx = np.clip(np.searchsorted(cumulative, p, side='right') - 1, 0, len(segments) - 1)
+
+        m = np.empty(p.shape, dtype=np.float64)
+        for i, (x1, x2, slope, b, prob) in enumerate(segments):
+            where = idx == i
+            m[where] = invert_power_integral(p[where] - cumulative[i], x1, slope, b)
+        return m
+
+    def mean_mass(self, m_lower, m_upper, m_solar):
+        if m_lower == m_upper:
+            return m_lower
+        return sum(power_integral(x1, x2, slope + 1, b)
+                   for (x1, x2, slope, b, prob) in self._segments(m_lower, m_upper, m_solar))
+
+    def mean_mass2(self, m_lower, m_upper, m_solar):
+        if m_lower == m_upper:
+            return m_lower**2
+        return sum(power_integral(x1, x2, slope + 2, b)
+                   for (x1, x2, slope, b, prob) in self._segments(m_lower, m_upper, m_solar))
+
+    def mean_mass2_ln_mass(self, m_lower, m_upper, m_solar):
+        if m_lower == m_upper:
+            return m_lower**2 * np.log(m_lower)
+        return sum(power_log_integral(x1, x2, slope + 2, b)
+                   for (x1, x2, slope, b, prob) in self._segments(m_lower, m_upper, m_solar))
+
+
+class PowerLaw(BrokenPowerLaw):
+    '''
+    power law p(m) ~ m^slope
+    '''
+
+    def __init__(self, slope: float = 0):
+        super().__init__((slope,))
+        self.slope = slope
+
+
+class Uniform(PowerLaw):
+
+    def __init__(self):
+        super().__init__(0)
+
+
+class Salpeter(PowerLaw):
+
+    def __init__(self):
+        super().__init__(-2.35)
+
+
+class Kroupa(BrokenPowerLaw):
+
+    def __init__(self):
+        super().__init__((-0.3, -1.3, -2.3), (0.08, 0.5))
+
+
+class OpticalDepth(MassFunction):
+    '''
+    mass function for which the optical depth of stars of mass m_lower and
+    of stars of mass m_upper are equal
+    '''
+
+    def mass(self, p, m_lower, m_upper, m_solar):
+        p = np.asarray(p, dtype=np.float64)
+        return np.where(p <= m_upper / (m_lower + m_upper), m_lower, m_upper).astype(np.float64)
+
+    def mean_mass(self, m_lower, m_upper, m_solar):
+        return 2 * m_lower * m_upper / (m_lower + m_upper)
+
+    def mean_mass2(self, m_lower, m_upper, m_solar):
+        return m_lower * m_upper
+
+    def mean_mass2_ln_mass(self, m_lower, m_upper, m_solar):
+        return m_lower * m_upper * (m_lower * np.log(m_lower) + m_upper * np.log(m_upper)) / (m_lower + m_upper)
+
+
+MASS_FUNCTIONS = {
+    'equal': Equal,
+    'uniform': Uniform,
+    'salpeter': Salpeter,
+    'kroupa': Kroupa,
+    'optical_depth': OpticalDepth,
+}
+
+def get_mass_function(name: str):
+    '''
+    :param name: name of the mass function. Options are: equal, uniform,
+                 Salpeter, Kroupa, and optical_depth
+    :return mass_function: instance of the corresponding MassFunction
+    '''
+    if name.lower() not in MASS_FUNCTIONS.keys():
+        raise ValueError("mass_function must be equal, uniform, Salpeter, Kroupa, or optical_depth")
+    return MASS_FUNCTIONS[name.lower()]()
@@ -0,0 +1,276 @@
+from .mass_functions import get_mass_function
+from microlensing.Util import star_file
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+'''
+star fields are generated in chunks of CHUNK_SIZE stars. every chunk has its
+own counter-based random number generator (Philox) keyed by the random seed
+and the index of the chunk, so any chunk can be generated on its own. a star
+field is therefore the same whether it is generated at once, streamed to a
+file, or split across processes
+'''
+
+CHUNK_SIZE = 2**20
+
+
+def _chunk_rng(random_seed: int, chunk: int):
+    return np.random.Generator(np.random.Philox(key=[random_seed, chunk]))
+
+def num_chunks(num_stars: int):
+    '''
+    :param num_stars: number of stars
+    :return num_chunks: number of chunks of a star field
+    '''
+    return -(-num_stars // CHUNK_SIZE)
+
+def generate_star_chunk(chunk: int, num_stars: int, rectangular: bool, corner, mass_function: str,
+                        m_lower: float, m_upper: float, m_solar: float, random_seed: int):
+    '''
+    Generate one chunk of a random field of point mass lenses
+
+    :param chunk: index of the chunk. the chunk contains stars
+                  chunk * CHUNK_SIZE to (chunk + 1) * CHUNK_SIZE
+    :param num_stars: number of stars of the whole star field
+    :param rectangular: whether the star field is rectangular or circular
+    :param corner: (x1, x2) corner of the star field. for circular star fields,
+                   only the magnitude of the corner is used
+    :param mass_function: mass function to draw masses from. Options are: equal,
+                          uniform, Salpeter, Kroupa, and optical_depth
+    :param m_lower: lower mass cutoff in arbitrary units
+    :param m_upper: upper mass cutoff in arbitrary units
+    :param m_solar: solar mass in arbitrary units
+    :param random_seed: seed for the random number generator
+
+    :return stars: array of stars (x1, x2, mass) of the chunk
+    '''
+    if random_seed < 0:
+        raise ValueError("random_seed must be >= 0")
+    n = min(CHUNK_SIZE, num_stars - chunk * CHUNK_SIZE)
+    if chunk < 0 or n < 1:
+        raise ValueError(f"chunk must be in the range [0, {num_chunks(num_stars)})")
+
+    rng = _chunk_rng(random_seed, chunk)
+
+    stars = np.empty((n, 3), dtype=np.float64)
+
+    if rectangular:
+        # random positions in the range [-corner, corner]
+        stars[:, 0] = rng.uniform(-corner[0], corner[0], n)
+        stars[:, 1] = rng.uniform(-corner[1], corner[1], n)
+    else:
+        # square root of the random radius so stars are evenly dispersed in 2D
+        a = rng.uniform(0, 2 * np.pi, n)
+        r = np.sqrt(rng.uniform(0, 1, n)) * np.hypot(*corner)
+        stars[:, 0] = r * np.cos(a)
+        stars[:, 1] = r * np.sin(a)
+
+    stars[:, 2] = get_mass_function(mass_function).mass(rng.uniform(0, 1, n),
+                                                        m_lower, m_upper, m_solar)
+
+    return stars
+
+def generate_star_field(num_stars: int, rectangular: bool, corner, mass_function: str,
+                        m_lower: float, m_upper: float, m_solar: float, random_seed: int):
+    '''
+    Generate a random field of point mass lenses centered on the origin
+
+    :param num_stars: number of stars to generate
+    :param rectangular: whether the star field is rectangular or circular
+    :param corner: (x1, x2) corner of the star field. for circular star fields,
+                   only the magnitude of the corner is used
+    :param mass_function: mass function to draw masses from. Options are: equal,
+                          uniform, Salpeter, Kroupa, and optical_depth
+    :param m_lower: lower mass cutoff in arbitrary units
+    :param m_upper: upper mass cutoff in arbitrary units
+    :param m_solar: solar mass in arbitrary units
+    :param random_seed: seed for the random number generator
+
+    :return stars: array of stars (x1, x2, mass) of shape (num_stars, 3)
+    '''
+    stars = np.empty((num_stars, 3), dtype=np.float64)
+    for chunk in range(num_chunks(num_stars)):
+        stars[chunk * CHUNK_SIZE: (chunk + 1) * CHUNK_SIZE] = generate_star_chunk(
+            chunk, num_stars, rectangular, corner, mass_function, m_lower, m_upper, m_solar, random_seed)
+    return stars
+
+
+def mass_limits(mass_function: str, m_lower: float, m_upper: float, m_solar: float):
+    '''
+    mass limits in the arbitrary units the masses are generated in, as the
+    library uses them
+
+    :param mass_function: name of the mass function
+    :param m_lower: lower mass cutoff in solar mass units
+    :param m_upper: upper mass cutoff in solar mass units
+    :param m_solar: solar mass in arbitrary units
+    :return m_lower: lower mass cutoff in arbitrary units
+    :return m_upper: upper mass cutoff in arbitrary units
+    '''
+    if mass_function.lower() == 'equal':
+        return 1, 1
+    return m_lower * m_solar, m_upper * m_solar
+
+def star_field_corner(shape, num_stars: int, mean_mass: float, kappa_star: float, theta_star: float,
+                      rectangular: bool):
+    '''
+    corner of a star field of a given number of stars and convergence
+
+    :param shape: complex number whose direction gives the shape of the star
+                  field, e.g. the corner of the region it must cover
+    :param num_stars: number of stars
+    :param mean_mass: mean mass of the stars
+    :param kappa_star: convergence in point mass lenses
+    :param theta_star: Einstein radius of a unit mass point lens
+    :param rectangular: whether the star field is rectangular or circular
+    :return corner: complex corner of the star field. if circular, the
+                    magnitude is the radius
+    '''
+    if rectangular:
+        corner = complex(np.sqrt(shape.real / shape.imag), np.sqrt(shape.imag / shape.real))
+        return corner * np.sqrt(np.pi * theta_star**2 * num_stars * mean_mass / (4 * kappa_star))
+    corner = shape / abs(shape)
+    return corner * np.sqrt(theta_star**2 * num_stars * mean_mass / kappa_star)
+
+def star_field_size(region_corner, kappa_star: float, theta_star: float, mean_mass: float,
+                    rectangular: bool, safety_scale: float):
+    '''
+    number of stars and corner of a star field which covers a region of the
+    lens plane, as calculated by the IPM and MIF classes
+
+    :param region_corner: complex corner of the region of the lens plane to
+                          cover, e.g. the corner of the shooting region
+    :param kappa_star: convergence in point mass lenses
+    :param theta_star: Einstein radius of a unit mass point lens
+    :param mean_mass: expected mean mass of the stars
+    :param rectangular: whether the star field is rectangular or circular
+    :param safety_scale: ratio of the size of the star field to the size of
+                         the region
+    :return num_stars: number of stars
+    :return corner: complex corner of the star field
+    '''
+    region_corner = complex(region_corner)
+    if rectangular:
+        num_stars = int(np.ceil(safety_scale * 2 * region_corner.real
+                                * safety_scale * 2 * region_corner.imag
+                                * kappa_star / (np.pi * theta_star**2 * mean_mass)))
+    else:
+        num_stars = int(np.ceil(safety_scale * abs(region_corner)
+                                * safety_scale * abs(region_corner)
+                                * kappa_star / (theta_star**2 * mean_mass)))
+    return num_stars, star_field_corner(region_corner, num_stars, mean_mass, kappa_star, theta_star, rectangular)
+
+
+def _write_chunks(fname: str, chunks, num_stars: int, rectangular: bool, corner, mass_function: str,
+                  m_lower: float, m_upper: float, m_solar: float, random_seed: int):
+    '''
+    generate chunks of a star field into an existing star file
+
+    :return total_mass: total mass of the stars of the chunks, as written
+    '''
+    stars = star_file.open_stars(fname, 'r+')[0]
+    total_mass = 0
+    for chunk in chunks:
+        lo = chunk * CHUNK_SIZE
+        hi = min(lo + CHUNK_SIZE, num_stars)
+        stars[lo: hi] = generate_star_chunk(chunk, num_stars, rectangular, corner, mass_function,
+                                            m_lower, m_upper, m_solar, random_seed)
+        total_mass += np.sum(stars[lo: hi, 2], dtype=np.float64)
+    stars.flush()
+    return total_mass
+
+def write_star_field(fname: str, region_corner, kappa_star: float, random_seed: int,
+                     theta_star: float = 1, mass_function: str = 'equal', m_solar: float = 1,
+                     m_lower: float = 0.01, m_upper: float = 50, rectangular: bool = False,
+                     safety_scale: float = 1.37, num_stars: int = None, dtype=np.float32,
+                     num_processes: int = 1, checksum: bool = False):
+    '''
+    Generate a random field of point mass lenses and write it to a binary star
+    file, which can be given as the starfile of IPM, CCF, or MIF. the field is
+    written in chunks, so it need not fit in memory. as in the library, the
+    stars are drawn within the corner expected from the mass function, and the
+    corner written to the file is then set from the actual masses so that the
+    convergence in stars is exactly kappa_star
+
+    :param fname: name of the .bin file to write
+    :param region_corner: complex corner of the region of the lens plane the
+                          star field must cover, e.g. the corner of the IPM
+                          shooting region. if num_stars is provided, only
+                          its direction is used
+    :param kappa_star: convergence in point mass lenses
+    :param random_seed: seed for the random number generator. must be > 0, as
+                        0 is reserved for star input files
+    :param theta_star: Einstein radius of a unit mass point lens in arbitrary units
+    :param mass_function: mass function to use for the point mass lenses.
+                          Options are: equal, uniform, Salpeter, Kroupa, and
+                          optical_depth
+    :param m_solar: solar mass in arbitrary units
+    :param m_lower: lower mass cutoff in solar mass units
+    :param m_upper: upper mass cutoff in solar mass units
+    :param rectangular: whether the star field is rectangular or circular
+    :param safety_scale: ratio of the size of the star field to the size of
+                         the region
+    :param num_stars: number of stars. default is the number needed to cover
+                      the region, as calculated by star_field_size
+    :param dtype: data type for the file. default is np.float32
+    :param num_processes: number of processes to generate chunks with
+    :param checksum: whether to also write a checksum file, fname + '.blake2b'
+
+    :return num_stars: number of stars written
+    :return corner: complex corner of the star field
+    '''
+    if random_seed < 1:
+        raise ValueError("random_seed must be >= 1")
+    if kappa_star <= 0:
+        raise ValueError("kappa_star must be > 0")
+    if m_lower > m_upper:
+        raise ValueError("m_lower must be <= m_upper")
+    if num_processes < 1:
+        raise ValueError("num_processes must be >= 1")
+
+    _m_lower, _m_upper = mass_limits(mass_function, m_lower, m_upper, m_solar)
+    mean_mass = get_mass_function(mass_function).mean_mass(_m_lower, _m_upper, m_solar)
+
+    region_corner = complex(region_corner)
+    if num_stars is None:
+        num_stars, corner = star_field_size(region_corner, kappa_star, theta_star, mean_mass,
+                                            rectangular, safety_scale)
+    else:
+        corner = star_field_corner(region_corner, num_stars, mean_mass, kappa_star, theta_star, rectangular)
+    if num_stars < 1:
+        raise ValueError("num_stars must be >= 1")
+    corner = (corner.real, corner.imag)
+
+    if not fname.endswith('.bin'):
+        raise ValueError('fname must be a .bin file')
+
+    # write the header and size the file, then fill in the stars
+    with open(fname, 'wb') as f:
+        np.array([num_stars, 1 if rectangular else 0], dtype=np.int32).tofile(f)
+        np.array([*corner, theta_star], dtype=dtype).tofile(f)
+        f.truncate(star_file.file_size(num_stars, dtype))
+
+    args = (num_stars, rectangular, corner, mass_function, _m_lower, _m_upper, m_solar, random_seed)
+    chunks = range(num_chunks(num_stars))
+    if num_processes == 1:
+        total_mass = _write_chunks(fname, chunks, *args)
+    else:
+        with ProcessPoolExecutor(max_workers=num_processes) as pool:
+            futures = [pool.submit(_write_chunks, fname, chunks[i::num_processes], *args)
+                       for i in range(num_processes)]
+            total_mass = sum(future.result() for future in futures)
+
+    # corner from the actual masses
+    corner = star_field_corner(complex(*corner), num_stars, total_mass / num_stars, kappa_star, theta_star, rectangular)
+    if not rectangular:
+        corner = complex(abs(corner), 0)
+    with open(fname, 'r+b') as f:
+        f.seek(star_file.INT_HEADER_SIZE)
+        np.array([corner.real, corner.imag], dtype=dtype).tofile(f)
+
+    if checksum:
+        star_file.write_checksum(fname)
+
+    return num_stars, corner
@@ -1,5 +1,3 @@
-from . import plotting
-
 import numpy as np
 
 
@@ -73,6 +71,7 @@ class Stars():
         return self.theta_star * np.sqrt(1000 * self.kappa_star * self.mean_mass2_actual / self.mean_mass_actual)
 
     def plot(self, ax, color='black', s=1, **kwargs):
+        from . import plotting
 
         stars = plotting.Stars(self.positions, self.masses, s=s, color=color, **kwargs)
         
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator
 from sncosmo import PropagationEffect
 
 
@@ -50,6 +49,7 @@ class ChromaticMicrolensing(PropagationEffect):
                 or mu.shape[1] != wavelengths.shape[0]):
             raise ValueError("Dimensions of mu do not match provided phases and wavelengths")
 
+        from scipy.interpolate import RegularGridInterpolator
         self.mu = RegularGridInterpolator((phases, wavelengths), mu)
 
     def propagate(self, wave, flux, phase):
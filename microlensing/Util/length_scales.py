@@ -1,11 +1,14 @@
 import numpy as np
-from astropy.cosmology import Planck18
-from astropy import units as u
-from astropy import constants
+
+
+'''
+astropy is only imported once a length scale is calculated, as importing it
+takes longer than the calculation
+'''
 
 
 def theta_star_physical(z_lens: float, z_src: float, m: float = 1,
-                        cosmo=Planck18):
+                        cosmo=None):
     '''
     Calculate the size of the Einstein radius of a point mass lens in the
     lens and source planes, in meters
@@ -18,6 +21,13 @@ def theta_star_physical(z_lens: float, z_src: float, m: float = 1,
     :return theta_star_lens: theta_star in the lens plane in meters
     :return theta_star_src: theta_star in the source plane in meters
     '''
+    from astropy import units as u
+    from astropy import constants
+
+    if cosmo is None:
+        from astropy.cosmology import Planck18
+        cosmo = Planck18
+
     microlens_mass = m * u.M_sun
 
     D_d = cosmo.angular_diameter_distance(z_lens)
@@ -31,7 +41,7 @@ def theta_star_physical(z_lens: float, z_src: float, m: float = 1,
     return theta_star_lens.to(u.m), theta_star_src.to(u.m)
 
 def sn_expansion_rate(z_lens: float, z_src: float, m: float = 1,
-                      cosmo=Planck18, v: float = 10**4):
+                      cosmo=None, v: float = 10**4):
     '''
     Calculate the expansion rate of a supernova in the source plane
     in units of the microlens Einstein radius / day
@@ -45,5 +55,7 @@ def sn_expansion_rate(z_lens: float, z_src: float, m: float = 1,
     :return v / theta_star_src: supernova expansion velocity in units
                                 of the microlens Einstein radius / day
     '''
+    from astropy import units as u
+
     v = v * u.km / u.s
     return (v * u.day / theta_star_physical(z_lens, z_src, m, cosmo)[1]).to(u.dimensionless_unscaled)
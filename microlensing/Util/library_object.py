@@ -0,0 +1,109 @@
+import numpy as np
+import weakref
+
+
+class _Buffer():
+    '''
+    array interface to a library buffer which keeps the object owning the
+    buffer alive
+    '''
+
+    def __init__(self, arr: np.ndarray, owner):
+        self.__array_interface__ = arr.__array_interface__
+        self.arr = arr
+        self.owner = owner
+
+
+class LibraryObject():
+    '''
+    owner of an object created by one of the ctypes libraries. the object is
+    deleted only once neither the Python wrapper nor any read-only view of its
+    buffers references this, so the library cannot free memory that is still
+    in use
+    '''
+
+    def __init__(self, lib, name: str):
+        '''
+        :param lib: ctypes library providing name_init and name_delete
+        :param name: name of the class in the library, e.g. IPM
+        '''
+        self.lib = lib
+        self.name = name
+        self.obj = getattr(lib, f"{name}_init")()
+        self._views = []
+
+    def __del__(self):
+        getattr(self.lib, f"{self.name}_delete")(self.obj)
+
+    def array(self, ptr, shape, zero_copy: bool = False):
+        '''
+        :param ptr: pointer to a buffer of the library object
+        :param shape: shape of the buffer
+        :param zero_copy: whether to return a read-only view of the buffer, or
+                          a copy of it
+        :return arr: array of the buffer contents
+        '''
+        arr = np.ctypeslib.as_array(ptr, shape=shape)
+        if not zero_copy:
+            return arr.copy()
+
+        # views of the returned array reference the buffer rather than the
+        # array itself, so the buffer is what is tracked
+        buffer = _Buffer(arr, self)
+        self._views.append(weakref.ref(buffer))
+        view = np.asarray(buffer)
+        view.flags.writeable = False
+        return view
+
+    def in_use(self):
+        '''
+        whether any view of the buffers is still referenced. running the
+        library again would overwrite or free the memory of such views
+        '''
+        self._views = [view for view in self._views if view() is not None]
+        return len(self._views) > 0
+
+
+def library_state(wrapper):
+    '''
+    state of a wrapper to pickle it with. the parameters of the library object
+    are read through the library, so that the object can be created again when
+    unpickled. to_shared from microlensing.Util.shared_array sends the
+    results through shared memory instead of the pickle payload
+
+    :param wrapper: IPM, CCF, NCC, or MIF instance
+    :return state: dictionary of the attributes of the wrapper other than the
+                   library and its object, and of the library parameters
+    '''
+    parameters = {}
+    for name, attr in vars(type(wrapper)).items():
+        if not isinstance(attr, property) or attr.fset is None:
+            continue
+        try:
+            parameters[name] = getattr(wrapper.lib, f"get_{name}")(wrapper.obj)
+        except AttributeError:
+            # parameters of another backend, or kept by the wrapper itself
+            continue
+
+    state = {key: value for key, value in wrapper.__dict__.items() if key not in ['lib', '_handle', 'obj']}
+    state['_parameters'] = parameters
+    return state
+
+def restore_library_state(wrapper, state: dict, lib, name: str):
+    '''
+    create the library object of an unpickled wrapper again
+
+    :param wrapper: IPM, CCF, NCC, or MIF instance
+    :param state: state from library_state
+    :param lib: library of the wrapper's backend
+    :param name: name of the class in the library, e.g. IPM
+    '''
+    state = dict(state)
+    parameters = state.pop('_parameters')
+    wrapper.__dict__.update(state)
+
+    wrapper.lib = lib
+    wrapper._handle = LibraryObject(lib, name)
+    wrapper.obj = wrapper._handle.obj
+    for key, value in parameters.items():
+        getattr(lib, f"set_{key}")(wrapper.obj, value)
@@ -0,0 +1,418 @@
+from microlensing.Deflection import fmm
+from microlensing.Deflection.deflector import Deflector
+from microlensing.Deflection.tree import QuadTree
+from microlensing.Stars.mass_functions import get_mass_function
+from microlensing.Stars.star_field import generate_star_field, mass_limits, star_field_corner
+from microlensing.Util.star_file import open_stars
+from microlensing.Util.timings import stage
+from microlensing.Util.util import write_stars
+
+import numpy as np
+import os
+import sys
+import time
+
+
+def print_verbose(message: str, verbose: int, level: int):
+    '''
+    print a message if the verbosity is at least the given level
+    '''
+    if verbose >= level:
+        print(message, flush=True)
+
+def print_error(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+def available_cpus():
+    '''
+    number of CPUs this process may run on
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def read_star_file(fname: str):
+    '''
+    Read in a .bin or .txt star file. binary files are read with
+    star_file.open_stars, which determines their precision. text files are assumed to be in units where
+    theta_star = 1, and whether the field is rectangular or circular is
+    determined from the moment of inertia of the stars
+
+    :param fname: name of the file to read
+    :return stars: array of stars (x1, x2, mass)
+    :return rectangular: whether the star field is rectangular or circular
+    :return corner: complex corner of the star field. if circular, (rad, 0)
+    :return theta_star: Einstein radius of a unit mass point lens
+    '''
+    if fname.endswith('.bin'):
+        stars, rectangular, corner, theta_star = open_stars(fname)
+        return (np.array(stars, dtype=np.float64), rectangular,
+                complex(float(corner[0]), float(corner[1])), float(theta_star))
+
+    elif fname.endswith('.txt'):
+        stars = np.loadtxt(fname, dtype=np.float64, ndmin=2)[:, :3]
+        if stars.shape[0] < 1:
+            raise ValueError(f"too few stars in file {fname}")
+
+        total_mass = np.sum(stars[:, 2])
+        I_stars = np.sum(stars[:, 2] * (stars[:, 0]**2 + stars[:, 1]**2))
+        max_x1 = np.max(np.abs(stars[:, 0]))
+        max_x2 = np.max(np.abs(stars[:, 1]))
+        max_rad = np.max(np.hypot(stars[:, 0], stars[:, 1]))
+
+        # moments of inertia of a disk of radius max_rad and of a rectangle
+        # with corner (max_x1, max_x2)
+        I_circ = total_mass * max_rad**2 / 2
+        I_rect = total_mass * (max_x1**2 + max_x2**2) / 3
+        if I_stars / I_circ > I_stars / I_rect:
+            return stars, False, complex(max_rad, 0), 1.
+        return stars, True, complex(max_x1, max_x2), 1.
+
+    raise ValueError(f"star file {fname} is not a .bin or .txt file")
+
+
+class Microlensing():
+    '''
+    CPU implementation of the parameters and star field handling shared by
+    the microlensing classes of the CUDA library. defaults match the C++ class
+    '''
+
+    MAX_TAYLOR_SMOOTH = 101
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+
+        self.kappa_tot = 0.3
+        self.shear = 0.3
+        self.kappa_star = 0.27
+        self.theta_star = 1
+        self.mass_function = 'equal'
+        self.m_solar = 1
+        self.m_lower = 0.01
+        self.m_upper = 50
+        self.rectangular = 0
+        self.approx = 1
+        self.safety_scale = 1.37
+        self.starfile = ''
+        self.random_seed = 0
+        self.write_stars = 1
+        self.outfile_prefix = './'
+
+        self.num_stars = 0
+        self.corner = 0j
+        self.stars = np.zeros((0, 3), dtype=dtype)
+        self.taylor_smooth = 1
+        self.alpha_error = 0
+        self.expansion_order = 0
+        self.root_half_length = 0
+        self.tree_levels = 0
+        self.deflector = None
+
+        # time in seconds of each stage of the last run
+        self.timings = {}
+
+    def get_corner_x1(self):
+        return self.corner.real
+
+    def get_corner_x2(self):
+        return self.corner.imag
+
+    def check_input_params(self, verbose: int):
+        print_verbose("Checking Microlensing input parameters...", verbose, 3)
+
+        tiny = np.finfo(self.dtype).tiny
+
+        if self.kappa_tot < tiny:
+            print_error(f"Error. kappa_tot must be >= {tiny}")
+            return False
+
+        if self.kappa_star < tiny:
+            print_error(f"Error. kappa_star must be >= {tiny}")
+            return False
+        if self.starfile == '' and self.kappa_star > self.kappa_tot:
+            print_error("Error. kappa_star must be <= kappa_tot")
+            return False
+
+        if self.starfile == '' and self.theta_star < tiny:
+            print_error(f"Error. theta_star must be >= {tiny}")
+            return False
+
+        if self.starfile == '' and self.mass_function not in ['equal', 'uniform', 'salpeter', 'kroupa', 'optical_depth']:
+            print_error("Error. mass_function must be equal, uniform, Salpeter, Kroupa, or optical_depth.")
+            return False
+
+        if self.starfile == '' and self.m_solar < tiny:
+            print_error(f"Error. m_solar must be >= {tiny}")
+            return False
+
+        if self.starfile == '' and self.m_lower < tiny:
+            print_error(f"Error. m_lower must be >= {tiny}")
+            return False
+
+        if self.starfile == '' and self.m_upper < self.m_lower:
+            print_error("Error. m_upper must be >= m_lower.")
+            return False
+
+        if self.starfile == '' and self.rectangular not in [0, 1]:
+            print_error("Error. rectangular must be 1 (rectangular) or 0 (circular).")
+            return False
+
+        if self.approx not in [0, 1]:
+            print_error("Error. approx must be 1 (approximate) or 0 (exact).")
+            return False
+
+        if self.safety_scale < 1.1:
+            print_error("Error. safety_scale must be >= 1.1")
+            return False
+
+        if self.write_stars not in [0, 1]:
+            print_error("Error. write_stars must be 1 (true) or 0 (false).")
+            return False
+
+        print_verbose("Done checking Microlensing input parameters.", verbose, 3)
+        return True
+
+    def calculate_derived_params(self, verbose: int):
+        print_verbose("Calculating Microlensing derived parameters...", verbose, 3)
+
+        self.mu_ave = 1 / ((1 - self.kappa_tot)**2 - self.shear**2)
+
+        if self.starfile == '':
+            # masses are kept in arbitrary units for the calculation, without
+            # modifying the input mass limits
+            self._m_lower, self._m_upper = mass_limits(self.mass_function, self.m_lower, self.m_upper, self.m_solar)
+
+            mass_function = get_mass_function(self.mass_function)
+            self.mean_mass = mass_function.mean_mass(self._m_lower, self._m_upper, self.m_solar)
+            self.mean_mass2 = mass_function.mean_mass2(self._m_lower, self._m_upper, self.m_solar)
+            self.mean_mass2_ln_mass = mass_function.mean_mass2_ln_mass(self._m_lower, self._m_upper, self.m_solar)
+        else:
+            print_verbose(f"Calculating some parameter values based on star input file {self.starfile}", verbose, 3)
+
+            try:
+                with stage(self.timings, 'read_stars'):
+                    stars, rectangular, corner, theta_star = read_star_file(self.starfile)
+            except (OSError, ValueError) as e:
+                print_error(f"Error. Unable to read star field parameters from file {self.starfile}\n{e}")
+                return False
+
+            self.stars = stars
+            self.num_stars = stars.shape[0]
+            self.rectangular = int(rectangular)
+            self.corner = corner
+            self.theta_star = theta_star
+
+            self.calculate_star_params()
+            self.kappa_star = self.kappa_star_actual
+            if self.kappa_star > self.kappa_tot:
+                print_error("Warning. kappa_star > kappa_tot")
+            self._m_lower = self.m_lower_actual
+            self._m_upper = self.m_upper_actual
+            self.mean_mass = self.mean_mass_actual
+            self.mean_mass2 = self.mean_mass2_actual
+            self.mean_mass2_ln_mass = self.mean_mass2_ln_mass_actual
+
+        print_verbose("Done calculating Microlensing derived parameters.", verbose, 3)
+        return True
+
+    def calculate_taylor_smooth(self):
+        '''
+        degree of the Taylor series for alpha_smooth of a rectangular star field,
+        chosen so the error of the series is below alpha_error
+        '''
+        self.taylor_smooth = 1
+        while ((self.kappa_star / np.pi * 4 / (self.taylor_smooth + 1) * abs(self.corner)
+                * (self.safety_scale + 1) / (self.safety_scale - 1)
+                * (1 / self.safety_scale)**(self.taylor_smooth + 1) > self.alpha_error)
+               and self.taylor_smooth <= self.MAX_TAYLOR_SMOOTH):
+            self.taylor_smooth += 2
+
+        # avoid cos(phase * (taylor_smooth - 1)) = 0 within errors
+        phase = np.angle(self.corner)
+        while ((np.fmod(phase * (self.taylor_smooth - 1), np.pi) < 0.1 * np.pi
+                or np.fmod(phase * (self.taylor_smooth - 1), np.pi) > 0.9 * np.pi)
+               and self.taylor_smooth <= self.MAX_TAYLOR_SMOOTH):
+            self.taylor_smooth += 2
+
+        if self.rectangular and self.taylor_smooth > self.MAX_TAYLOR_SMOOTH:
+            print_error(f"Error. taylor_smooth must be <= {self.MAX_TAYLOR_SMOOTH}")
+            return False
+        return True
+
+    def calculate_star_params(self):
+        masses = self.stars[:, 2].astype(np.float64)
+        self.m_lower_actual = np.min(masses)
+        self.m_upper_actual = np.max(masses)
+        self.mean_mass_actual = np.mean(masses)
+        self.mean_mass2_actual = np.mean(masses**2)
+        self.mean_mass2_ln_mass_actual = np.mean(masses**2 * np.log(masses))
+        if self.rectangular:
+            self.kappa_star_actual = (np.sum(masses) * np.pi * self.theta_star**2
+                                      / (4 * self.corner.real * self.corner.imag))
+        else:
+            self.kappa_star_actual = np.sum(masses) * self.theta_star**2 / abs(self.corner)**2
+
+    def populate_star_array(self, verbose: int):
+        if self.starfile == '':
+            print_verbose("Generating star field...", verbose, 1)
+            t0 = time.perf_counter()
+
+            # if random seed was not provided, get one based on the time
+            while self.random_seed == 0:
+                self.random_seed = time.time_ns() % 2**31
+
+            self.stars = generate_star_field(self.num_stars, self.rectangular, (self.corner.real, self.corner.imag),
+                                             self.mass_function, self._m_lower, self._m_upper, self.m_solar,
+                                             self.random_seed).astype(self.dtype)
+
+            self.timings['generate_stars'] = time.perf_counter() - t0
+            print_verbose(f"Done generating star field. Elapsed time: {self.timings['generate_stars']} seconds.", verbose, 1)
+        else:
+            # random seed of 0 denotes that stars come from an external file
+            self.random_seed = 0
+            self.stars = self.stars.astype(self.dtype)
+
+        self.calculate_star_params()
+
+        if self.starfile == '':
+            self.corner = star_field_corner(self.corner, self.num_stars, self.mean_mass_actual,
+                                            self.kappa_star, self.theta_star, self.rectangular)
+
+        return True
+
+    def create_tree(self, verbose: int):
+        if self.rectangular:
+            root_half_length = max(self.corner.real, self.corner.imag)
+        else:
+            root_half_length = abs(self.corner)
+        # slight buffer for containing all the stars
+        self.root_half_length = root_half_length * 1.1
+
+        print_verbose("Creating tree and calculating multipole and local coefficients...", verbose, 1)
+        t0 = time.perf_counter()
+
+        # the expansion order depends on the depth of the tree, so the
+        # coefficients are calculated once it is known
+        with stage(self.timings, 'create_tree'):
+            tree = QuadTree(self.stars, self.root_half_length)
+        self.tree_levels = tree.levels
+        print_verbose(f"tree_levels set to {self.tree_levels}", verbose, 2)
+
+        self.expansion_order = int(np.ceil(2 * np.log2(self.theta_star)
+                                           + np.log2(self.mean_mass2) - np.log2(self.mean_mass)
+                                           + self.tree_levels
+                                           - np.log2(self.root_half_length) - np.log2(self.alpha_error)))
+        print_verbose(f"expansion_order set to {self.expansion_order}", verbose, 2)
+        if self.expansion_order < 3:
+            print_error("Error. Expansion order needs to be >= 3")
+            return False
+        elif self.expansion_order > fmm.MAX_EXPANSION_ORDER:
+            print_error(f"Error. Maximum allowed expansion order is {fmm.MAX_EXPANSION_ORDER}")
+            return False
+
+        with stage(self.timings, 'fmm_coefficients'):
+            self.deflector = Deflector(self.stars, self.theta_star, self.kappa_tot, self.shear, self.kappa_star,
+                                       self.rectangular, self.corner, self.approx, self.taylor_smooth,
+                                       self.root_half_length, self.expansion_order, tree=tree)
+
+        print_verbose(f"Done creating tree and calculating multipole and local coefficients. "
+                      f"Elapsed time: {time.perf_counter() - t0} seconds.", verbose, 1)
+        return True
+
+    def write_files(self, verbose: int, class_name: str = 'microlensing'):
+        print_verbose("Writing Microlensing parameter info...", verbose, 2)
+        fname = f"{self.outfile_prefix}{class_name}_parameter_info.txt"
+        with open(fname, 'w') as f:
+            f.write(f"kappa_tot {self.kappa_tot:.9g}\n")
+            f.write(f"shear {self.shear:.9g}\n")
+            f.write(f"mu_ave {self.mu_ave:.9g}\n")
+            f.write(f"smooth_fraction {1 - self.kappa_star / self.kappa_tot:.9g}\n")
+            f.write(f"kappa_star {self.kappa_star:.9g}\n")
+            if self.starfile == '':
+                f.write(f"kappa_star_actual {self.kappa_star_actual:.9g}\n")
+            f.write(f"theta_star {self.theta_star:.9g}\n")
+            f.write(f"random_seed {self.random_seed}\n")
+            if self.starfile == '':
+                f.write(f"mass_function {self.mass_function}\n")
+                if self.mass_function in ['salpeter', 'kroupa']:
+                    f.write(f"m_solar {self.m_solar:.9g}\n")
+                f.write(f"m_lower {self._m_lower:.9g}\n")
+                f.write(f"m_upper {self._m_upper:.9g}\n")
+                f.write(f"mean_mass {self.mean_mass:.9g}\n")
+                f.write(f"mean_mass2 {self.mean_mass2:.9g}\n")
+                f.write(f"mean_mass2_ln_mass {self.mean_mass2_ln_mass:.9g}\n")
+            f.write(f"m_lower_actual {self.m_lower_actual:.9g}\n")
+            f.write(f"m_upper_actual {self.m_upper_actual:.9g}\n")
+            f.write(f"mean_mass_actual {self.mean_mass_actual:.9g}\n")
+            f.write(f"mean_mass2_actual {self.mean_mass2_actual:.9g}\n")
+            f.write(f"mean_mass2_ln_mass_actual {self.mean_mass2_ln_mass_actual:.9g}\n")
+            f.write(f"num_stars {self.num_stars}\n")
+            if self.rectangular:
+                f.write(f"corner_x1 {self.corner.real:.9g}\n")
+                f.write(f"corner_x2 {self.corner.imag:.9g}\n")
+                if self.approx:
+                    f.write(f"taylor_smooth {self.taylor_smooth}\n")
+            else:
+                f.write(f"rad {abs(self.corner):.9g}\n")
+            f.write(f"safety_scale {self.safety_scale:.9g}\n")
+            f.write(f"alpha_error {self.alpha_error:.9g}\n")
+            f.write(f"expansion_order {self.expansion_order}\n")
+            f.write(f"root_half_length {self.root_half_length:.9g}\n")
+            f.write(f"tree_levels {self.tree_levels}\n")
+        print_verbose(f"Done writing Microlensing parameter info to file {fname}", verbose, 1)
+
+        if self.write_stars:
+            print_verbose("Writing Microlensing star info...", verbose, 2)
+            fname = f"{self.outfile_prefix}{class_name}_stars.bin"
+            if self.rectangular:
+                corner = (self.corner.real, self.corner.imag)
+            else:
+                corner = (abs(self.corner), 0)
+            write_stars(fname, self.stars, self.rectangular, corner, self.theta_star, self.dtype)
+            print_verbose(f"Done writing Microlensing star info to file {fname}", verbose, 1)
+
+        return True
+
+
+class Library():
+    '''
+    stand-in for a ctypes library of the CUDA code, so that the Python
+    wrappers can drive a CPU implementation unchanged. for a class named
+    Name, provides Name_init, Name_delete, get_x and set_x for every
+    attribute x (strings are passed as bytes), run, save, and any other
+    run_ methods
+    '''
+
+    def __init__(self, cls, dtype):
+        self.cls = cls
+        self.dtype = dtype
+
+    def __getattr__(self, name: str):
+        if name == f"{self.cls.__name__}_init":
+            return lambda: self.cls(self.dtype)
+
+        if name == f"{self.cls.__name__}_delete":
+            return lambda obj: None
+
+        if name in ['run', 'save'] or name.startswith('run_'):
+            return lambda obj, *args: getattr(obj, name)(*args)
+
+        if name.startswith('get_'):
+            def get(obj):
+                if hasattr(type(obj), name):
+                    return getattr(obj, name)()
+                value = getattr(obj, name[4:])
+                if isinstance(value, str):
+                    return value.encode('utf-8')
+                return value
+            return get
+
+        if name.startswith('set_'):
+            def set(obj, value):
+                if isinstance(value, bytes):
+                    value = value.decode('utf-8')
+                setattr(obj, name[4:], value)
+            return set
+
+        raise AttributeError(name)
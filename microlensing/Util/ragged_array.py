@@ -0,0 +1,196 @@
+import numpy as np
+import os
+import struct
+
+
+'''
+ragged binary files, e.g. of image lines, consist of
+
+    num_members (int32), then for each member: n (int32), n values
+
+where each value is one number, or two for complex numbers. the counts
+interleave with the values, so finding member i requires a scan over all
+previous members. the scan is done once, and the byte offsets of the members
+may be cached in an index file next to the data so that reopening is
+immediate. members are then read through a memory map without copying
+'''
+
+
+class RaggedArray():
+    '''
+    memory mapped ragged array with O(1) access to each member
+
+        arr = RaggedArray(fname, np.float64, is_complex=True)
+        arr[i]        # view of member i
+        arr[i:j]      # RaggedArray of members i to j, sharing the memory map
+        for batch in arr.batches(1000):
+            ...
+    '''
+
+    def __init__(self, fname: str, dtype, is_complex: bool = False, cache_index: bool = True):
+        '''
+        :param fname: name of the file to read
+        :param dtype: type for the array
+        :param is_complex: bool, whether the numbers are complex or not
+                           default is False
+        :param cache_index: whether to read and write the offsets of the
+                            members in fname + '.index.npz'
+        '''
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        self.is_complex = is_complex
+        self._mm = np.memmap(fname, dtype=np.uint8, mode='r')
+
+        index = None
+        if cache_index:
+            index = self._read_index()
+        if index is None:
+            index = self._scan()
+            if cache_index:
+                self._write_index(*index)
+        self.starts, self.lengths = index
+
+    @property
+    def _values_per_item(self):
+        return 2 if self.is_complex else 1
+
+    @property
+    def _index_fname(self):
+        return self.fname + '.index.npz'
+
+    def _stat(self):
+        stat = os.stat(self.fname)
+        return np.array([stat.st_size, stat.st_mtime_ns, self.dtype.itemsize, self._values_per_item],
+                        dtype=np.int64)
+
+    def _scan(self):
+        '''
+        find the byte offset and length of every member with one pass over the
+        counts
+        '''
+        buffer = memoryview(self._mm)
+        if len(buffer) < 4:
+            raise ValueError(f"{self.fname} is too small to be a ragged array file")
+        num_members = struct.unpack_from('i', buffer, 0)[0]
+        if num_members < 0:
+            raise ValueError(f"Invalid number of members in {self.fname}")
+
+        item_size = self.dtype.itemsize * self._values_per_item
+        starts = np.empty(num_members, dtype=np.int64)
+        lengths = np.empty(num_members, dtype=np.int64)
+
+        unpack = struct.Struct('i').unpack_from
+        pos = 4
+        size = len(buffer)
+        for i in range(num_members):
+            if pos + 4 > size:
+                raise ValueError(f"{self.fname} ends after {i} of {num_members} members")
+            n = unpack(buffer, pos)[0]
+            if n < 0:
+                raise ValueError(f"Invalid length of member {i} in {self.fname}")
+            starts[i] = pos + 4
+            lengths[i] = n
+            pos += 4 + n * item_size
+        if pos > size:
+            raise ValueError(f"{self.fname} ends within its final member")
+
+        return starts, lengths
+
+    def _read_index(self):
+        try:
+            with np.load(self._index_fname) as index:
+                if not np.array_equal(index['stat'], self._stat()):
+                    return None
+                return index['starts'], index['lengths']
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _write_index(self, starts, lengths):
+        try:
+            # write then rename, so an interrupted write is never read back
+            tmp = self._index_fname + '.tmp.npz'
+            np.savez(tmp, stat=self._stat(), starts=starts, lengths=lengths)
+            os.replace(tmp, self._index_fname)
+        except OSError:
+            # the index is only a cache, e.g. for read only directories
+            pass
+
+    def __len__(self):
+        return self.lengths.size
+
+    @property
+    def offsets(self):
+        '''
+        offsets of the members in the flat array of all items. member i is
+        items offsets[i] to offsets[i+1]
+        '''
+        return np.concatenate(([0], np.cumsum(self.lengths)))
+
+    def _member(self, i: int):
+        shape = (int(self.lengths[i]), 2) if self.is_complex else (int(self.lengths[i]),)
+        return np.ndarray(shape, dtype=self.dtype, buffer=self._mm, offset=int(self.starts[i]))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            res = object.__new__(RaggedArray)
+            res.fname = self.fname
+            res.dtype = self.dtype
+            res.is_complex = self.is_complex
+            res._mm = self._mm
+            res.starts = self.starts[key]
+            res.lengths = self.lengths[key]
+            return res
+
+        i = int(key)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"index {key} is out of range for {len(self)} members")
+        return self._member(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._member(i)
+
+    def batches(self, batch_size: int):
+        '''
+        iterate over consecutive groups of members
+
+        :param batch_size: number of members per batch
+        :return batch: RaggedArray of at most batch_size members
+        '''
+        if batch_size < 1:
+            raise ValueError("batch_size must be >= 1")
+        for i in range(0, len(self), batch_size):
+            yield self[i: i + batch_size]
+
+    def flat(self, max_items: int = 2**22):
+        '''
+        copy all members into a single array
+
+        :param max_items: approximate number of items gathered at once
+        :return values: array of the items of all members
+        :return offsets: member i is values[offsets[i]:offsets[i+1]]
+        '''
+        offsets = self.offsets
+
+        # counts and values are multiples of 4 bytes, so the file is gathered
+        # as 4 byte units
+        units = self._mm[: self._mm.size // 4 * 4].view(np.uint32)
+        units_per_item = self.dtype.itemsize * self._values_per_item // 4
+        counts = self.lengths * units_per_item
+        unit_offsets = offsets * units_per_item
+
+        values = np.empty(int(unit_offsets[-1]), dtype=np.uint32)
+        bounds = np.searchsorted(offsets, np.arange(0, offsets[-1], max_items), side='right') - 1
+        bounds = np.unique(np.concatenate((bounds, [len(self)])))
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            c = counts[lo:hi]
+            num = int(c.sum())
+            within = np.arange(num) - np.repeat(np.cumsum(c) - c, c)
+            values[unit_offsets[lo]: unit_offsets[lo] + num] = units[np.repeat(self.starts[lo:hi] // 4, c) + within]
+
+        values = values.view(self.dtype)
+        if self.is_complex:
+            values = values.reshape(-1, 2)
+        return values, offsets
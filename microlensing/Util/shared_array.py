@@ -0,0 +1,97 @@
+from multiprocessing import resource_tracker, shared_memory
+
+import pickle
+
+
+'''
+objects are pickled with their arrays in the payload, so a payload can be
+unpickled any number of times. an object wrapped with to_shared to send it to
+or return it from a worker process is pickled with the buffers of its arrays,
+including those of the objects it holds, written to blocks of shared memory,
+and the payload only holds the names of the blocks. the process unpickling
+the object copies the buffers out of the blocks and frees them, so such a
+payload is meant to be unpickled once, as by multiprocessing and
+concurrent.futures. a payload that is never unpickled leaves its blocks in
+shared memory
+
+    def run(ipm):
+        ipm.run()
+        return to_shared(ipm)
+
+    ipm = executor.submit(run, to_shared(ipm)).result()
+'''
+
+
+# buffers smaller than this many bytes are pickled as usual, as a block of
+# shared memory costs more than copying them through the payload
+MIN_SHARED_BYTES = 2**16
+
+
+class SharedObject():
+    '''
+    object which is pickled with its buffers in shared memory, and unpickled
+    as the object itself
+    '''
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __reduce__(self):
+        # protocol 5 hands the buffers of contiguous arrays to the callback
+        # rather than writing them into the payload
+        buffers = []
+        payload = pickle.dumps(self.obj, protocol=5, buffer_callback=buffers.append)
+        return (_load, (payload, [_write(buffer.raw()) for buffer in buffers]))
+
+
+def _write(buffer: memoryview):
+    '''
+    :param buffer: buffer of an array of the object
+    :return block: name and size of a block of shared memory holding the
+                   buffer, or a copy of the buffer if it is small
+    '''
+    if buffer.nbytes < MIN_SHARED_BYTES:
+        return bytearray(buffer)
+
+    shm = shared_memory.SharedMemory(create=True, size=buffer.nbytes)
+    shm.buf[:buffer.nbytes] = buffer
+    shm.close()
+    # the block belongs to whichever process unpickles it, which may not
+    # share the resource tracker of this one
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return (shm.name, buffer.nbytes)
+
+def _read(block):
+    '''
+    :param block: block from _write
+    :return buffer: copy of the buffer, after which the block is freed
+    '''
+    if isinstance(block, bytearray):
+        return block
+
+    name, size = block
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        with shm.buf[:size] as view:
+            buffer = bytearray(view)
+    finally:
+        shm.close()
+        shm.unlink()
+    return buffer
+
+def _load(payload: bytes, blocks: list):
+    '''
+    :param payload: pickle of the object without its buffers
+    :param blocks: blocks from _write of each buffer
+    :return obj: the unpickled object
+    '''
+    return pickle.loads(payload, buffers=[_read(block) for block in blocks])
+
+def to_shared(obj):
+    '''
+    :param obj: object to send to or return from a worker process, e.g. an
+                IPM, CCF, NCC, or MIF instance
+    :return shared: wrapper of the object which is pickled through shared
+                    memory, and unpickled as the object itself
+    '''
+    return SharedObject(obj)
@@ -0,0 +1,249 @@
+import numpy as np
+import hashlib
+import os
+
+
+'''
+binary star files, as read by read_star_file_bin in star.cuh, consist of
+
+    num_stars (int32), rectangular (int32), corner (2 x T), theta_star (T),
+    stars (num_stars x 3 x T)
+
+where T is float32 or float64, determined from the size of the file. stars
+are written in bulk and read through memory maps, so files larger than memory
+can be streamed in chunks
+'''
+
+# size of the two int32 values at the start of the file
+INT_HEADER_SIZE = 8
+
+
+def _item_dtype(dtype):
+    if dtype == np.float64:
+        return np.dtype(np.float64)
+    elif dtype == np.float32:
+        return np.dtype(np.float32)
+    raise ValueError("dtype must be np.float32 or np.float64")
+
+def file_size(num_stars: int, dtype):
+    '''
+    :param num_stars: number of stars
+    :param dtype: np.float32 or np.float64
+    :return size: size in bytes of a star file
+    '''
+    return INT_HEADER_SIZE + (3 + 3 * num_stars) * _item_dtype(dtype).itemsize
+
+def read_header(fname: str):
+    '''
+    Read and validate the header of a binary file of star information, in the
+    same way as the C++ code
+
+    :param fname: name of the file to read
+    :return num_stars: number of stars
+    :return rectangular: bool of whether the star field is rectangular or
+                         circular
+    :return corner: corner of the star field (x1, x2). if circular, (rad, 0)
+    :return theta_star: Einstein radius of a unit mass point lens
+    :return dtype: data type of the file, np.float32 or np.float64
+    '''
+    if not fname.endswith('.bin'):
+        raise ValueError('fname must be a .bin file')
+
+    size = os.path.getsize(fname)
+    if size < INT_HEADER_SIZE:
+        raise ValueError(f"{fname} is too small to be a star file")
+
+    with open(fname, 'rb') as f:
+        num_stars, rectangular = np.fromfile(f, dtype=np.int32, count=2).tolist()
+
+        if num_stars < 1:
+            raise ValueError(f"Invalid num_stars in {fname}. num_stars must be an integer > 0")
+        if rectangular not in [0, 1]:
+            raise ValueError(f"Invalid rectangular in {fname}. rectangular must be 1 (rectangular) or 0 (circular)")
+
+        for dtype in [np.float32, np.float64]:
+            if size == file_size(num_stars, dtype):
+                break
+        else:
+            raise ValueError(f"Size of {fname} ({size} bytes) does not match {num_stars} stars "
+                             f"of type float32 ({file_size(num_stars, np.float32)} bytes) "
+                             f"or float64 ({file_size(num_stars, np.float64)} bytes)")
+
+        vals = np.fromfile(f, dtype=dtype, count=3)
+
+    return num_stars, bool(rectangular), vals[:2], vals[2], dtype
+
+def open_stars(fname: str, mode: str = 'r', verify: bool = False):
+    '''
+    Memory map a binary file of star information without reading it into
+    memory
+
+    :param fname: name of the file
+    :param mode: 'r' (read only) or 'r+' (read and write). default is 'r'
+    :param verify: whether to check the file against its checksum file, if
+                   one was written
+
+    :return stars: memory mapped array of stars (x1, x2, mass)
+    :return rectangular: bool of whether the star field is rectangular or
+                         circular
+    :return corner: corner of the star field (x1, x2). if circular, (rad, 0)
+    :return theta_star: Einstein radius of a unit mass point lens
+    '''
+    if mode not in ['r', 'r+']:
+        raise ValueError("mode must be 'r' or 'r+'")
+
+    num_stars, rectangular, corner, theta_star, dtype = read_header(fname)
+    if verify:
+        verify_checksum(fname)
+
+    offset = INT_HEADER_SIZE + 3 * np.dtype(dtype).itemsize
+    stars = np.memmap(fname, dtype=dtype, mode=mode, offset=offset, shape=(num_stars, 3))
+    return stars, rectangular, corner, theta_star
+
+def iter_stars(fname: str, chunk_size: int = 2**20, dtype=None):
+    '''
+    Iterate over the stars of a binary file in chunks, holding at most one
+    chunk in memory
+
+    :param fname: name of the file to read
+    :param chunk_size: number of stars per chunk
+    :param dtype: data type of the chunks. default is the type of the file
+    :return stars: array of at most chunk_size stars (x1, x2, mass)
+    '''
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be >= 1")
+
+    stars = open_stars(fname)[0]
+    if dtype is None:
+        dtype = stars.dtype
+    for i in range(0, stars.shape[0], chunk_size):
+        yield np.array(stars[i: i + chunk_size], dtype=dtype)
+
+
+class StarFileWriter():
+    '''
+    Write a binary file of star information in chunks. the number of stars is
+    written when the file is closed, so the total need not be known in advance
+
+        with StarFileWriter(fname, rectangular, corner, theta_star) as f:
+            for chunk in chunks:
+                f.write(chunk)
+    '''
+
+    def __init__(self, fname: str, rectangular: bool, corner, theta_star: float,
+                 dtype=np.float32, checksum: bool = False):
+        '''
+        :param fname: name of the file to write
+        :param rectangular: bool of whether the star field is rectangular or
+                            circular
+        :param corner: array of 2 numbers representing the (x1, x2) corner of
+                       the star field in the case of rectangular star fields.
+                       if the star field is circular, this should be (rad, 0)
+        :param theta_star: Einstein radius of a unit mass point lens in
+                           arbitrary units. typically 1
+        :param dtype: data type for the file. default is np.float32
+        :param checksum: whether to also write a checksum file, fname + '.blake2b'
+        '''
+        if not fname.endswith('.bin'):
+            raise ValueError('fname must be a .bin file')
+
+        self.fname = fname
+        self.dtype = _item_dtype(dtype)
+        self.checksum = checksum
+        self.num_stars = 0
+
+        self._file = open(fname, 'wb')
+        np.array([0, 1 if rectangular else 0], dtype=np.int32).tofile(self._file)
+        np.array([*np.asarray(corner).tolist(), theta_star], dtype=self.dtype).tofile(self._file)
+
+    def write(self, stars):
+        '''
+        :param stars: array of stars in the form (x1, x2, mass)
+        '''
+        stars = np.asarray(stars)
+        if stars.ndim != 2 or stars.shape[1] != 3:
+            raise ValueError("stars must be an array of shape (num_stars, 3)")
+        if self.num_stars + stars.shape[0] > np.iinfo(np.int32).max:
+            raise ValueError("number of stars is too large for the file format")
+
+        np.ascontiguousarray(stars, dtype=self.dtype).tofile(self._file)
+        self.num_stars += stars.shape[0]
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        np.array([self.num_stars], dtype=np.int32).tofile(self._file)
+        self._file.close()
+        if self.checksum:
+            write_checksum(self.fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_stars(fname: str, stars, rectangular: bool, corner, theta_star: float,
+                dtype=np.float32, chunk_size: int = 2**20, checksum: bool = False):
+    '''
+    Write a binary file of star information in bulk
+
+    :param fname: name of the file to write
+    :param stars: array of stars in the form (x1, x2, mass)
+    :param rectangular: bool of whether the star field is rectangular or
+                        circular
+    :param corner: array of 2 numbers representing the (x1, x2) corner of the
+                   star field in the case of rectangular star fields.
+                   if the star field is circular, this should be (rad, 0)
+    :param theta_star: Einstein radius of a unit mass point lens in arbitrary
+                       units. typically 1
+    :param dtype: data type for the file. default is np.float32
+    :param chunk_size: number of stars converted to dtype at a time
+    :param checksum: whether to also write a checksum file, fname + '.blake2b'
+    '''
+    if not isinstance(stars, np.ndarray):
+        stars = np.array(stars)
+    if stars.ndim != 2:
+        raise ValueError("stars is not a 2D array")
+
+    with StarFileWriter(fname, rectangular, corner, theta_star, dtype, checksum) as f:
+        for i in range(0, stars.shape[0], chunk_size):
+            f.write(stars[i: i + chunk_size])
+
+
+def file_checksum(fname: str, chunk_size: int = 2**24):
+    '''
+    :param fname: name of the file
+    :param chunk_size: number of bytes read at a time
+    :return checksum: hex digest of the BLAKE2b hash of the file
+    '''
+    h = hashlib.blake2b()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def write_checksum(fname: str):
+    '''
+    Write the checksum of a file to fname + '.blake2b'. the file itself is
+    unchanged, so it stays readable by the C++ code
+    '''
+    with open(fname + '.blake2b', 'w') as f:
+        f.write(file_checksum(fname) + '\n')
+
+def verify_checksum(fname: str):
+    '''
+    Check a file against its checksum file, if there is one
+
+    :return verified: True if the checksum matches, False if there is no
+                      checksum file
+    '''
+    if not os.path.exists(fname + '.blake2b'):
+        return False
+    with open(fname + '.blake2b') as f:
+        expected = f.read().strip()
+    if file_checksum(fname) != expected:
+        raise ValueError(f"Checksum of {fname} does not match {fname}.blake2b")
+    return True
@@ -0,0 +1,335 @@
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+'''
+sweeps over grids of parameters of IPM or CCF runs. every point of the grid
+is run in a pool of worker processes, one per slot (a GPU, or a share of the
+CPUs), and written to its own output directory. each finished point is
+recorded in an sqlite index together with its parameters, timings, and output
+files, so a sweep that is restarted after a crash skips the points that were
+already completed
+
+    sweep = Sweep('ipm', {'kappa_tot': [0.3, 0.5], 'random_seed': [1, 2, 3]},
+                  'sweep_output', fixed={'shear': 0.3, 'smooth_fraction': 0.5,
+                                         'half_length_y1': 10, 'half_length_y2': 10})
+    sweep.run()
+
+as workers are started with the spawn method, scripts running a sweep must be
+guarded by if __name__ == '__main__'
+'''
+
+
+def _json_value(value):
+    '''
+    convert numpy scalars and tuples so that parameters and timings can be
+    written as json
+    '''
+    if hasattr(value, 'item'):
+        return value.item()
+    if isinstance(value, (tuple, list)):
+        return [_json_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _json_value(v) for k, v in value.items()}
+    return value
+
+def parameter_grid(grid: dict, fixed: dict = None):
+    '''
+    every combination of the values in a grid of parameters
+
+    :param grid: dictionary mapping a parameter name to a list of values. a
+                 tuple of names maps to a list of tuples of values which vary
+                 together, e.g. ('center_y1', 'center_y2'): [(0, 0), (10, 0)]
+                 for a sweep over source regions
+    :param fixed: dictionary of parameters which are the same for every point
+    :return points: list of dictionaries of the parameters of every point
+    '''
+    if fixed is None:
+        fixed = {}
+
+    names = list(grid.keys())
+    points = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        point = dict(fixed)
+        for name, value in zip(names, values):
+            if isinstance(name, tuple):
+                if len(name) != len(value):
+                    raise ValueError(f"values for {name} must have {len(name)} elements")
+                point.update(zip(name, value))
+            else:
+                point[name] = value
+        points.append({key: _json_value(val) for key, val in point.items()})
+    return points
+
+def point_key(kind: str, params: dict):
+    '''
+    :param kind: 'ipm' or 'ccf'
+    :param params: dictionary of parameters of the point
+    :return key: hash identifying the point
+    '''
+    text = json.dumps([kind, params], sort_keys=True)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class ResultIndex():
+    '''
+    sqlite index of the points of a sweep. a point is only recorded as done
+    once its output has been saved
+    '''
+
+    def __init__(self, fname: str):
+        '''
+        :param fname: name of the sqlite database
+        '''
+        self.fname = fname
+        self._con = sqlite3.connect(fname)
+        with self._con:
+            self._con.execute('''CREATE TABLE IF NOT EXISTS points (
+                                     key TEXT PRIMARY KEY,
+                                     kind TEXT,
+                                     status TEXT,
+                                     params TEXT,
+                                     outfile_prefix TEXT,
+                                     outputs TEXT,
+                                     t_shoot_cells REAL,
+                                     t_ccs REAL,
+                                     t_total REAL,
+                                     error TEXT,
+                                     finished REAL,
+                                     timings TEXT)''')
+
+    def completed(self):
+        '''
+        :return keys: set of the keys of all completed points
+        '''
+        return set(row[0] for row in self._con.execute("SELECT key FROM points WHERE status = 'done'"))
+
+    def record(self, key: str, kind: str, params: dict, outfile_prefix: str, outputs=None,
+               t_shoot_cells: float = None, t_ccs: float = None, t_total: float = None, error: str = None,
+               timings: dict = None):
+        '''
+        record a finished point, replacing any earlier record of it
+
+        :param key: hash identifying the point
+        :param kind: 'ipm' or 'ccf'
+        :param params: dictionary of parameters of the point
+        :param outfile_prefix: prefix of the output files of the point
+        :param outputs: list of output files
+        :param t_shoot_cells: time taken to shoot cells, for IPM
+        :param t_ccs: time taken to find critical curves, for CCF
+        :param t_total: time taken to run and save the point
+        :param error: error message if the point failed. failed points are
+                      run again when the sweep is restarted
+        :param timings: dictionary of the time of each stage of the point and
+                        the peak memory of its worker
+        '''
+        status = 'done' if error is None else 'failed'
+        with self._con:
+            self._con.execute("INSERT OR REPLACE INTO points (key, kind, status, params, outfile_prefix, outputs, "
+                              "t_shoot_cells, t_ccs, t_total, error, finished, timings) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (key, kind, status, json.dumps(params, sort_keys=True), outfile_prefix,
+                               json.dumps(outputs or []), t_shoot_cells, t_ccs, t_total, error, time.time(),
+                               json.dumps(timings or {})))
+
+    def results(self, status: str = 'done'):
+        '''
+        :param status: 'done' or 'failed'
+        :return results: list of dictionaries of the recorded points
+        '''
+        cursor = self._con.execute("SELECT * FROM points WHERE status = ? ORDER BY finished", (status,))
+        names = [col[0] for col in cursor.description]
+        results = []
+        for row in cursor:
+            result = dict(zip(names, row))
+            result['params'] = json.loads(result['params'])
+            result['outputs'] = json.loads(result['outputs'])
+            result['timings'] = json.loads(result['timings'] or '{}')
+            results.append(result)
+        return results
+
+    def close(self):
+        self._con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _init_worker(slots, backend: str):
+    '''
+    claim a slot for this worker process. for the gpu backend, the slot is the
+    device the worker runs on
+    '''
+    slot = slots.get()
+    if backend == 'gpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(slot)
+
+def run_point(kind: str, params: dict, outfile_prefix: str):
+    '''
+    run and save a single point of a sweep
+
+    :param kind: 'ipm' or 'ccf'
+    :param params: dictionary of keyword arguments for IPM or CCF
+    :param outfile_prefix: prefix of the output files
+    :return outputs: list of output files
+    :return t_shoot_cells: time taken to shoot cells, for IPM
+    :return t_ccs: time taken to find critical curves, for CCF
+    :return t_total: time taken to run and save the point
+    :return timings: dictionary of the time of each stage of the point and
+                     the peak memory of the worker
+    '''
+    t0 = time.perf_counter()
+
+    if kind == 'ipm':
+        from microlensing.IPM.ipm import IPM
+        obj = IPM(**params, outfile_prefix=outfile_prefix)
+    elif kind == 'ccf':
+        from microlensing.CCF.ccf import CCF
+        obj = CCF(**params, outfile_prefix=outfile_prefix)
+    else:
+        raise ValueError("kind must be ipm or ccf")
+
+    obj.run()
+    obj.save()
+
+    t_shoot_cells = obj.t_shoot_cells if kind == 'ipm' else None
+    t_ccs = obj.t_ccs if kind == 'ccf' else None
+
+    directory = os.path.dirname(outfile_prefix) or '.'
+    outputs = sorted(os.path.join(directory, fname) for fname in os.listdir(directory)
+                     if os.path.join(directory, fname).startswith(outfile_prefix))
+    return outputs, t_shoot_cells, t_ccs, time.perf_counter() - t0, _json_value(obj.timings)
+
+
+class Sweep():
+    '''
+    resumable sweep over a grid of IPM or CCF parameters
+    '''
+
+    def __init__(self, kind: str, grid: dict, outdir: str, fixed: dict = None,
+                 slots=None, index_fname: str = None, verbose: int = 1):
+        '''
+        :param kind: 'ipm' or 'ccf'
+        :param grid: dictionary mapping a parameter name, or a tuple of names,
+                     to a list of values. see parameter_grid
+        :param outdir: directory for the output. each point is written to
+                       its own subdirectory named by the key of the point
+        :param fixed: dictionary of parameters which are the same for every
+                      point, e.g. write_maps or backend
+        :param slots: list with one entry per worker. for the gpu backend,
+                      these are the devices to run on. default is [0] for the
+                      gpu backend and one slot per CPU for the cpu backend
+        :param index_fname: name of the sqlite index. default is
+                            outdir/sweep_index.sqlite
+        :param verbose: verbosity level of messages. must be 0 or 1
+        '''
+        if kind not in ['ipm', 'ccf']:
+            raise ValueError("kind must be ipm or ccf")
+        self.kind = kind
+        self.points = parameter_grid(grid, fixed)
+        self.outdir = outdir
+        self.verbose = verbose
+
+        self.backend = (fixed or {}).get('backend', 'gpu')
+        if slots is None:
+            if self.backend == 'gpu':
+                slots = [0]
+            else:
+                from microlensing.Util.microlensing_cpu import available_cpus
+                slots = list(range(available_cpus()))
+        if len(slots) < 1:
+            raise ValueError("slots must contain at least one slot")
+        self.slots = list(slots)
+
+        if index_fname is None:
+            index_fname = os.path.join(outdir, 'sweep_index.sqlite')
+        self.index_fname = index_fname
+
+    @property
+    def keys(self):
+        return [point_key(self.kind, params) for params in self.points]
+
+    def outfile_prefix(self, key: str):
+        return os.path.join(self.outdir, key, '')
+
+    def _worker_params(self, params: dict):
+        params = dict(params)
+        # workers on the cpu backend share the CPUs unless told otherwise
+        if self.kind == 'ipm' and self.backend == 'cpu' and 'num_processes' not in params:
+            from microlensing.Util.microlensing_cpu import available_cpus
+            params['num_processes'] = max(1, available_cpus() // len(self.slots))
+        return params
+
+    def pending(self):
+        '''
+        :return points: list of (key, params) of the points which have not
+                        been completed
+        '''
+        with ResultIndex(self.index_fname) as index:
+            done = index.completed()
+        return [(key, params) for key, params in zip(self.keys, self.points) if key not in done]
+
+    def run(self):
+        '''
+        run every point that has not been completed yet. failed points are
+        recorded with their error, and retried the next time the sweep is run
+
+        :return num_failed: number of points which failed
+        '''
+        os.makedirs(self.outdir, exist_ok=True)
+        pending = self.pending()
+        if self.verbose:
+            print(f"{len(self.points) - len(pending)} of {len(self.points)} points already completed", flush=True)
+        if len(pending) == 0:
+            return 0
+
+        # CUDA cannot be used in forked processes
+        ctx = multiprocessing.get_context('spawn')
+        slots = ctx.Queue()
+        for slot in self.slots:
+            slots.put(slot)
+
+        num_failed = 0
+        with ResultIndex(self.index_fname) as index, \
+             ProcessPoolExecutor(max_workers=len(self.slots), mp_context=ctx,
+                                 initializer=_init_worker, initargs=(slots, self.backend)) as pool:
+            futures = {}
+            for key, params in pending:
+                prefix = self.outfile_prefix(key)
+                os.makedirs(prefix, exist_ok=True)
+                futures[pool.submit(run_point, self.kind, self._worker_params(params), prefix)] = (key, params)
+
+            for i, future in enumerate(as_completed(futures), start=1):
+                key, params = futures[future]
+                try:
+                    outputs, t_shoot_cells, t_ccs, t_total, timings = future.result()
+                except Exception as e:
+                    num_failed += 1
+                    index.record(key, self.kind, params, self.outfile_prefix(key), error=repr(e))
+                    if self.verbose:
+                        print(f"Point {key} failed: {e!r}", flush=True)
+                    continue
+                index.record(key, self.kind, params, self.outfile_prefix(key), outputs,
+                             t_shoot_cells, t_ccs, t_total, timings=timings)
+                if self.verbose:
+                    print(f"Completed point {i} of {len(pending)} in {t_total} seconds.", flush=True)
+
+        return num_failed
+
+    def results(self):
+        '''
+        :return results: list of dictionaries of the completed points of this
+                         sweep, as recorded in the index
+        '''
+        keys = set(self.keys)
+        with ResultIndex(self.index_fname) as index:
+            return [result for result in index.results() if result['key'] in keys]
@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+import functools
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+'''
+instrumentation of the stages of a run. the wrappers and the cpu backend
+record the time of each stage in a dict with stage(), and report it along with
+the peak memory of the process through their timings property. a Profiler
+additionally records every call of the pipeline functions decorated with
+profiled while it is active
+
+    with Profiler() as prof:
+        ipm.run()
+        lightcurves.constant_source(ipm, source, 1000)
+    print(prof.report())
+'''
+
+
+def peak_memory():
+    '''
+    :return peak_memory: peak resident memory of the process in bytes, or None
+                         if it is not available on this platform
+    '''
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+@contextmanager
+def stage(timings: dict, name: str):
+    '''
+    add the time taken within the context to timings[name]
+
+    :param timings: dictionary of stage names to times in seconds
+    :param name: name of the stage
+    '''
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - t0
+
+
+# profilers currently recording, innermost last
+_profilers = []
+
+def profiled(func):
+    '''
+    decorator recording the calls of a function in any active Profiler. calls
+    made while no Profiler is active only pay for one check
+    '''
+    name = f"{func.__module__}.{func.__qualname__}".removeprefix('microlensing.')
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _profilers:
+            return func(*args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t0
+            for profiler in _profilers:
+                profiler.add(name, elapsed)
+
+    return wrapper
+
+
+class Profiler():
+    '''
+    context manager recording the number of calls and the total time of every
+    profiled function called within it. times of nested calls are included in
+    the times of the functions that call them
+    '''
+
+    def __init__(self):
+        self.stats = {}
+        self.time = 0
+        self.peak_memory = None
+        self._t0 = None
+
+    def add(self, name: str, elapsed: float):
+        calls, total = self.stats.get(name, (0, 0))
+        self.stats[name] = (calls + 1, total + elapsed)
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        _profilers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _profilers.remove(self)
+        self.time += time.perf_counter() - self._t0
+        self.peak_memory = peak_memory()
+
+    def as_dict(self):
+        '''
+        :return stats: dictionary with the total time within the profiler, the
+                       peak memory of the process in bytes, and the calls and
+                       time of every profiled function
+        '''
+        return {'time': self.time,
+                'peak_memory': self.peak_memory,
+                'functions': {name: {'calls': calls, 'time': total}
+                              for name, (calls, total) in self.stats.items()}}
+
+    def report(self):
+        '''
+        :return report: table of the profiled functions, slowest first
+        '''
+        lines = [f"{'function':<50} {'calls':>8} {'time (s)':>12}"]
+        for name, (calls, total) in sorted(self.stats.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<50} {calls:>8} {total:>12.4f}")
+        lines.append(f"{'total':<50} {'':>8} {self.time:>12.4f}")
+        if self.peak_memory is not None:
+            lines.append(f"peak memory {self.peak_memory / 2**20:.1f} MiB")
+        return '\n'.join(lines)
@@ -1,5 +1,7 @@
+from microlensing.Util import star_file
+from microlensing.Util.ragged_array import RaggedArray
+
 import numpy as np
-import struct
 
 
 def read_params(fname: str):
@@ -27,7 +29,8 @@ def read_stars(fname: str, dtype=np.float32):
     Read in a binary file of star information
 
     :param fname: name of the file to read
-    :param dtype: data type for the file. default is np.float32
+    :param dtype: data type for the stars. the type of the file is determined
+                  from its size. default is np.float32
 
     :return stars: array of stars (x1, x2, mass)
     :return rectangular: bool of whether the star field is rectangular or
@@ -36,17 +39,10 @@ def read_stars(fname: str, dtype=np.float32):
     :return theta_star: Einstein radius of a unit mass point lens in arbitrary
                         units
     '''
+    stars, rectangular, corner, theta_star = star_file.open_stars(fname)
+    stars = np.array(stars, dtype=dtype)
 
-    with open(fname) as f:
-        nstars = np.fromfile(f, dtype=np.int32, count=1)[0]
-        rectangular = np.fromfile(f, dtype=np.int32, 
-                                  count=1).astype(np.bool_)[0]
-        corner = np.fromfile(f, dtype=dtype, count=2)
-        theta_star = np.fromfile(f, dtype=dtype, count=1)[0]
-        stars = np.fromfile(f, dtype=dtype)
-        stars = stars.reshape(nstars, 3)
-
-    return stars, rectangular, corner, theta_star
+    return stars, rectangular, corner.astype(dtype), dtype(theta_star)
 
 
 def write_stars(fname: str, stars, rectangular: bool, corner,
@@ -65,38 +61,7 @@ def write_stars(fname: str, stars, rectangular: bool, corner,
                        units. typically 1
     :param dtype: data type for the file. default is np.float32
     '''
-    if not fname.endswith('.bin'):
-        raise ValueError('fname must be a .bin file')
-    
-    if not isinstance(stars, np.ndarray):
-        stars = np.array(stars)
-    if stars.ndim != 2:
-        raise ValueError("stars is not a 2D array")
-    
-    if dtype == np.float64:
-        dtype = 'd'
-    elif dtype == np.float32:
-        dtype = 'f'
-    else:
-        raise ValueError("dtype must be np.float32 or np.float64")
-
-    if rectangular:
-        rectangular = 1
-    else:
-        rectangular = 0
-
-    with open(fname, 'wb') as f:
-        s = struct.pack('i', stars.shape[0])
-        f.write(s)
-        s = struct.pack('i', rectangular)
-        f.write(s)
-        s = struct.pack(dtype * 2, *corner)
-        f.write(s)
-        s = struct.pack(dtype, theta_star)
-        f.write(s)
-        s = struct.pack(dtype * len(stars.ravel()), *stars.ravel())
-        f.write(s)
-        f.close()
+    star_file.write_stars(fname, stars, rectangular, corner, theta_star, dtype)
 
 
 def read_array(fname: str, dtype, is_complex: bool = False):
@@ -119,6 +84,59 @@ def read_array(fname: str, dtype, is_complex: bool = False):
     return dat
 
 
+def write_array(fname: str, dat, dtype=np.float32):
+    '''
+    Write a binary file of a 2d array of numbers. complex numbers are written
+    as (re, im) pairs, as read by read_array with is_complex
+
+    :param fname: name of the file to write
+    :param dat: 2d array to write
+    :param dtype: type for the array, or for each part of complex numbers.
+                  default is np.float32
+    '''
+    if not fname.endswith('.bin'):
+        raise ValueError('fname must be a .bin file')
+
+    dat = np.asarray(dat)
+    if dat.ndim != 2:
+        raise ValueError("dat is not a 2D array")
+
+    with open(fname, 'wb') as f:
+        np.array(dat.shape, dtype=np.int32).tofile(f)
+        if np.iscomplexobj(dat):
+            dat = np.stack([dat.real, dat.imag], axis=-1)
+        np.ascontiguousarray(dat, dtype=dtype).tofile(f)
+
+
+def open_array(fname: str, dtype, mode: str = 'r', shape=None):
+    '''
+    Memory map a binary file of a 2d array of numbers, as written by
+    write_array, without reading it into memory
+
+    :param fname: name of the file
+    :param dtype: type for the array
+    :param mode: 'r' (read only), 'r+' (read and write), or 'w+' (create or
+                 overwrite the file). default is 'r'
+    :param shape: (nrows, ncols) of the array. required if mode is 'w+'
+    '''
+    if mode == 'w+':
+        if shape is None:
+            raise ValueError("shape must be provided when creating a file")
+        if not fname.endswith('.bin'):
+            raise ValueError('fname must be a .bin file')
+        with open(fname, 'wb') as f:
+            np.array(shape, dtype=np.int32).tofile(f)
+            f.truncate(8 + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        mode = 'r+'
+    elif mode not in ['r', 'r+']:
+        raise ValueError("mode must be 'r', 'r+', or 'w+'")
+
+    with open(fname, 'rb') as f:
+        nrows, ncols = np.fromfile(f, dtype=np.int32, count=2)
+
+    return np.memmap(fname, dtype=dtype, mode=mode, offset=8, shape=(int(nrows), int(ncols)))
+
+
 def read_ragged_array(fname: str, dtype, is_complex: bool = False):
     '''
     Read in a binary file of a ragged array of numbers
@@ -128,19 +146,7 @@ def read_ragged_array(fname: str, dtype, is_complex: bool = False):
     :param is_complex: bool, whether the numbers are complex or not
                        default is False
     '''
-    with open(fname) as f:
-        res = []
-        n_members = np.fromfile(f, dtype=np.int32, count=1)[0]
-        for i in range(n_members):
-            n = np.fromfile(f, dtype=np.int32, count=1)[0]
-            if is_complex:
-                dat = np.fromfile(f, dtype=dtype, count=n * 2)
-                dat = dat.reshape(n, 2)
-            else:
-                dat = np.fromfile(f, dtype=dtype, count=n)
-            res.append(dat)
-
-    return res
+    return [np.array(member) for member in RaggedArray(fname, dtype, is_complex, cache_index=False)]
 
 
 def read_hist(fname: str):
@@ -151,3 +157,22 @@ def read_hist(fname: str):
     :param fname: name of the file to read
     '''
     return np.loadtxt(fname, dtype=np.int32)
+
+
+def write_hist(fname: str, values, counts):
+    '''
+    Write a whitespace delimited text file of integer
+    (value, num_pixels) lines, skipping values with no pixels
+
+    :param fname: name of the file to write
+    :param values: integer values of the histogram bins
+    :param counts: number of pixels in each bin
+    '''
+    if not fname.endswith('.txt'):
+        raise ValueError('fname must be a .txt file')
+
+    values = np.asarray(values)
+    counts = np.asarray(counts)
+    where = counts != 0
+
+    np.savetxt(fname, np.column_stack((values[where], counts[where])), fmt='%d')